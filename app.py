@@ -1,13 +1,34 @@
-from flask import Flask, request, json, jsonify, render_template
+from flask import Flask, request, json, jsonify, render_template, url_for, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
-import http.client
+from sqlalchemy import insert, select, update, delete, func, literal, or_, and_, event, inspect, text
+from datetime import datetime, timedelta, timezone
 import logging
 import os
 from dotenv import load_dotenv
 from translations import get_message
 from io import StringIO # Importar StringIO para el manejo de credenciales
-import threading
+from urllib.parse import quote
+import atexit
+import click
+import csv
+import gzip
+from workers import ColaLlena, ColaTrabajo, TareaPeriodica
+from graph_client import GraphClient
+from log_writer import EscritorLog
+from dedup import Deduplicador
+from flows import MotorFlujo
+from payloads import CachePlantillas
+from sessions import AlmacenSesiones
+from outbound import LimitadorTasa, ProgramadorEnvios
+from metrics import RegistroMetricas
+from firma import VerificadorFirma
+from media import TIPOS_MEDIA, CacheMedia, DescargadorMedia, subir_media
+from campaigns import EjecutorCampana, PENDIENTE, ENVIANDO, ENVIADO, FALLIDO
+from exportar import (COLUMNAS_EXPORTACION, FORMATOS, SubidorSheets, cursor_de_fila, filas_a_jsonl,
+                      guardar_punto_control, leer_punto_control, token_sheets)
+import random
+import time
+import uuid
 
 load_dotenv()
 #_______________________________________________________________________________________
@@ -17,7 +38,7 @@ Descripción: Primer Bot de Whatsapp para la empresa TicAll Media,
 con descarga en Google Sheet de Conversaciones
 
 Caracteristicas: 
--Un solo idioma, debido a que se genera lentitud en la aplicación
+-Idioma por usuario guardado en la tabla de sesiones y servido desde una caché en memoria
 -Uso de diccionario: Se crea un diccionario con las respuestas básicas en español e ingles
 -Variables de entorno: Se guarda Todas las credenciales de whatsapp y google para una 
 administración mas segura.
@@ -27,8 +48,35 @@ administración mas segura.
 Cambios:
 -Debido a que apesar de alimentar el google sheet asincronicamente, empeoro la duplicidad 
 de los mensajes, no se realizara copia en google.
--Se eliminaran el codgio de consulta de idioma y solo se utilizara uno
+-Se eliminó la consulta del idioma en Google Sheet; el idioma de cada usuario se guarda en la
+tabla de sesiones (ver más abajo)
 -El código solo permanecera en su forma mas básica
+-El webhook responde 200 de inmediato y los mensajes se procesan en una cola acotada (workers.py)
+-Envíos a WhatsApp con un pool de conexiones keep-alive y reintentos (graph_client.py)
+-El log se escribe por lotes desde un solo hilo en lugar de un hilo por mensaje (log_writer.py)
+-Los reenvíos de Meta con el mismo id de mensaje se confirman sin reprocesar (dedup.py)
+-Se procesan todas las entradas, cambios, mensajes y estados de entrega de cada POST
+-Dashboard paginado por cursor y con filtros, consultado y ordenado en la DB (también en /api/log)
+-El flujo de conversación se define en flows.json (máquina de estados, recarga en caliente)
+-Los mensajes salientes se serializan una vez y se cachean como plantillas (payloads.py)
+-Vuelve el idioma por usuario, sin consultar la DB en cada mensaje (sessions.py)
+-Motor de DB configurable con DATABASE_URL (pool de conexiones); en SQLite se usa WAL y busy_timeout
+-Modo asíncrono opcional (asgi.py, uvicorn asgi:app) que reutiliza la lógica del flujo
+-Envíos con orden FIFO por destinatario y límite de tasa por número emisor (outbound.py)
+-Tiempos por etapa y contadores en formato Prometheus en /metrics (metrics.py); el JSON del
+webhook solo se vuelca al log en DEBUG o por muestreo (LOG_PAYLOAD_MUESTREO)
+-Exportación masiva del log en CSV/JSONL (/api/log/exportar y `flask exportar-log`), incremental
+por punto de control (fecha|id, con un retraso de seguridad) y con subida por lotes a Google Sheets (exportar.py)
+-Resúmenes diarios del log (tabla resumen_diario) y retención: los registros viejos se archivan
+o borran por lotes (`flask mantener-log` o MANTENIMIENTO_INTERVALO); el dashboard muestra un panel
+de estadísticas servido desde los resúmenes
+-Los POST del webhook se aceptan solo con una firma X-Hub-Signature-256 válida (firma.py); sin
+META_WHATSAPP_APP_SECRET se rechazan todos, salvo con WEBHOOK_EXIGIR_FIRMA=0
+-La imagen del saludo se sube una vez a /media y se envía por id (guardado en la tabla
+media_subido hasta que vence); las imágenes, audios y documentos recibidos se descargan a
+disco por bloques (media.py)
+-Campañas de envío masivo por lotes, con estado por destinatario y reanudables sin envíos
+dobles (campaigns.py, `flask campana ...`)
 
 """
 #_______________________________________________________________________________________
@@ -37,13 +85,50 @@ app = Flask(__name__)
 # Configura el logger (útil para depurar en Render)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Configuración de base de datos SQLITE
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///metapython.db'
+# Configuración de base de datos: SQLite por defecto, o la URL de DATABASE_URL (p. ej. PostgreSQL)
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///metapython.db')
+if DATABASE_URL.startswith('postgres://'):
+    DATABASE_URL = 'postgresql://' + DATABASE_URL[len('postgres://'):] # Formato antiguo que usa Render/Heroku
+ES_SQLITE = DATABASE_URL.startswith('sqlite')
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+if ES_SQLITE:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000, 'check_same_thread': False}
+    }
+else:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '5')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '10')),
+        'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', '30')),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
+        'pool_pre_ping': True
+    }
 db = SQLAlchemy(app)
 
+def _configurar_sqlite(dbapi_connection, connection_record):
+    """WAL permite leer mientras se escribe; NORMAL reduce fsyncs; busy_timeout espera en vez de fallar con 'database is locked'."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+if ES_SQLITE:
+    with app.app_context():
+        event.listen(db.engine, 'connect', _configurar_sqlite)
+
 # Creación tabla, o modelado
 class Log(db.Model):
+    # Índices para el dashboard: orden por fecha (paginación por cursor) y filtros
+    __table_args__ = (
+        db.Index('ix_log_fecha_id', 'fecha_y_hora', 'id'),
+        db.Index('ix_log_telefono_fecha', 'telefono_usuario_id', 'fecha_y_hora'),
+        db.Index('ix_log_estado_usuario', 'estado_usuario'),
+        db.Index('ix_log_etiqueta_campana', 'etiqueta_campana'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     fecha_y_hora = db.Column(db.DateTime, default=datetime.utcnow)
     telefono_usuario_id = db.Column(db.Text)
@@ -53,84 +138,1156 @@ class Log(db.Model):
     etiqueta_campana = db.Column(db.Text)
     agente = db.Column(db.Text)
 
+# Sesión por usuario: idioma, paso actual del flujo y última actividad
+class SesionUsuario(db.Model):
+    telefono_usuario_id = db.Column(db.String(32), primary_key=True)
+    idioma = db.Column(db.String(8))
+    paso_flujo = db.Column(db.Text)
+    ultima_vez = db.Column(db.DateTime, index=True)
+
+# Ids de mensajes de WhatsApp ya procesados (deduplicación de reenvíos de Meta)
+class MensajeProcesado(db.Model):
+    id = db.Column(db.String(128), primary_key=True)
+    fecha_y_hora = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+# Media ids de los recursos subidos a /media, compartidos entre procesos y reinicios
+class MediaSubido(db.Model):
+    origen = db.Column(db.String(512), primary_key=True)
+    media_id = db.Column(db.String(128), nullable=False)
+    vence = db.Column(db.DateTime, nullable=False)
+
+# Campañas de envío masivo: el nombre se usa como etiqueta_campana de los envíos en el log
+class Campana(db.Model):
+    nombre = db.Column(db.String(64), primary_key=True)
+    tipo = db.Column(db.String(16), nullable=False)
+    mensaje = db.Column(db.Text, nullable=False)
+    botones = db.Column(db.Text) # JSON [[titulo, id], ...] para el tipo 'button'
+    estado = db.Column(db.String(16), nullable=False, default='creada')
+    creada = db.Column(db.DateTime, default=datetime.utcnow)
+    actualizada = db.Column(db.DateTime, default=datetime.utcnow)
+    ejecutor = db.Column(db.String(32)) # Token del proceso que la está enviando (bloqueo), renovado por tramo
+    ejecutor_vence = db.Column(db.DateTime)
+
+# Estado del envío de una campaña a cada destinatario (pendiente, enviando, enviado, fallido)
+class EnvioCampana(db.Model):
+    __table_args__ = (
+        db.Index('ix_envio_campana_estado', 'campana', 'estado', 'telefono_usuario_id'),
+    )
+    campana = db.Column(db.String(64), db.ForeignKey('campana.nombre'), primary_key=True)
+    telefono_usuario_id = db.Column(db.String(32), primary_key=True)
+    estado = db.Column(db.String(16), nullable=False, default=PENDIENTE)
+    wamid = db.Column(db.Text)
+    error = db.Column(db.Text)
+    actualizado = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Resumen diario del log por campaña, estado y usuario (lo llena el mantenimiento del log).
+# Las claves nulas del log se guardan como '' porque forman parte de la clave primaria
+class ResumenDiario(db.Model):
+    dia = db.Column(db.Date, primary_key=True)
+    etiqueta_campana = db.Column(db.Text, primary_key=True)
+    estado_usuario = db.Column(db.Text, primary_key=True)
+    telefono_usuario_id = db.Column(db.Text, primary_key=True)
+    mensajes = db.Column(db.Integer, nullable=False)
+    primera_vez = db.Column(db.DateTime)
+    ultima_vez = db.Column(db.DateTime)
+
+# Estado del mantenimiento del log compartido entre procesos: 'resumido_hasta' (último día resumido,
+# en ISO) y 'bloqueo' (token del proceso que lo está ejecutando y hasta cuándo vale)
+class EstadoMantenimiento(db.Model):
+    clave = db.Column(db.String(32), primary_key=True)
+    valor = db.Column(db.Text)
+    vence = db.Column(db.DateTime)
+
 # Crear tabla si no existe
 with app.app_context():
     db.create_all()
+    # create_all no agrega índices a tablas ya existentes
+    for indice in Log.__table__.indexes:
+        indice.create(db.engine, checkfirst=True)
+    # ni columnas nuevas: las de campana que falten se agregan (si otro proceso se adelantó, ya existen)
+    existentes = {columna['name'] for columna in inspect(db.engine).get_columns('campana')}
+    for columna in Campana.__table__.columns:
+        if columna.name not in existentes:
+            try:
+                with db.engine.begin() as conexion:
+                    conexion.execute(text(f"ALTER TABLE campana ADD COLUMN {columna.name} {columna.type.compile(db.engine.dialect)}"))
+            except Exception:
+                if columna.name not in {c['name'] for c in inspect(db.engine).get_columns('campana')}:
+                    raise
 #_______________________________________________________________________________________
 
 # --- Recursos ---
 IMA_SALUDO_URL = "https://res.cloudinary.com/dioy4cydg/image/upload/v1747884690/imagen_index_wjog6p.jpg"
 AGENTE_BOT = "Bot" # Usamos una constante para el agente
 
+# --- Métricas (metrics.py, expuestas en /metrics) ---
+metricas = RegistroMetricas(prefijo='whatsapp_bot_')
+tiempo_etapa = metricas.histograma(
+    'etapa_segundos', 'Tiempo por etapa del camino del mensaje (parseo_webhook, ruteo, escritura_log, descarga_media)'
+)
+tiempo_graph = metricas.histograma('graph_api_segundos', 'Tiempo de cada llamada a la API Graph por código de estado')
+mensajes_por_tipo = metricas.contador('mensajes_recibidos_total', 'Mensajes entrantes no duplicados por tipo')
+mensajes_por_estado = metricas.contador('mensajes_log_total', 'Mensajes registrados en el log por estado_usuario')
+# Conteo de recibos de entrega (sent, delivered, read, failed) reportados por Meta
+estados_entrega = metricas.contador('estados_entrega_total', 'Recibos de entrega reportados por Meta por estado')
+# Fracción de POST del webhook cuyo JSON completo se escribe en el log (en DEBUG siempre se escribe)
+LOG_PAYLOAD_MUESTREO = float(os.getenv('LOG_PAYLOAD_MUESTREO', '0'))
+
+# --- Escritor del log ---
+COLUMNAS_LOG = ('telefono_usuario_id', 'plataforma', 'mensaje', 'estado_usuario', 'etiqueta_campana', 'agente')
+
+def _escribir_lote_log(lote):
+    """Inserta un lote de registros de log en una sola transacción (lo llama el escritor único)."""
+    with app.app_context(), tiempo_etapa.medir(etapa='escritura_log'): # Necesario para interactuar con SQLAlchemy en un hilo
+        try:
+            db.session.execute(insert(Log), lote)
+            db.session.commit()
+        except Exception:
+            db.session.rollback() # Si hay un error, revertir la transacción
+            raise
+
+# Un solo hilo escribe el log por lotes (log_writer.py); se registra antes que la cola del
+# webhook para que, al apagar, primero se drene el webhook y luego se vacíe el log
+escritor_log = EscritorLog(
+    _escribir_lote_log,
+    tamano_lote=int(os.getenv('LOG_TAMANO_LOTE', '100')),
+    intervalo=float(os.getenv('LOG_INTERVALO', '0.5')),
+)
+atexit.register(escritor_log.detener)
+
+# --- Deduplicación de mensajes por id de WhatsApp ---
+DEDUP_TTL = int(os.getenv('DEDUP_TTL', '86400'))
+
+def _insert_dialecto(modelo):
+    """INSERT del dialecto de la DB, con soporte de ON CONFLICT (SQLite y PostgreSQL)."""
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as insert_dialecto
+    else:
+        from sqlalchemy.dialects.sqlite import insert as insert_dialecto
+    return insert_dialecto(modelo)
+
+def _insert_ignorando_duplicados(modelo):
+    """INSERT que ignora claves primarias repetidas."""
+    return _insert_dialecto(modelo).on_conflict_do_nothing()
+
+def _escribir_lote_ids(lote):
+    """Persiste un lote de ids de mensajes procesados."""
+    with app.app_context():
+        try:
+            db.session.execute(_insert_ignorando_duplicados(MensajeProcesado), lote)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+escritor_ids = EscritorLog(_escribir_lote_ids, tamano_lote=200, intervalo=0.2)
+atexit.register(escritor_ids.detener)
+
+deduplicador = Deduplicador(
+    ttl=DEDUP_TTL,
+    max_ids=int(os.getenv('DEDUP_MAX_IDS', '100000')),
+    persistir=lambda message_id: escritor_ids.registrar({'id': message_id, 'fecha_y_hora': datetime.utcnow()})
+)
+
+# Al arrancar: se borran ids vencidos y se cargan los recientes para no reprocesar tras un reinicio
+with app.app_context():
+    _limite_dedup = datetime.utcnow() - timedelta(seconds=DEDUP_TTL)
+    MensajeProcesado.query.filter(MensajeProcesado.fecha_y_hora < _limite_dedup).delete()
+    db.session.commit()
+    # Solo las dos columnas y los max_ids más recientes: el resto no cabría en el deduplicador
+    deduplicador.cargar(
+        (message_id, fecha_y_hora.replace(tzinfo=timezone.utc).timestamp())
+        for message_id, fecha_y_hora in db.session.execute(
+            select(MensajeProcesado.id, MensajeProcesado.fecha_y_hora)
+            .where(MensajeProcesado.fecha_y_hora >= _limite_dedup)
+            .order_by(MensajeProcesado.fecha_y_hora.desc())
+            .limit(deduplicador.max_ids)
+        )
+    )
+
+# --- Sesiones de usuario ---
+# Caché LRU con TTL (sessions.py); los cambios se guardan por lotes con un upsert (write-behind)
+def _cargar_sesion(telefono_id):
+    """Lee la sesión de la DB (solo cuando no está en caché)."""
+    with app.app_context():
+        fila = db.session.get(SesionUsuario, telefono_id)
+        if fila is None:
+            return None
+        return {'idioma': fila.idioma, 'paso': fila.paso_flujo, 'ultima_vez': fila.ultima_vez}
+
+def _escribir_lote_sesiones(lote):
+    """Guarda un lote de sesiones; si un usuario aparece varias veces se guarda su último estado."""
+    ultimas = {sesion['telefono_usuario_id']: sesion for sesion in lote}
+    filas = [
+        {
+            'telefono_usuario_id': telefono_id,
+            'idioma': sesion['idioma'],
+            'paso_flujo': sesion['paso'],
+            'ultima_vez': sesion['ultima_vez']
+        }
+        for telefono_id, sesion in ultimas.items()
+    ]
+    with app.app_context():
+        try:
+            consulta = _insert_dialecto(SesionUsuario)
+            consulta = consulta.on_conflict_do_update(
+                index_elements=['telefono_usuario_id'],
+                set_={columna: consulta.excluded[columna] for columna in ('idioma', 'paso_flujo', 'ultima_vez')}
+            )
+            db.session.execute(consulta, filas)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+escritor_sesiones = EscritorLog(_escribir_lote_sesiones, tamano_lote=200, intervalo=1.0)
+atexit.register(escritor_sesiones.detener)
+
+sesiones = AlmacenSesiones(
+    _cargar_sesion,
+    escritor_sesiones.registrar,
+    ttl=int(os.getenv('SESION_TTL', '1800')),
+    max_sesiones=int(os.getenv('SESION_MAX', '50000')),
+    idioma_por_defecto=os.getenv('IDIOMA_POR_DEFECTO', 'es'),
+)
+
+# --- Programador de envíos salientes ---
+# FIFO por destinatario, destinatarios en paralelo y límite de tasa por phone-number-id (outbound.py).
+# Se registra antes que la cola del webhook para drenarse después de ella al apagar.
+# GRAPH_TASA_MENSAJES es el nivel del número, compartido con las campañas (`flask campana enviar`,
+# otro proceso con su propia cubeta): el bot usa lo que dejan las campañas, así la suma de ambas
+# cubetas no supera el nivel. CAMPANA_FRACCION_TASA=0 (sin campañas) le deja todo el nivel al bot
+GRAPH_TASA_MENSAJES = float(os.getenv('GRAPH_TASA_MENSAJES', '80'))
+CAMPANA_TASA_MENSAJES = float(os.getenv(
+    'CAMPANA_TASA_MENSAJES', str(GRAPH_TASA_MENSAJES * float(os.getenv('CAMPANA_FRACCION_TASA', '0.25')))
+))
+TASA_MENSAJES_BOT = GRAPH_TASA_MENSAJES - CAMPANA_TASA_MENSAJES
+if TASA_MENSAJES_BOT <= 0:
+    raise ValueError(f"CAMPANA_TASA_MENSAJES ({CAMPANA_TASA_MENSAJES}) debe ser menor que GRAPH_TASA_MENSAJES ({GRAPH_TASA_MENSAJES})")
+limitador_envios = LimitadorTasa(
+    tasa=TASA_MENSAJES_BOT,
+    rafaga=float(os.getenv('GRAPH_RAFAGA_MENSAJES', str(TASA_MENSAJES_BOT))),
+)
+programador_envios = ProgramadorEnvios(
+    lambda cuerpo: send_whatsapp_message(cuerpo),
+    limitador_envios,
+    num_hilos=int(os.getenv('ENVIOS_HILOS', '8')),
+    max_pendientes=int(os.getenv('ENVIOS_MAX_PENDIENTES', '10000')),
+    espera_encolar=float(os.getenv('ENVIOS_ESPERA_ENCOLAR', '5')),
+)
+atexit.register(programador_envios.detener)
+
+# --- Cola de procesamiento del webhook ---
+# 'cola': el webhook solo valida, encola y responde 200; 'sincrono': procesa dentro de la petición
+WEBHOOK_MODO = os.getenv('WEBHOOK_MODO', 'cola')
+cola_webhook = ColaTrabajo(
+    nombre="webhook",
+    num_trabajadores=int(os.getenv('WEBHOOK_TRABAJADORES', '4')),
+    tamano_maximo=int(os.getenv('WEBHOOK_COLA_MAX', '1000')),
+)
+atexit.register(cola_webhook.detener)
+
+# --- Plantillas de mensajes salientes ---
+# Cada mensaje del bot se serializa una vez (payloads.py); al enviar solo cambia el destinatario
+cache_plantillas = CachePlantillas(image_link=IMA_SALUDO_URL)
+
+# --- Flujo de conversación ---
+# Definición declarativa en flows.json, compilada a una tabla de despacho y recargada al cambiar
+motor_flujo = MotorFlujo(
+    os.getenv('FLUJO_ARCHIVO', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flows.json')),
+    intervalo_revision=float(os.getenv('FLUJO_INTERVALO_REVISION', '5')),
+    al_cargar=lambda flujo: cache_plantillas.precargar(flujo.todas_las_respuestas()),
+)
+
+# --- Retención y resúmenes del log ---
+LOG_RETENCION_DIAS = int(os.getenv('LOG_RETENCION_DIAS', '90'))
+LOG_ARCHIVO_DIR = os.getenv('LOG_ARCHIVO_DIR') # Si está definido, los registros se archivan (JSONL gzip) antes de borrarse
+MANTENIMIENTO_LOTE = int(os.getenv('MANTENIMIENTO_LOTE', '1000'))
+MANTENIMIENTO_PAUSA = float(os.getenv('MANTENIMIENTO_PAUSA', '0.05')) # Pausa entre lotes para no acaparar la DB
+MANTENIMIENTO_BLOQUEO = float(os.getenv('MANTENIMIENTO_BLOQUEO', '900')) # Segundos que vale el bloqueo sin renovarse
+ultimo_mantenimiento = {}
+
+def _tomar_bloqueo_mantenimiento(token, liberar=False):
+    """
+    Toma o renueva el bloqueo del mantenimiento si está libre, vencido (el proceso que lo tenía
+    murió) o ya es de `token`; con `liberar` lo suelta. Retorna si el bloqueo es de `token`.
+    """
+    ahora = datetime.utcnow()
+    with app.app_context():
+        try:
+            if liberar:
+                condicion, valores = EstadoMantenimiento.valor == token, {'valor': None, 'vence': None}
+            else:
+                db.session.execute(_insert_ignorando_duplicados(EstadoMantenimiento), [{'clave': 'bloqueo'}])
+                condicion = or_(EstadoMantenimiento.valor == token, EstadoMantenimiento.valor.is_(None),
+                                EstadoMantenimiento.vence < ahora)
+                valores = {'valor': token, 'vence': ahora + timedelta(seconds=MANTENIMIENTO_BLOQUEO)}
+            # UPDATE condicional: de dos procesos que lo intentan a la vez solo uno cambia la fila
+            tomado = db.session.execute(
+                update(EstadoMantenimiento).where(EstadoMantenimiento.clave == 'bloqueo', condicion)
+                .values(**valores).execution_options(synchronize_session=False)
+            ).rowcount == 1
+            db.session.commit()
+            return tomado
+        except Exception:
+            db.session.rollback()
+            raise
+
+def resumir_dia(dia):
+    """Recalcula en una transacción los resúmenes de un día (UTC) a partir del log."""
+    inicio = datetime.combine(dia, datetime.min.time())
+    claves = [func.coalesce(getattr(Log, columna), '') for columna in ('etiqueta_campana', 'estado_usuario', 'telefono_usuario_id')]
+    agregado = (
+        select(literal(dia, db.Date), *claves, func.count(Log.id), func.min(Log.fecha_y_hora), func.max(Log.fecha_y_hora))
+        .where(Log.fecha_y_hora >= inicio, Log.fecha_y_hora < inicio + timedelta(days=1))
+        .group_by(*claves)
+    )
+    with app.app_context():
+        try:
+            db.session.execute(delete(ResumenDiario).where(ResumenDiario.dia == dia))
+            db.session.execute(insert(ResumenDiario).from_select(
+                ['dia', 'etiqueta_campana', 'estado_usuario', 'telefono_usuario_id', 'mensajes', 'primera_vez', 'ultima_vez'],
+                agregado
+            ))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+def resumir_log(al_avanzar=None):
+    """
+    Resume los días completos pendientes, uno por transacción: desde el último día resumido
+    (guardado en estado_mantenimiento; se recalcula por si llegaron registros tarde) hasta ayer.
+    Los días anteriores al primer registro crudo (sin actividad o ya purgados) no se recalculan,
+    para no reemplazar su resumen por uno vacío. Retorna el último día resumido.
+    """
+    with app.app_context():
+        guardado = db.session.get(EstadoMantenimiento, 'resumido_hasta')
+        if guardado is not None:
+            dia = datetime.fromisoformat(guardado.valor).date()
+        else:
+            dia = db.session.scalar(select(func.max(ResumenDiario.dia)))
+        primera_fecha = db.session.scalar(select(func.min(Log.fecha_y_hora)))
+    if dia is None and primera_fecha is None:
+        return None
+    ayer = datetime.utcnow().date() - timedelta(days=1)
+    # Sin registros crudos no hay nada que recalcular
+    dia = max(dia or primera_fecha.date(), primera_fecha.date()) if primera_fecha is not None else ayer + timedelta(days=1)
+    while dia <= ayer:
+        resumir_dia(dia)
+        dia += timedelta(days=1)
+        if al_avanzar:
+            al_avanzar()
+    # Se guarda al final: si el proceso muere a mitad se retoma desde el día guardado antes,
+    # cuyos registros crudos no se purgaron
+    with app.app_context():
+        try:
+            db.session.merge(EstadoMantenimiento(clave='resumido_hasta', valor=ayer.isoformat()))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    return ayer
+
+def purgar_log(corte, tamano_lote=MANTENIMIENTO_LOTE, directorio_archivo=LOG_ARCHIVO_DIR, al_avanzar=None):
+    """
+    Borra (y opcionalmente archiva) los registros anteriores a `corte` en lotes de `tamano_lote`,
+    cada uno en su propia transacción corta para no bloquear al escritor del log. Retorna las filas borradas.
+    """
+    archivo = None
+    if directorio_archivo:
+        os.makedirs(directorio_archivo, exist_ok=True)
+        archivo = gzip.open(os.path.join(directorio_archivo, f"log_hasta_{corte:%Y%m%d}.jsonl.gz"), 'at', encoding='utf-8')
+    columnas = [getattr(Log, columna) for columna in COLUMNAS_EXPORTACION]
+    borradas = 0
+    try:
+        while True:
+            with app.app_context():
+                try:
+                    filas = db.session.execute(
+                        select(*columnas).where(Log.fecha_y_hora < corte)
+                        .order_by(Log.fecha_y_hora, Log.id).limit(tamano_lote)
+                    ).all()
+                    if not filas:
+                        return borradas
+                    if archivo:
+                        # Se archiva antes de borrar: ante una falla el lote puede quedar repetido en el archivo, no perdido
+                        archivo.writelines(filas_a_jsonl(filas))
+                        archivo.flush()
+                    db.session.execute(delete(Log).where(Log.id.in_([fila[0] for fila in filas])))
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    raise
+            borradas += len(filas)
+            if al_avanzar:
+                al_avanzar()
+            time.sleep(MANTENIMIENTO_PAUSA)
+    finally:
+        if archivo:
+            archivo.close()
+
+def mantener_log(retencion_dias=LOG_RETENCION_DIAS):
+    """
+    Actualiza los resúmenes diarios, purga el log crudo vencido ya resumido y los ids de deduplicación
+    vencidos. Si otro proceso lo está ejecutando (bloqueo en estado_mantenimiento) no hace nada.
+    """
+    token = uuid.uuid4().hex
+    if not _tomar_bloqueo_mantenimiento(token):
+        logging.info("Mantenimiento del log en curso en otro proceso; se omite")
+        return {'omitido': "mantenimiento en curso en otro proceso"}
+
+    def renovar():
+        if not _tomar_bloqueo_mantenimiento(token):
+            raise RuntimeError("Se perdió el bloqueo del mantenimiento del log")
+
+    inicio = time.perf_counter()
+    try:
+        ultimo_dia = resumir_log(al_avanzar=renovar)
+        borradas = 0
+        if ultimo_dia is not None:
+            # Solo se borran días ya resumidos (el último se recalcula en la próxima ejecución y se conserva)
+            corte = min(datetime.utcnow() - timedelta(days=retencion_dias), datetime.combine(ultimo_dia, datetime.min.time()))
+            borradas = purgar_log(corte, al_avanzar=renovar)
+        with app.app_context():
+            ids_vencidos = MensajeProcesado.query.filter(
+                MensajeProcesado.fecha_y_hora < datetime.utcnow() - timedelta(seconds=DEDUP_TTL)
+            ).delete()
+            db.session.commit()
+    finally:
+        _tomar_bloqueo_mantenimiento(token, liberar=True)
+    ultimo_mantenimiento.update({
+        'fecha': datetime.utcnow().isoformat(),
+        'ultimo_dia_resumido': ultimo_dia.isoformat() if ultimo_dia else None,
+        'registros_borrados': borradas,
+        'ids_dedup_borrados': ids_vencidos,
+        'segundos': round(time.perf_counter() - inicio, 3),
+    })
+    logging.info("Mantenimiento del log: %s", ultimo_mantenimiento)
+    return dict(ultimo_mantenimiento)
+
+# En el proceso que atiende el webhook, desde iniciar_tareas_servidor (0 = desactivado; en ese caso
+# usar `flask mantener-log` desde un cron). Con varios procesos, el bloqueo deja correr uno a la vez
+MANTENIMIENTO_INTERVALO = float(os.getenv('MANTENIMIENTO_INTERVALO', '0'))
+tarea_mantenimiento = TareaPeriodica("mantenimiento-log", mantener_log, MANTENIMIENTO_INTERVALO)
+atexit.register(tarea_mantenimiento.detener)
+
+@app.cli.command('mantener-log')
+@click.option('--retencion-dias', type=int, default=LOG_RETENCION_DIAS, help="Días de log crudo a conservar")
+def mantener_log_cli(retencion_dias):
+    """Actualiza los resúmenes diarios y archiva/borra el log crudo vencido."""
+    click.echo(json.dumps(mantener_log(retencion_dias)))
+
 #_______________________________________________________________________________________
 # --- Funciones de la Aplicación Flask ---
+LOG_LIMITE_PAGINA = 50
+LOG_LIMITE_MAXIMO = 500
+FILTROS_LOG = ('telefono_usuario_id', 'estado_usuario', 'etiqueta_campana', 'desde', 'hasta')
+
+def _leer_fecha(valor, fin_del_dia=False):
+    """Convierte 'AAAA-MM-DD' o ISO 8601 en datetime; las fechas sin hora en 'hasta' incluyen todo el día."""
+    fecha = datetime.fromisoformat(valor)
+    if fin_del_dia and len(valor) == 10:
+        fecha += timedelta(days=1)
+    return fecha
+
+def _filtrar_log(consulta, filtros):
+    """Aplica los filtros del dashboard (FILTROS_LOG) a una consulta del log."""
+    for columna in ('telefono_usuario_id', 'estado_usuario', 'etiqueta_campana'):
+        if columna in filtros:
+            consulta = consulta.filter(getattr(Log, columna) == filtros[columna])
+    if 'desde' in filtros:
+        consulta = consulta.filter(Log.fecha_y_hora >= _leer_fecha(filtros['desde']))
+    if 'hasta' in filtros:
+        consulta = consulta.filter(Log.fecha_y_hora < _leer_fecha(filtros['hasta'], fin_del_dia=True))
+    return consulta
+
+def _leer_cursor(cursor):
+    """Convierte un cursor 'fecha_iso|id' en (datetime, id); ValueError si no es válido."""
+    fecha_cursor, id_cursor = cursor.rsplit('|', 1)
+    return datetime.fromisoformat(fecha_cursor), int(id_cursor)
+
+def consultar_log(args):
+    """
+    Consulta el log en la DB, ordenado del más reciente al más antiguo, con paginación por cursor.
+    El cursor es 'fecha_iso|id' del último registro de la página anterior.
+    Retorna (registros, siguiente_cursor, filtros).
+    """
+    filtros = {clave: args.get(clave) for clave in FILTROS_LOG if args.get(clave)}
+    limite = args.get('limite', LOG_LIMITE_PAGINA, type=int)
+    if limite < 1:
+        raise ValueError(f"limite debe ser positivo: {limite}")
+    limite = max(1, min(limite, LOG_LIMITE_MAXIMO))
+
+    consulta = _filtrar_log(Log.query, filtros)
+
+    cursor = args.get('cursor')
+    if cursor:
+        fecha_cursor, id_cursor = _leer_cursor(cursor)
+        consulta = consulta.filter(or_(
+            Log.fecha_y_hora < fecha_cursor,
+            and_(Log.fecha_y_hora == fecha_cursor, Log.id < id_cursor)
+        ))
+
+    # Se pide un registro extra para saber si hay página siguiente
+    registros = consulta.order_by(Log.fecha_y_hora.desc(), Log.id.desc()).limit(limite + 1).all()
+    siguiente_cursor = None
+    if len(registros) > limite:
+        registros = registros[:limite]
+        ultimo = registros[-1]
+        siguiente_cursor = f"{ultimo.fecha_y_hora.isoformat()}|{ultimo.id}"
+    return registros, siguiente_cursor, filtros
+
+RESUMEN_DIAS_PANEL = 14
+
+def resumen_panel(filtros):
+    """Estadísticas del dashboard desde la tabla de resúmenes (no recorre el log crudo)."""
+    condiciones = [
+        getattr(ResumenDiario, columna) == filtros[columna]
+        for columna in ('telefono_usuario_id', 'estado_usuario', 'etiqueta_campana') if columna in filtros
+    ]
+    if 'desde' in filtros:
+        condiciones.append(ResumenDiario.dia >= _leer_fecha(filtros['desde']).date())
+    if 'hasta' in filtros:
+        condiciones.append(ResumenDiario.dia <= _leer_fecha(filtros['hasta']).date())
+    por_campana = db.session.execute(
+        select(ResumenDiario.etiqueta_campana, ResumenDiario.estado_usuario, func.sum(ResumenDiario.mensajes),
+               func.count(func.distinct(ResumenDiario.telefono_usuario_id)),
+               func.min(ResumenDiario.primera_vez), func.max(ResumenDiario.ultima_vez))
+        .where(*condiciones)
+        .group_by(ResumenDiario.etiqueta_campana, ResumenDiario.estado_usuario)
+        .order_by(ResumenDiario.etiqueta_campana, ResumenDiario.estado_usuario)
+    ).all()
+    por_dia = db.session.execute(
+        select(ResumenDiario.dia, func.sum(ResumenDiario.mensajes), func.count(func.distinct(ResumenDiario.telefono_usuario_id)))
+        .where(*condiciones)
+        .group_by(ResumenDiario.dia).order_by(ResumenDiario.dia.desc()).limit(RESUMEN_DIAS_PANEL)
+    ).all()
+    return {'por_campana': por_campana, 'por_dia': por_dia}
+
+def _log_a_dict(registro):
+    return {
+        'id': registro.id,
+        'fecha_y_hora': registro.fecha_y_hora.isoformat() if registro.fecha_y_hora else None,
+        'telefono_usuario_id': registro.telefono_usuario_id,
+        'plataforma': registro.plataforma,
+        'mensaje': registro.mensaje,
+        'estado_usuario': registro.estado_usuario,
+        'etiqueta_campana': registro.etiqueta_campana,
+        'agente': registro.agente
+    }
+
 @app.route('/')
 def index():
-    """Renderiza la página principal con los registros del log."""
-    registros = Log.query.all()
-    registros_ordenados = sorted(registros, key=lambda x: x.fecha_y_hora, reverse=True)
-    return render_template('index.html', registros=registros_ordenados)
+    """Renderiza la página principal con una página de registros del log."""
+    try:
+        registros, siguiente_cursor, filtros = consultar_log(request.args)
+        resumen = resumen_panel(filtros)
+    except ValueError:
+        return jsonify({'error': 'Parámetros de consulta inválidos'}), 400
+    siguiente_url = url_for('index', cursor=siguiente_cursor, **filtros) if siguiente_cursor else None
+    return render_template('index.html', registros=registros, filtros=filtros, siguiente_url=siguiente_url, resumen=resumen)
+
+@app.route('/api/log')
+def api_log():
+    """Misma consulta del dashboard en formato JSON."""
+    try:
+        registros, siguiente_cursor, filtros = consultar_log(request.args)
+    except ValueError:
+        return jsonify({'error': 'Parámetros de consulta inválidos'}), 400
+    return jsonify({
+        'registros': [_log_a_dict(registro) for registro in registros],
+        'siguiente_cursor': siguiente_cursor,
+        'filtros': filtros
+    })
+
+# --- Exportación masiva del log ---
+EXPORTAR_FILAS_POR_LOTE = int(os.getenv('EXPORTAR_FILAS_POR_LOTE', '1000'))
+# Margen para que los registros de todos los procesos estén confirmados (ver exportar.py)
+EXPORTAR_RETRASO = int(os.getenv('EXPORTAR_RETRASO', '120'))
+
+def iterar_log_exportacion(filtros, desde_id=0, despues_de=None, hasta_fecha=None):
+    """
+    Recorre el log en orden (fecha_y_hora, id) con un cursor del lado del servidor (memoria
+    constante). Para exportaciones incrementales `despues_de` es el (fecha, id) de la última
+    fila exportada y `hasta_fecha` excluye los registros recientes que otro proceso podría
+    estar por confirmar (con ids menores a los ya visibles).
+    """
+    consulta = _filtrar_log(select(*(getattr(Log, columna) for columna in COLUMNAS_EXPORTACION)), filtros)
+    if desde_id:
+        consulta = consulta.filter(Log.id > desde_id)
+    if despues_de:
+        fecha_cursor, id_cursor = despues_de
+        consulta = consulta.filter(or_(
+            Log.fecha_y_hora > fecha_cursor,
+            and_(Log.fecha_y_hora == fecha_cursor, Log.id > id_cursor)
+        ))
+    if hasta_fecha:
+        consulta = consulta.filter(Log.fecha_y_hora < hasta_fecha)
+    consulta = consulta.order_by(Log.fecha_y_hora, Log.id).execution_options(yield_per=EXPORTAR_FILAS_POR_LOTE)
+    for fila in db.session.execute(consulta):
+        yield tuple(fila)
+
+@app.route('/api/log/exportar')
+def exportar_log():
+    """
+    Descarga el log filtrado en CSV o JSONL (formato=csv|jsonl) sin cargarlo en memoria.
+    Incremental: incremental=1 y cursor='fecha_iso|id' de la última fila ya recibida.
+    """
+    formato = request.args.get('formato', 'csv')
+    if formato not in FORMATOS:
+        return jsonify({'error': f"Formato no soportado: {formato}"}), 400
+    filtros = {clave: request.args.get(clave) for clave in FILTROS_LOG if request.args.get(clave)}
+    try:
+        desde_id = request.args.get('desde_id', 0, type=int)
+        despues_de = _leer_cursor(request.args['cursor']) if request.args.get('cursor') else None
+        hasta_fecha = datetime.utcnow() - timedelta(seconds=EXPORTAR_RETRASO) if request.args.get('incremental') else None
+        # Se validan las fechas antes de empezar a responder (luego ya no se puede retornar 400)
+        for clave in ('desde', 'hasta'):
+            if clave in filtros:
+                _leer_fecha(filtros[clave])
+    except ValueError:
+        return jsonify({'error': 'Parámetros de consulta inválidos'}), 400
+    generar, tipo_mime = FORMATOS[formato]
+    return Response(
+        stream_with_context(generar(iterar_log_exportacion(filtros, desde_id, despues_de, hasta_fecha))),
+        mimetype=tipo_mime,
+        headers={'Content-Disposition': f'attachment; filename=log.{formato}'}
+    )
+
+def _punto_control_exportacion(texto):
+    """(fecha, id) del punto de control; acepta el formato anterior (solo el último id)."""
+    if not texto:
+        return None
+    if texto.isdigit():
+        fecha = db.session.scalar(select(Log.fecha_y_hora).where(Log.id <= int(texto)).order_by(Log.id.desc()).limit(1))
+        return (fecha or datetime.min), int(texto)
+    return _leer_cursor(texto)
+
+@app.cli.command('exportar-log')
+@click.option('--formato', type=click.Choice(sorted(FORMATOS)), default='csv')
+@click.option('--salida', type=click.File('w', encoding='utf-8'), default='-', help="Archivo de salida (- para stdout)")
+@click.option('--desde', help="Fecha inicial AAAA-MM-DD")
+@click.option('--hasta', help="Fecha final AAAA-MM-DD (incluida)")
+@click.option('--etiqueta-campana')
+@click.option('--estado-usuario')
+@click.option('--desde-id', type=int, default=0, help="Exportar solo ids mayores a este")
+@click.option('--punto-control', type=click.Path(dir_okay=False),
+              help="Archivo con la última fila exportada (fecha|id); se lee al iniciar y se actualiza al terminar")
+@click.option('--sheets', is_flag=True, help="Subir las filas a Google Sheets en lugar de escribir un archivo")
+def exportar_log_cli(formato, salida, desde, hasta, etiqueta_campana, estado_usuario, desde_id, punto_control, sheets):
+    """Exporta el log a CSV/JSONL o a Google Sheets; con --punto-control es incremental."""
+    filtros = {clave: valor for clave, valor in (
+        ('desde', desde), ('hasta', hasta), ('etiqueta_campana', etiqueta_campana), ('estado_usuario', estado_usuario)
+    ) if valor}
+    despues_de = hasta_fecha = None
+    if punto_control:
+        despues_de = _punto_control_exportacion(leer_punto_control(punto_control))
+        hasta_fecha = datetime.utcnow() - timedelta(seconds=EXPORTAR_RETRASO)
+    filas = iterar_log_exportacion(filtros, desde_id, despues_de, hasta_fecha)
+
+    if sheets:
+        cliente = GraphClient(base_url=os.getenv('SHEETS_API_URL', 'https://sheets.googleapis.com'), tamano_pool=1)
+        subidor = SubidorSheets(
+            cliente, os.environ['SHEETS_SPREADSHEET_ID'], os.getenv('SHEETS_RANGO', 'Log!A1'), token_sheets(),
+            tamano_lote=int(os.getenv('SHEETS_FILAS_POR_LOTE', '500')),
+        )
+        # El punto de control avanza por cada lote aceptado: si falla a mitad no se duplican filas
+        al_confirmar = (lambda fila: guardar_punto_control(punto_control, cursor_de_fila(fila))) if punto_control else None
+        subidor.subir(filas, al_confirmar)
+        cliente.cerrar()
+        click.echo(f"{subidor.filas_subidas} filas subidas a Sheets en {subidor.lotes} lotes", err=True)
+        return
+
+    ultima, total = None, 0
+    def contar(filas):
+        nonlocal ultima, total
+        for fila in filas:
+            ultima, total = fila, total + 1
+            yield fila
+    generar, _ = FORMATOS[formato]
+    for bloque in generar(contar(filas)):
+        salida.write(bloque)
+    salida.flush()
+    if punto_control and ultima is not None:
+        guardar_punto_control(punto_control, cursor_de_fila(ultima))
+    click.echo(f"{total} filas exportadas (última {cursor_de_fila(ultima) if ultima else '-'})", err=True)
+
+@app.route('/estado')
+def estado():
+    """Retorna las métricas de la cola del webhook, el cliente Graph y el escritor de log."""
+    return jsonify({
+        'modo': WEBHOOK_MODO,
+        'cola_webhook': cola_webhook.estadisticas(),
+        'graph_client': graph_client.estadisticas(),
+        'escritor_log': escritor_log.estadisticas(),
+        'deduplicador': deduplicador.estadisticas(),
+        'estados_entrega': estados_entrega.valores(),
+        'webhooks_rechazados': webhooks_rechazados.valores(),
+        'flujo': {'recargas': motor_flujo.recargas},
+        'sesiones': sesiones.estadisticas(),
+        'plantillas': cache_plantillas.estadisticas(),
+        'envios': programador_envios.estadisticas(),
+        'mantenimiento': ultimo_mantenimiento,
+        'media': {
+            'salientes': cache_media.estadisticas(),
+            'entrantes': descargador_media.estadisticas(),
+            'cola': cola_media.estadisticas()
+        }
+    })
+
+@app.route('/metrics')
+def metrics():
+    """Métricas en formato de texto de Prometheus."""
+    return metricas.exportar(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# Profundidad de las colas, leída al momento de exportar
+metricas.medidor('cola_webhook_profundidad', 'Lotes de usuario en la cola del webhook',
+                 lambda: cola_webhook.estadisticas()['profundidad'])
+metricas.medidor('envios_pendientes', 'Mensajes en el programador de envíos', lambda: programador_envios.total_pendientes)
+metricas.medidor('log_pendientes', 'Registros de log esperando escritura', lambda: escritor_log.estadisticas()['pendientes'])
+
+def registrar_log(datos):
+    """Encola un registro de mensaje (dict) para el escritor de log."""
+    registro = {columna: datos.get(columna) for columna in COLUMNAS_LOG}
+    mensajes_por_estado.inc(estado=registro['estado_usuario'])
+    # La fecha se toma al ocurrir el evento, no al escribir el lote
+    registro['fecha_y_hora'] = datetime.utcnow()
+    return escritor_log.registrar(registro)
 
 def agregar_mensajes_log(datos_json):
     """Agrega un registro de mensaje a la base de datos."""
-    datos = json.loads(datos_json)
-    nuevo_registro = Log(
-        telefono_usuario_id=datos.get('telefono_usuario_id'),
-        plataforma=datos.get('plataforma'),
-        mensaje=datos.get('mensaje'),
-        estado_usuario=datos.get('estado_usuario'),
-        etiqueta_campana=datos.get('etiqueta_campana'),
-        agente=datos.get('agente')
-    )
-    db.session.add(nuevo_registro)
-    db.session.commit()
+    registrar_log(json.loads(datos_json))
 
 
 def _agregar_mensajes_log_thread_safe(log_data_json):
     """Función para agregar un registro a la base de datos en un hilo."""
-    with app.app_context(): # Necesario para interactuar con SQLAlchemy en un hilo
-        try:
-            datos = json.loads(log_data_json)
-            nuevo_registro = Log(
-                telefono_usuario_id=datos.get('telefono_usuario_id'),
-                plataforma=datos.get('plataforma'),
-                mensaje=datos.get('mensaje'),
-                estado_usuario=datos.get('estado_usuario'),
-                etiqueta_campana=datos.get('etiqueta_campana'),
-                agente=datos.get('agente')
-            )
-            db.session.add(nuevo_registro)
-            db.session.commit()
-            logging.info(f"Registro de log añadido a DB (hilo): {datos.get('mensaje')}")
-        except Exception as e:
-            db.session.rollback() # Si hay un error, revertir la transacción
-            logging.error(f"Error añadiendo log a DB (hilo): {e}")
+    registrar_log(json.loads(log_data_json))
 
 
 # --- API WhatsApp para el envío de mensajes ---
-def send_whatsapp_message(data):
-    """Envía un mensaje a través de la API de WhatsApp Business."""
-    data = json.dumps(data)
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {os.environ['META_WHATSAPP_ACCESS_TOKEN']}"
-    }
+# Cliente con pool de conexiones keep-alive hacia graph.facebook.com (graph_client.py)
+graph_client = GraphClient(
+    base_url=os.getenv('GRAPH_API_URL', 'https://graph.facebook.com'),
+    tamano_pool=int(os.getenv('GRAPH_POOL_SIZE', '10')),
+    timeout=float(os.getenv('GRAPH_TIMEOUT', '10')),
+    max_reintentos=int(os.getenv('GRAPH_MAX_REINTENTOS', '3')),
+)
 
-    connection = http.client.HTTPSConnection("graph.facebook.com")
+def ruta_mensajes():
+    """Ruta del endpoint /messages del número de WhatsApp configurado."""
+    return f"/{os.environ['API_WHATSAPP_VERSION']}/{os.environ['META_WHATSAPP_PHONE_NUMBER_ID']}/messages"
+
+def enviar_a_graph(data):
+    """POST instrumentado a /messages que retorna la RespuestaGraph y propaga los errores de red."""
+    if not isinstance(data, bytes):
+        data = json.dumps(data)
+    inicio = time.perf_counter()
+    try:
+        response = graph_client.post_json(ruta_mensajes(), data, os.environ['META_WHATSAPP_ACCESS_TOKEN'])
+    except Exception:
+        tiempo_graph.observar(time.perf_counter() - inicio, status='error')
+        raise
+    tiempo_graph.observar(time.perf_counter() - inicio, status=response.status)
+    logging.info("Respuesta de WhatsApp API: %s %s", response.status, response.reason)
+    return response
+
+def send_whatsapp_message(data):
+    """
+    Envía un mensaje (dict o cuerpo JSON ya serializado en bytes) a través de la API de WhatsApp Business.
+    Retorna la RespuestaGraph, o None si hubo un error de red.
+    """
     try:
-        connection.request("POST", f"/{os.environ['API_WHATSAPP_VERSION']}/{os.environ['META_WHATSAPP_PHONE_NUMBER_ID']}/messages", data, headers)
-        response = connection.getresponse()
-        logging.info(f"Respuesta de WhatsApp API: {response.status} {response.reason}")
+        return enviar_a_graph(data)
     except Exception as e:
         logging.error(f"Error al enviar mensaje a WhatsApp: {e}")
         # No se registra aquí en la DB para evitar redundancia, se registra antes de llamar a esta función
+        return None
+
+# --- Archivos multimedia (media.py) ---
+# Recursos que se suben una vez a /media y se envían por id (mientras no haya id se envía el link)
+RECURSOS_MEDIA = [IMA_SALUDO_URL]
+
+def ruta_media():
+    """Ruta del endpoint /media del número de WhatsApp configurado."""
+    return f"/{os.environ['API_WHATSAPP_VERSION']}/{os.environ['META_WHATSAPP_PHONE_NUMBER_ID']}/media"
+
+def _al_subir_media(origen, media_id):
+    """Las plantillas de imagen pasan a usar el media id nuevo."""
+    if origen == IMA_SALUDO_URL:
+        cache_plantillas.usar_imagen_id(media_id)
+        cache_plantillas.precargar(motor_flujo.flujo.todas_las_respuestas())
+
+def _leer_media(origen):
+    with app.app_context():
+        fila = db.session.get(MediaSubido, origen)
+        return (fila.media_id, fila.vence.replace(tzinfo=timezone.utc).timestamp()) if fila else None
+
+def _guardar_media(origen, media_id, vence):
+    with app.app_context():
+        try:
+            db.session.merge(MediaSubido(origen=origen, media_id=media_id, vence=datetime.utcfromtimestamp(vence)))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+cache_media = CacheMedia(
+    lambda origen: subir_media(graph_client, ruta_media(), os.environ['META_WHATSAPP_ACCESS_TOKEN'], origen),
+    al_actualizar=_al_subir_media,
+    leer=_leer_media,
+    guardar=_guardar_media,
+)
+# Se revisa cada MEDIA_INTERVALO_REVISION segundos si hay que renovar (MEDIA_SUBIR=0: siempre por link)
+tarea_media = TareaPeriodica(
+    "media", lambda: cache_media.refrescar(RECURSOS_MEDIA),
+    float(os.getenv('MEDIA_INTERVALO_REVISION', '3600')), inmediata=True
+)
+atexit.register(tarea_media.detener)
+
+def iniciar_tareas_servidor():
+    """
+    Arranca las tareas de fondo del proceso que atiende el webhook (primera petición en Flask,
+    lifespan en ASGI); al importar app.py desde la CLI o los benchmarks no se sube nada.
+    """
+    if os.getenv('MEDIA_SUBIR', '1') == '1':
+        tarea_media.iniciar()
+    if MANTENIMIENTO_INTERVALO > 0:
+        tarea_mantenimiento.iniciar()
+
+app.before_request(iniciar_tareas_servidor)
+
+def _url_descarga_media(media_id):
+    """Consulta a la API Graph la URL temporal de descarga de un archivo recibido."""
+    headers = {"Authorization": f"Bearer {os.environ['META_WHATSAPP_ACCESS_TOKEN']}"}
+    respuesta = graph_client.request("GET", f"/{os.environ['API_WHATSAPP_VERSION']}/{quote(media_id, safe='')}", headers=headers)
+    if not respuesta.ok:
+        raise RuntimeError(f"No se pudo consultar el archivo {media_id}: {respuesta.status}")
+    return json.loads(respuesta.body)['url'], headers
+
+descargador_media = DescargadorMedia(
+    _url_descarga_media,
+    os.getenv('MEDIA_DIRECTORIO', os.path.join(app.instance_path, 'media')),
+    max_bytes=int(os.getenv('MEDIA_MAX_BYTES', str(100 * 1024 * 1024))),
+)
+# Las descargas van en su propia cola para no demorar las respuestas del flujo
+cola_media = ColaTrabajo(
+    nombre="media",
+    num_trabajadores=int(os.getenv('MEDIA_TRABAJADORES', '2')),
+    tamano_maximo=int(os.getenv('MEDIA_COLA_MAX', '200')),
+)
+atexit.register(cola_media.detener)
+
+def procesar_media_entrante(telefono_id, tipo, media):
+    """Descarga un archivo recibido y lo registra en el log con su ruta en disco."""
+    with tiempo_etapa.medir(etapa='descarga_media'):
+        try:
+            mensaje = f"[{tipo}] {descargador_media.descargar(media)}"
+        except Exception as e:
+            logging.error(f"Error descargando {tipo} {media.get('id')} de {telefono_id}: {e}")
+            mensaje = f"[{tipo}] descarga fallida {media.get('id')}"
+    if media.get('caption'):
+        mensaje += f" {media['caption']}"
+    registrar_log({
+        'telefono_usuario_id': telefono_id,
+        'plataforma': 'whatsapp 📞📱💬',
+        'mensaje': mensaje,
+        'estado_usuario': 'recibido',
+        'etiqueta_campana': motor_flujo.flujo.etiqueta_campana,
+        'agente': AGENTE_BOT
+    })
+
+# --- Campañas de envío masivo (campaigns.py) ---
+CAMPANA_LOTE = int(os.getenv('CAMPANA_LOTE', '500'))
+CAMPANA_HILOS = int(os.getenv('CAMPANA_HILOS', '16'))
+CAMPANA_BLOQUEO = float(os.getenv('CAMPANA_BLOQUEO', '300')) # Segundos que vale el bloqueo de un envío sin renovarse
+# La campaña corre en su propio proceso y no comparte la cubeta del bot: usa CAMPANA_TASA_MENSAJES
+# (por defecto CAMPANA_FRACCION_TASA del nivel), que ya se descuenta de la cubeta del bot
+limitador_campanas = LimitadorTasa(
+    tasa=CAMPANA_TASA_MENSAJES,
+    rafaga=float(os.getenv('CAMPANA_RAFAGA_MENSAJES', str(CAMPANA_TASA_MENSAJES))),
+)
+
+def agregar_destinatarios(nombre, telefonos, tamano_lote=1000):
+    """Agrega destinatarios 'pendiente' por lotes; los repetidos se ignoran. Retorna cuántos se leyeron."""
+    leidos = 0
+    lote = []
+    def escribir(lote):
+        with app.app_context():
+            try:
+                db.session.execute(_insert_ignorando_duplicados(EnvioCampana), lote)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+    for telefono in telefonos:
+        lote.append({'campana': nombre, 'telefono_usuario_id': telefono, 'estado': PENDIENTE})
+        leidos += 1
+        if len(lote) >= tamano_lote:
+            escribir(lote)
+            lote = []
+    if lote:
+        escribir(lote)
+    return leidos
+
+def _pendientes_campana(nombre, despues_de, limite):
+    with app.app_context():
+        return list(db.session.scalars(
+            select(EnvioCampana.telefono_usuario_id)
+            .where(EnvioCampana.campana == nombre, EnvioCampana.estado == PENDIENTE,
+                   EnvioCampana.telefono_usuario_id > despues_de)
+            .order_by(EnvioCampana.telefono_usuario_id).limit(limite)
+        ))
+
+def _marcar_envios(nombre, mensaje, cambios):
+    """Guarda el estado de un lote de destinatarios en una transacción y registra los enviados en el log."""
+    ahora = datetime.utcnow()
+    with app.app_context():
+        try:
+            db.session.execute(update(EnvioCampana), [dict(cambio, campana=nombre, actualizado=ahora) for cambio in cambios])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    for cambio in cambios:
+        if cambio['estado'] == ENVIADO:
+            registrar_log({
+                'telefono_usuario_id': cambio['telefono_usuario_id'],
+                'plataforma': 'whatsapp 📞📱💬',
+                'mensaje': mensaje,
+                'estado_usuario': 'enviado',
+                'etiqueta_campana': nombre,
+                'agente': AGENTE_BOT
+            })
+
+def _actualizar_campana(nombre, estado):
+    with app.app_context():
+        db.session.execute(update(Campana).where(Campana.nombre == nombre).values(estado=estado, actualizada=datetime.utcnow()))
+        db.session.commit()
+
+def _tomar_campana(nombre, token):
+    """
+    Toma o renueva el bloqueo de envío de la campaña si está libre, vencido (el proceso que la
+    enviaba murió) o ya es de `token`. Retorna si el bloqueo es de `token`.
+    """
+    ahora = datetime.utcnow()
+    with app.app_context():
+        # UPDATE condicional: de dos procesos que lo intentan a la vez solo uno cambia la fila
+        tomada = db.session.execute(
+            update(Campana)
+            .where(Campana.nombre == nombre,
+                   or_(Campana.ejecutor.is_(None), Campana.ejecutor == token, Campana.ejecutor_vence < ahora))
+            .values(ejecutor=token, ejecutor_vence=ahora + timedelta(seconds=CAMPANA_BLOQUEO))
+            .execution_options(synchronize_session=False)
+        ).rowcount == 1
+        db.session.commit()
+    return tomada
+
+def _liberar_campana(nombre, token, estado):
+    """Deja la campaña en `estado` y suelta el bloqueo, solo si sigue siendo de `token`."""
+    with app.app_context():
+        db.session.execute(
+            update(Campana).where(Campana.nombre == nombre, Campana.ejecutor == token)
+            .values(estado=estado, ejecutor=None, ejecutor_vence=None, actualizada=datetime.utcnow())
+        )
+        db.session.commit()
+
+def _reclamar_envios(nombre, token, telefonos):
+    """
+    Renueva el bloqueo de la campaña y pasa a 'enviando', en una transacción, los destinatarios de
+    `telefonos` que siguen 'pendiente'. Retorna los reclamados: solo esos se envían.
+    """
+    if not _tomar_campana(nombre, token):
+        raise RuntimeError(f"Se perdió el bloqueo de la campaña {nombre}")
+    ahora = datetime.utcnow()
+    reclamo = (
+        update(EnvioCampana)
+        .where(EnvioCampana.campana == nombre, EnvioCampana.telefono_usuario_id.in_(telefonos),
+               EnvioCampana.estado == PENDIENTE)
+        .values(estado=ENVIANDO, wamid=None, error=None, actualizado=ahora)
+        .execution_options(synchronize_session=False)
+    )
+    with app.app_context():
+        try:
+            if db.engine.dialect.update_returning:
+                reclamados = set(db.session.scalars(reclamo.returning(EnvioCampana.telefono_usuario_id)))
+            else:
+                # Sin RETURNING se releen en la misma transacción, que tiene bloqueadas las filas actualizadas
+                db.session.execute(reclamo)
+                reclamados = set(db.session.scalars(
+                    select(EnvioCampana.telefono_usuario_id)
+                    .where(EnvioCampana.campana == nombre, EnvioCampana.telefono_usuario_id.in_(telefonos),
+                           EnvioCampana.estado == ENVIANDO, EnvioCampana.actualizado == ahora)
+                ))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    return [telefono for telefono in telefonos if telefono in reclamados]
+
+def resumen_campana(nombre):
+    """Estado de la campaña y conteo de destinatarios por estado, o None si no existe."""
+    with app.app_context():
+        campana = db.session.get(Campana, nombre)
+        if campana is None:
+            return None
+        conteos = dict(db.session.execute(
+            select(EnvioCampana.estado, func.count()).where(EnvioCampana.campana == nombre).group_by(EnvioCampana.estado)
+        ).all())
+        return {
+            'nombre': campana.nombre,
+            'estado': campana.estado,
+            'tipo': campana.tipo,
+            'destinatarios': sum(conteos.values()),
+            **{estado: conteos.get(estado, 0) for estado in (PENDIENTE, ENVIANDO, ENVIADO, FALLIDO)},
+        }
+
+def ejecutar_campana(nombre, num_hilos=CAMPANA_HILOS, tamano_lote=CAMPANA_LOTE):
+    """Envía la campaña a sus destinatarios pendientes; se puede volver a llamar para reanudarla."""
+    if CAMPANA_TASA_MENSAJES <= 0:
+        raise ValueError("Las campañas no tienen tasa asignada (CAMPANA_FRACCION_TASA o CAMPANA_TASA_MENSAJES en 0)")
+    with app.app_context():
+        campana = db.session.get(Campana, nombre)
+        if campana is None:
+            raise ValueError(f"No existe la campaña {nombre}")
+        tipo, mensaje = campana.tipo, campana.mensaje
+        botones = json.loads(campana.botones) if campana.botones else []
+    plantilla = cache_plantillas.obtener(mensaje, tipo, [titulo for titulo, _ in botones] or None,
+                                         [boton_id for _, boton_id in botones] or None)
+    if plantilla is None:
+        raise ValueError(f"Tipo de mensaje no soportado o parámetros incompletos: {tipo}")
+
+    # Una sola ejecución por campaña a la vez; el bloqueo se renueva en cada tramo
+    token = uuid.uuid4().hex
+    if not _tomar_campana(nombre, token):
+        raise RuntimeError(f"La campaña {nombre} ya se está enviando en otro proceso (si murió, "
+                           f"se puede reanudar cuando venza su bloqueo, a lo sumo en {CAMPANA_BLOQUEO:.0f}s)")
+    ejecutor = EjecutorCampana(
+        lambda despues_de, limite: _pendientes_campana(nombre, despues_de, limite),
+        lambda telefonos: _reclamar_envios(nombre, token, telefonos),
+        lambda cambios: _marcar_envios(nombre, mensaje, cambios),
+        lambda telefono: enviar_a_graph(plantilla.para(telefono)),
+        limitador_campanas,
+        os.environ['META_WHATSAPP_PHONE_NUMBER_ID'],
+        num_hilos=num_hilos,
+        tamano_lote=tamano_lote,
+    )
+    _actualizar_campana(nombre, 'en_curso')
+    try:
+        estadisticas = ejecutor.ejecutar()
     finally:
-        connection.close()
+        resumen = resumen_campana(nombre)
+        # 'incompleta': no quedan pendientes pero hay envíos inciertos ('enviando') por revisar
+        if resumen[PENDIENTE]:
+            _liberar_campana(nombre, token, 'pausada')
+        else:
+            _liberar_campana(nombre, token, 'incompleta' if resumen[ENVIANDO] else 'terminada')
+    return estadisticas
+
+def _leer_telefonos(archivo):
+    """Teléfonos de la primera columna de un CSV (o uno por línea), leídos en streaming; se omite el encabezado."""
+    for fila in csv.reader(archivo):
+        if fila and fila[0].strip().lstrip('+').isdigit():
+            yield fila[0].strip().lstrip('+')
+
+@app.cli.group('campana')
+def campana_cli():
+    """Campañas de envío masivo."""
+
+@campana_cli.command('crear')
+@click.argument('nombre')
+@click.option('--mensaje', required=True, help="Texto (o descripción de la imagen)")
+@click.option('--tipo', type=click.Choice(['text', 'image', 'button']), default='text')
+@click.option('--boton', 'botones', multiple=True, help="Botón 'Título:id' (tipo button, hasta 3)")
+@click.option('--destinatarios', type=click.File('r', encoding='utf-8'), help="CSV con los teléfonos en la primera columna")
+def crear_campana_cli(nombre, mensaje, tipo, botones, destinatarios):
+    """Crea una campaña y opcionalmente carga sus destinatarios."""
+    botones = [boton.rsplit(':', 1) for boton in botones]
+    with app.app_context():
+        db.session.add(Campana(nombre=nombre, tipo=tipo, mensaje=mensaje, botones=json.dumps(botones) if botones else None))
+        db.session.commit()
+    if destinatarios:
+        click.echo(f"{agregar_destinatarios(nombre, _leer_telefonos(destinatarios))} destinatarios leídos", err=True)
+
+@campana_cli.command('agregar')
+@click.argument('nombre')
+@click.argument('destinatarios', type=click.File('r', encoding='utf-8'))
+def agregar_destinatarios_cli(nombre, destinatarios):
+    """Agrega destinatarios (CSV) a una campaña existente; los repetidos se ignoran."""
+    click.echo(f"{agregar_destinatarios(nombre, _leer_telefonos(destinatarios))} destinatarios leídos", err=True)
+
+@campana_cli.command('enviar')
+@click.argument('nombre')
+@click.option('--hilos', type=int, default=CAMPANA_HILOS)
+@click.option('--lote', type=int, default=CAMPANA_LOTE)
+def enviar_campana_cli(nombre, hilos, lote):
+    """Envía (o reanuda) la campaña a los destinatarios pendientes."""
+    click.echo(json.dumps(ejecutar_campana(nombre, hilos, lote)))
+    click.echo(json.dumps(resumen_campana(nombre)))
+
+@campana_cli.command('estado')
+@click.argument('nombre')
+def estado_campana_cli(nombre):
+    """Muestra el conteo de destinatarios por estado."""
+    click.echo(json.dumps(resumen_campana(nombre)))
+
+@campana_cli.command('reintentar')
+@click.argument('nombre')
+@click.option('--inciertos', is_flag=True,
+              help="También los que quedaron 'enviando' tras una caída o sin respuesta de Graph (pueden recibirlo dos veces)")
+def reintentar_campana_cli(nombre, inciertos):
+    """Vuelve a 'pendiente' los envíos fallidos (y con --inciertos los que quedaron a medias)."""
+    estados = [FALLIDO, ENVIANDO] if inciertos else [FALLIDO]
+    with app.app_context():
+        campana = db.session.get(Campana, nombre)
+        # Mientras se envía, sus 'enviando' están en vuelo: volverlos a 'pendiente' los duplicaría
+        if campana is not None and campana.ejecutor and campana.ejecutor_vence > datetime.utcnow():
+            raise click.ClickException(f"La campaña {nombre} se está enviando; reintente cuando termine")
+        cantidad = db.session.execute(
+            update(EnvioCampana).where(EnvioCampana.campana == nombre, EnvioCampana.estado.in_(estados))
+            .values(estado=PENDIENTE, error=None)
+        ).rowcount
+        db.session.commit()
+    if cantidad:
+        _actualizar_campana(nombre, 'pausada')
+    click.echo(f"{cantidad} destinatarios vuelven a 'pendiente'", err=True)
+
+@app.route('/api/campanas/<nombre>')
+def api_campana(nombre):
+    """Estado de una campaña y sus destinatarios."""
+    resumen = resumen_campana(nombre)
+    if resumen is None:
+        return jsonify({'error': 'Campaña no encontrada'}), 404
+    return jsonify(resumen)
 
 #_______________________________________________________________________________________
 # --- Uso del Token y recepción de mensajes ---
 TOKEN_CODE = os.getenv('META_WHATSAPP_TOKEN_CODE')
 
+# Firma de Meta (HMAC-SHA256 del cuerpo con el App Secret); se verifica antes de parsear el JSON
+verificador_firma = VerificadorFirma(os.getenv('META_WHATSAPP_APP_SECRET'))
+# Sin secreto se rechazan todos los POST (falla cerrada); WEBHOOK_EXIGIR_FIRMA=0 los acepta sin verificar (desarrollo)
+WEBHOOK_EXIGIR_FIRMA = os.getenv('WEBHOOK_EXIGIR_FIRMA', '1') == '1'
+if not verificador_firma.activo:
+    if WEBHOOK_EXIGIR_FIRMA:
+        logging.error("META_WHATSAPP_APP_SECRET no está definido: se rechazan todos los POST del webhook")
+    else:
+        logging.warning("META_WHATSAPP_APP_SECRET no está definido: el webhook acepta POST sin verificar la firma")
+webhooks_rechazados = metricas.contador('webhook_rechazados_total', 'POST del webhook rechazados por firma, por motivo')
+# Los cuerpos más grandes se rechazan (413) sin leerlos ni calcular el HMAC
+WEBHOOK_MAX_BYTES = int(os.getenv('WEBHOOK_MAX_BYTES', str(1024 * 1024)))
+app.config['MAX_CONTENT_LENGTH'] = WEBHOOK_MAX_BYTES
+
+def firma_rechazada(cuerpo, encabezado):
+    """Retorna el motivo si el POST no trae una firma válida (y lo contabiliza), o None si se acepta."""
+    if not verificador_firma.activo:
+        motivo = 'sin_secreto' if WEBHOOK_EXIGIR_FIRMA else None
+    else:
+        motivo = verificador_firma.motivo_rechazo(cuerpo, encabezado)
+    if motivo:
+        webhooks_rechazados.inc(motivo=motivo)
+    return motivo
+
 @app.route('/webhook', methods=['GET', 'POST'])
 def webhook():
     """Maneja las solicitudes GET y POST del webhook de WhatsApp."""
@@ -151,203 +1308,174 @@ def verificar_token(req):
     else:
         return jsonify({'error': 'Token Invalido'}), 401
 
+def extraer_eventos(data_json):
+    """Recorre todas las entradas, cambios, mensajes y estados de entrega de un POST del webhook."""
+    for entry in data_json.get('entry', []):
+        for changes in entry.get('changes', []):
+            value = changes.get('value', {})
+            for message in value.get('messages', []):
+                yield 'mensaje', message
+            for status in value.get('statuses', []):
+                yield 'estado', status
+
+def texto_de_mensaje(message):
+    """Retorna el texto procesable de un mensaje (texto o id del botón), o "" si no aplica."""
+    tipo_mensaje = message.get('type')
+    mensaje_texto = ""
+    if tipo_mensaje == 'interactive':
+        interactive_type = message.get('interactive', {}).get('type')
+        if interactive_type == "button_reply":
+            mensaje_texto = message.get('interactive', {}).get('button_reply', {}).get('id')
+    elif tipo_mensaje == 'text':
+        mensaje_texto = message.get('text', {}).get('body')
+    return mensaje_texto
+
+def registrar_estado_entrega(status):
+    """Contabiliza un recibo de entrega; los fallidos se reportan en el log."""
+    estado_envio = status.get('status')
+    estados_entrega.inc(estado=estado_envio)
+    if estado_envio == 'failed':
+        logging.warning(f"Entrega fallida a {status.get('recipient_id')}: {status.get('errors')}")
+
+def agrupar_mensajes_por_usuario(data_json, ids_pendientes):
+    """
+    Recorre el lote del webhook: contabiliza estados de entrega, descarta duplicados y agrupa
+    los mensajes procesables por usuario conservando el orden de llegada.
+    Retorna {telefono_id: [(message_id, mensaje_texto), ...]}; los ids aceptados se agregan a `ids_pendientes`.
+    Lanza ColaLlena si un archivo multimedia no entra en cola_media.
+    """
+    lotes = {}
+    for tipo_evento, evento in extraer_eventos(data_json):
+        if tipo_evento == 'estado':
+            registrar_estado_entrega(evento)
+            continue
+
+        message_id = evento.get('id')
+        if message_id and deduplicador.es_duplicado(message_id):
+            # Reenvío de Meta de un mensaje ya procesado: se confirma sin volver a responder
+            logging.info(f"Mensaje duplicado ignorado: {message_id}")
+            continue
+        mensajes_por_tipo.inc(tipo=evento.get('type'))
+
+        telefono_id = evento.get('from')
+        tipo_mensaje = evento.get('type')
+        if tipo_mensaje in TIPOS_MEDIA and telefono_id and evento.get(tipo_mensaje, {}).get('id'):
+            # Imagen, audio, documento...: se descarga en segundo plano, sin respuesta del flujo
+            if not cola_media.encolar(procesar_media_entrante, telefono_id, tipo_mensaje, evento[tipo_mensaje], clave=telefono_id):
+                if message_id:
+                    deduplicador.olvidar(message_id) # Para que el reintento de Meta sí se procese
+                raise ColaLlena(f"Cola de descargas llena: archivo {message_id} de {telefono_id}")
+            if message_id:
+                deduplicador.confirmar(message_id)
+            continue
+        mensaje_texto = texto_de_mensaje(evento)
+        if telefono_id and mensaje_texto:
+            lotes.setdefault(telefono_id, []).append((message_id, mensaje_texto))
+            if message_id:
+                ids_pendientes.append(message_id)
+        else:
+            logging.info("Mensaje no procesable (sin ID de teléfono o texto de mensaje).")
+            if message_id:
+                deduplicador.confirmar(message_id)
+    return lotes
+
+def registrar_payload(data_json):
+    """Vuelca el JSON del webhook al log solo en DEBUG o en la fracción LOG_PAYLOAD_MUESTREO de los POST."""
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("Mensaje recibido: %s", json.dumps(data_json, indent=2))
+    elif LOG_PAYLOAD_MUESTREO and random.random() < LOG_PAYLOAD_MUESTREO:
+        logging.info("Mensaje recibido (muestra): %s", json.dumps(data_json, indent=2))
+
 def recibir_mensajes(req):
-    """Procesa los mensajes entrantes del webhook de WhatsApp."""
+    """Procesa los mensajes entrantes del webhook de WhatsApp (todos los del lote)."""
+    # El cuerpo crudo queda en caché y get_json lo reutiliza sin volver a leerlo
+    if firma_rechazada(req.get_data(cache=True), req.headers.get('X-Hub-Signature-256')):
+        return jsonify({'error': 'Firma inválida'}), 401
+    ids_pendientes = [] # Ids marcados como vistos pero aún no despachados
     try:
-        data_json = req.get_json()
-        logging.info(f"Mensaje recibido: {json.dumps(data_json, indent=2)}")
-
-        entry = data_json.get('entry', [{}])[0]
-        changes = entry.get('changes', [{}])[0]
-        value = changes.get('value', {})
-        objeto_mensaje = value.get('messages', [])
-
-        if objeto_mensaje:
-            message = objeto_mensaje[0]
-            telefono_id = message.get('from')
-            tipo_mensaje = message.get('type')
-            
-            mensaje_texto = ""
-            if tipo_mensaje == 'interactive':
-                interactive_type = message.get('interactive', {}).get('type')
-                if interactive_type == "button_reply":
-                    mensaje_texto = message.get('interactive', {}).get('button_reply', {}).get('id')
-            elif tipo_mensaje == 'text':
-                mensaje_texto = message.get('text', {}).get('body')
-
-            if telefono_id and mensaje_texto:
-                procesar_y_responder_mensaje(telefono_id, mensaje_texto)
+        with tiempo_etapa.medir(etapa='parseo_webhook'):
+            data_json = req.get_json()
+            lotes = agrupar_mensajes_por_usuario(data_json, ids_pendientes)
+        registrar_payload(data_json)
+
+        for telefono_id, mensajes in lotes.items():
+            textos = [mensaje_texto for _, mensaje_texto in mensajes]
+            if WEBHOOK_MODO == 'cola':
+                # Un usuario siempre cae en el mismo hilo (orden FIFO); usuarios distintos van en paralelo.
+                # Si la cola está llena se pide reintento a Meta
+                if not cola_webhook.encolar(procesar_mensajes_usuario, telefono_id, textos, clave=telefono_id):
+                    for message_id in ids_pendientes:
+                        deduplicador.olvidar(message_id) # Para que el reintento de Meta sí se procese
+                    return jsonify({'message': 'EVENT_QUEUE_FULL'}), 503
             else:
-                logging.info("Mensaje no procesable (sin ID de teléfono o texto de mensaje).")
-        
+                procesar_mensajes_usuario(telefono_id, textos)
+            for message_id, _ in mensajes:
+                if message_id:
+                    deduplicador.confirmar(message_id)
+                    ids_pendientes.remove(message_id)
+
         return jsonify({'message': 'EVENT_RECEIVED'}), 200
+    except ColaLlena as e:
+        logging.warning(str(e))
+        for message_id in ids_pendientes:
+            deduplicador.olvidar(message_id)
+        return jsonify({'message': 'EVENT_QUEUE_FULL'}), 503
     except Exception as e:
         logging.error(f"Error en recibir_mensajes: {e}")
+        for message_id in ids_pendientes:
+            deduplicador.olvidar(message_id)
         return jsonify({'message': 'EVENT_RECEIVED_ERROR'}), 500
 
+def procesar_mensajes_usuario(telefono_id, mensajes):
+    """Procesa en orden los mensajes de un mismo usuario recibidos en un lote."""
+    for mensaje_texto in mensajes:
+        procesar_y_responder_mensaje(telefono_id, mensaje_texto)
+
 def procesar_y_responder_mensaje(telefono_id, mensaje_recibido):
     """
     Procesa un mensaje recibido, determina el idioma del usuario y envía la respuesta adecuada.
-    Registra el mensaje entrante y la respuesta en la base de datos y Google Sheets.
+    Registra el mensaje entrante y la respuesta en la base de datos.
     """
-    mensaje_procesado = mensaje_recibido.lower()
-    user_language = ""
-    
-    # Primero, registra el mensaje entrante
-    log_data_in = {
-        'telefono_usuario_id': telefono_id,
-        'plataforma': 'whatsapp 📞📱💬',
-        'mensaje': mensaje_recibido,
-        'estado_usuario': 'recibido',
-        'etiqueta_campana': 'Vacaciones',
-        'agente': AGENTE_BOT
-    }
-    #agregar_mensajes_log(json.dumps(log_data_in))
-    #exportar_eventos() # Exportar después de cada registro de mensaje
-
-    # Delega el registro en la DB y la exportación a Google Sheets a un hilo
-    threading.Thread(target=_agregar_mensajes_log_thread_safe, args=(json.dumps(log_data_in),)).start()
-
-    # Lógica para seleccionar idioma
-    if mensaje_procesado =="hola" or mensaje_procesado =="hi" or mensaje_procesado =="start" :
-        user_language = "es"
-        send_initial_messages(telefono_id, user_language)
-    elif mensaje_procesado == "btn_si1":
-        user_language = "es"
-        question1_messages(telefono_id, user_language)
-    elif mensaje_procesado == "btn_no1":
-        user_language = "es"
-        request1_messages(telefono_id, user_language)
-    elif mensaje_procesado in map(str, range(0, 10)):
-        user_language = "es"
-        request2_messages(telefono_id, user_language)
-    elif mensaje_procesado == "btn_si2":
-        user_language = "es"
-        request2_messages(telefono_id, user_language)
-    elif mensaje_procesado == "btn_no2":
-        user_language = "es"
-        request1_messages(telefono_id, user_language)
-    elif mensaje_procesado == "btn_no3":
-        user_language = "es"
-        despedida_messages(telefono_id, user_language)
-    else: # Si no tiene idioma, pedirle que lo seleccione
-        user_language = "es"
-        send_initial_messages(telefono_id, user_language)
-
-
-
-def send_initial_messages(telefono_id, lang):
-    """Envía los mensajes iniciales (bienvenida, imagen, botones Si/No) después de seleccionar idioma."""
-    # Saludo en el idioma elegido
-    message_response = get_message(lang, "welcome_initial")
-    send_message_and_log(telefono_id, message_response, 'text')
-
-    # Imagen
-    message_response = get_message(lang, "greeting_text1") # Quizás 'greeting_image_caption' sea más apropiado aquí
-    send_message_and_log(telefono_id, message_response, 'image')
-
-    #Botones pregunta1
-    # Definimos los títulos de los botones según el idioma
-    if lang == "es":
-        si_title = "Si"
-        no_title = "Tal vez"
-    else:
-        si_title = "Yes"
-        no_title = "Maybe"
-    
-    # Definimos los IDs de los botones (estos no cambian con el idioma)
-    si_id = "btn_si1"
-    no_id = "btn_no1"
-
-    message_response_for_buttons = get_message(lang, "greeting_text2")
-    
-    send_message_and_log(
-        telefono_id, 
-        message_response_for_buttons, 
-        'button', 
-        button_titles=[si_title, no_title], # Pasamos los títulos que varían por idioma
-        button_ids=[si_id, no_id]           # Pasamos los IDs fijos
-    )
-
-
-def question1_messages(telefono_id, lang):
-    """Envía los mensajes iniciales (bienvenida, imagen, botones Si/No) después de seleccionar idioma."""
-    # Saludo en el idioma elegido
-    message_response = get_message(lang, "job")
-    send_message_and_log(telefono_id, message_response, 'text')
-
-    # Imagen
-    #message_response = get_message(lang, "advice1") 
-    #send_message_and_log(telefono_id, message_response, 'text')
-
-    #Botones pregunta1
-    # Definimos los títulos de los botones según el idioma
-    if lang == "es":
-        si_title = "Si"
-        no_title = "Tal vez"
-    else:
-        si_title = "Yes"
-        no_title = "Maybe"
-    
-    # Definimos los IDs de los botones (estos no cambian con el idioma)
-    si_id = "btn_si2"
-    no_id = "btn_no2"
+    for tipo, texto, button_titles, button_ids in resolver_respuestas(telefono_id, mensaje_recibido):
+        send_message_and_log(telefono_id, texto, tipo, button_titles=button_titles, button_ids=button_ids)
 
-    message_response_for_buttons = get_message(lang, "advice1")
-    
-    send_message_and_log(
-        telefono_id, 
-        message_response_for_buttons, 
-        'button', 
-        button_titles=[si_title, no_title], # Pasamos los títulos que varían por idioma
-        button_ids=[si_id, no_id]           # Pasamos los IDs fijos
-    )
-
-def request1_messages(telefono_id, lang):
-    """Envía los mensajes iniciales (bienvenida, imagen, botones Si/No) después de seleccionar idioma."""
-    # Saludo en el idioma elegido
-    message_response = get_message(lang, "portfolio")
-    send_message_and_log(telefono_id, message_response, 'text')
-    
+def resolver_respuestas(telefono_id, mensaje_recibido):
+    """
+    Registra el mensaje entrante, avanza el flujo del usuario y retorna las respuestas a enviar
+    como (tipo, texto, titulos_botones, ids_botones). No hace llamadas de red, así el modo
+    asíncrono (asgi.py) reutiliza la misma lógica.
+    """
+    with tiempo_etapa.medir(etapa='ruteo'):
+        mensaje_procesado = mensaje_recibido.lower()
+        sesion = sesiones.obtener(telefono_id) # Desde la caché; solo va a la DB si no está
+        user_language = sesion['idioma']
+        flujo = motor_flujo.flujo
     
-def request2_messages(telefono_id, lang):
-    """Envía los mensajes iniciales (bienvenida, imagen, botones Si/No) después de seleccionar idioma."""
-    # Saludo en el idioma elegido
-    message_response = get_message(lang, "schedule")
-    send_message_and_log(telefono_id, message_response, 'text')
+        # Primero, registra el mensaje entrante
+        log_data_in = {
+            'telefono_usuario_id': telefono_id,
+            'plataforma': 'whatsapp 📞📱💬',
+            'mensaje': mensaje_recibido,
+            'estado_usuario': 'recibido',
+            'etiqueta_campana': flujo.etiqueta_campana,
+            'agente': AGENTE_BOT
+        }
+        #agregar_mensajes_log(json.dumps(log_data_in))
+        #exportar_eventos() # Exportar después de cada registro de mensaje
 
-    # Imagen
-    message_response = get_message(lang, "calendar") # Quizás 'greeting_image_caption' sea más apropiado aquí
-    send_message_and_log(telefono_id, message_response, 'text')
+        # Delega el registro en la DB al escritor único de log (por lotes)
+        registrar_log(log_data_in)
 
-    #Botones pregunta1
-    # Definimos los títulos de los botones según el idioma
-    if lang == "es":
-        si_title = "Hablar con un Agente"
-        no_title = "Finalizar chat"
-    else:
-        si_title = "Talk to an Agent"
-        no_title = "End Chat"
-    
-    # Definimos los IDs de los botones (estos no cambian con el idioma)
-    si_id = "btn_si3"
-    no_id = "btn_no3"
+        # Siguiente paso según la tabla del flujo (flows.json) y el paso actual del usuario
+        nuevo_idioma = flujo.idioma_para(mensaje_procesado)
+        if nuevo_idioma:
+            user_language = nuevo_idioma
+            paso = flujo.paso_por_defecto
+        else:
+            paso = flujo.resolver(sesion['paso'], mensaje_procesado)
+        sesiones.actualizar(telefono_id, idioma=user_language, paso=paso)
+        return flujo.respuestas(paso, user_language)
 
-    message_response_for_buttons = get_message(lang, "default_response")
-    
-    send_message_and_log(
-        telefono_id, 
-        message_response_for_buttons, 
-        'button', 
-        button_titles=[si_title, no_title], # Pasamos los títulos que varían por idioma
-        button_ids=[si_id, no_id]           # Pasamos los IDs fijos
-    )
-
-def despedida_messages(telefono_id, lang):
-    """Envía los mensajes iniciales (bienvenida, imagen, botones Si/No) después de seleccionar idioma."""
-    # Saludo en el idioma elegido
-    message_response = get_message(lang, "farewell")
-    send_message_and_log(telefono_id, message_response, 'text')
 
 def enviar_respuesta_interactiva(telefono_id, mensaje_procesado, user_language):
 
@@ -372,53 +1500,23 @@ def send_message_and_log(telefono_id, message_text, message_type='text', button_
     :param button_titles: Lista de títulos para botones (solo para 'button' type).
     :param button_ids: Lista de IDs para botones (solo para 'button' type).
     """
-    data = {}
-    if message_type == 'text':
-        data = {
-            "messaging_product": "whatsapp",
-            "recipient_type": "individual",
-            "to": telefono_id,
-            "type": "text",
-            "text": {
-                "preview_url": False,
-                "body": message_text
-            }
-        }
-    elif message_type == 'image':
-        data = {
-            "messaging_product": "whatsapp",
-            "recipient_type": "individual",
-            "to": telefono_id,
-            "type": "image",
-            "image": {
-                "link": IMA_SALUDO_URL,
-                "caption": message_text # El texto se usa como descripción de la imagen
-            }
-        }
-    elif message_type == 'button' and button_titles and button_ids and len(button_titles) == len(button_ids):
-        buttons = []
-        for i in range(len(button_titles)):
-            buttons.append({
-                "type": "reply",
-                "reply": {"id": button_ids[i], "title": button_titles[i]}
-            })
-        data = {
-            "messaging_product": "whatsapp",
-            "recipient_type": "individual",
-            "to": telefono_id,
-            "type": "interactive",
-            "interactive": {
-                "type": "button",
-                "body": {"text": message_text},
-                "footer": {"text": "Select one of the options:"},
-                "action": {"buttons": buttons}
-            }
-        }
-    else:
+    cuerpo = preparar_mensaje(telefono_id, message_text, message_type, button_titles, button_ids)
+    if cuerpo is None:
+        return
+    # El programador respeta el orden por destinatario y el límite de tasa del número emisor; si su
+    # cola sigue llena tras la espera acotada, la tarea falla (no se envía por fuera para no desordenar)
+    if not programador_envios.enviar(os.environ['META_WHATSAPP_PHONE_NUMBER_ID'], telefono_id, cuerpo):
+        raise RuntimeError(f"Cola de envíos llena: mensaje a {telefono_id} descartado")
+
+def preparar_mensaje(telefono_id, message_text, message_type='text', button_titles=None, button_ids=None):
+    """Registra el mensaje saliente y retorna su cuerpo JSON en bytes (o None si no es válido)."""
+    # Cuerpo ya serializado (plantilla en caché); solo se inserta el destinatario
+    plantilla = cache_plantillas.obtener(message_text, message_type, button_titles, button_ids)
+    if plantilla is None:
         logging.warning(f"Tipo de mensaje no soportado o parámetros incompletos: {message_type}")
-        return # No procesar si el tipo es incorrecto o faltan parámetros
+        return None # No procesar si el tipo es incorrecto o faltan parámetros
 
-    # Registrar el mensaje de salida y enviarlo
+    # Registrar el mensaje de salida
     log_data_out = {
         'telefono_usuario_id': telefono_id,
         'plataforma': 'whatsapp 📞📱💬',
@@ -430,9 +1528,9 @@ def send_message_and_log(telefono_id, message_text, message_type='text', button_
     #agregar_mensajes_log(json.dumps(log_data_out))
     #exportar_eventos()
 
-    threading.Thread(target=_agregar_mensajes_log_thread_safe, args=(json.dumps(log_data_out),)).start()
+    registrar_log(log_data_out)
 
-    send_whatsapp_message(data)
+    return plantilla.para(telefono_id)
 
 # --- Ejecución del Programa ---
 if __name__ == '__main__':
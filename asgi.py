@@ -0,0 +1,206 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import weakref
+from urllib.parse import parse_qsl
+
+import app as aplicacion
+from graph_client import GraphClientAsync
+
+#_______________________________________________________________________________________
+"""
+Modo asíncrono (ASGI) del webhook y del envío a la API de WhatsApp.
+
+En el modo Flask cada llamada a la API Graph ocupa un hilo mientras espera la respuesta.
+Aquí el webhook y los envíos corren en asyncio con un pool de conexiones compartido,
+así un solo proceso mantiene cientos de conversaciones en curso.
+-Reutiliza la lógica del flujo de app.py (resolver_respuestas, preparar_mensaje,
+deduplicación, sesiones y log por lotes); solo cambia cómo se envía.
+-Mensajes de un mismo usuario en orden (un candado por teléfono), usuarios distintos en paralelo.
+-Backpressure: con más de ASGI_MAX_EN_VUELO usuarios en proceso se responde 503 para que Meta reintente.
+-Mismas métricas que el modo Flask en /metrics (tiempos por etapa y de la API Graph).
+-Misma verificación de X-Hub-Signature-256 que el modo Flask, sobre el cuerpo crudo.
+El dashboard y las demás rutas siguen en la app Flask.
+
+Ejecución: uvicorn asgi:app --host 0.0.0.0 --port 80
+"""
+#_______________________________________________________________________________________
+
+
+class AplicacionAsgi:
+    """Aplicación ASGI mínima: /webhook (GET y POST), /estado y /metrics."""
+
+    def __init__(self, max_en_vuelo=1000):
+        self.max_en_vuelo = max_en_vuelo
+        self.graph = None
+        self._tareas = set()
+        self._candados = weakref.WeakValueDictionary() # Un candado por teléfono mientras tenga tareas
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._ciclo_de_vida(receive, send)
+        elif scope['type'] == 'http':
+            await self._atender(scope, receive, send)
+
+    async def _ciclo_de_vida(self, receive, send):
+        while True:
+            mensaje = await receive()
+            if mensaje['type'] == 'lifespan.startup':
+                self.graph = GraphClientAsync(
+                    base_url=os.getenv('GRAPH_API_URL', 'https://graph.facebook.com'),
+                    max_conexiones=int(os.getenv('ASGI_GRAPH_CONEXIONES', '100')),
+                    timeout=float(os.getenv('GRAPH_TIMEOUT', '10')),
+                    max_reintentos=int(os.getenv('GRAPH_MAX_REINTENTOS', '3')),
+                )
+                aplicacion.iniciar_tareas_servidor()
+                await send({'type': 'lifespan.startup.complete'})
+            elif mensaje['type'] == 'lifespan.shutdown':
+                # Drenado: se terminan las conversaciones en curso antes de cerrar el pool
+                if self._tareas:
+                    await asyncio.wait(self._tareas, timeout=30)
+                await self.graph.cerrar()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _atender(self, scope, receive, send):
+        path, method = scope['path'], scope['method']
+        if path == '/webhook' and method == 'GET':
+            parametros = dict(parse_qsl(scope['query_string'].decode()))
+            token, challenge = parametros.get('hub.verify_token'), parametros.get('hub.challenge')
+            if challenge and token == aplicacion.TOKEN_CODE:
+                await _responder(send, 200, challenge.encode(), 'text/plain')
+            else:
+                await _responder_json(send, 401, {'error': 'Token Invalido'})
+        elif path == '/webhook' and method == 'POST':
+            cuerpo = await _leer_cuerpo(receive, aplicacion.WEBHOOK_MAX_BYTES)
+            if cuerpo is None:
+                await _responder_json(send, 413, {'error': 'Cuerpo demasiado grande'})
+            elif aplicacion.firma_rechazada(cuerpo, _encabezado(scope, b'x-hub-signature-256')):
+                await _responder_json(send, 401, {'error': 'Firma inválida'})
+            else:
+                status, respuesta = await self._recibir_mensajes(cuerpo)
+                await _responder_json(send, status, respuesta)
+        elif path == '/estado' and method == 'GET':
+            await _responder_json(send, 200, {
+                'modo': 'asgi',
+                'en_vuelo': len(self._tareas),
+                'graph_client': self.graph.estadisticas() if self.graph else None,
+                'escritor_log': aplicacion.escritor_log.estadisticas(),
+                'deduplicador': aplicacion.deduplicador.estadisticas(),
+                'sesiones': aplicacion.sesiones.estadisticas(),
+            })
+        elif path == '/metrics' and method == 'GET':
+            await _responder(send, 200, aplicacion.metricas.exportar().encode(), 'text/plain; version=0.0.4; charset=utf-8')
+        else:
+            await _responder_json(send, 404, {'error': 'No encontrado'})
+
+    @staticmethod
+    def _agrupar(cuerpo, ids_pendientes):
+        with aplicacion.tiempo_etapa.medir(etapa='parseo_webhook'):
+            data_json = json.loads(cuerpo)
+            lotes = aplicacion.agrupar_mensajes_por_usuario(data_json, ids_pendientes)
+        aplicacion.registrar_payload(data_json)
+        return lotes
+
+    async def _recibir_mensajes(self, cuerpo):
+        """Valida y despacha el lote sin esperar los envíos; misma lógica que recibir_mensajes."""
+        ids_pendientes = []
+        try:
+            # Fuera del event loop: encolar un archivo multimedia puede bloquear si cola_media está llena
+            lotes = await asyncio.to_thread(self._agrupar, cuerpo, ids_pendientes)
+            if lotes and len(self._tareas) + len(lotes) > self.max_en_vuelo:
+                for message_id in ids_pendientes:
+                    aplicacion.deduplicador.olvidar(message_id) # Para que el reintento de Meta sí se procese
+                return 503, {'message': 'EVENT_QUEUE_FULL'}
+            for telefono_id, mensajes in lotes.items():
+                tarea = asyncio.create_task(
+                    self._procesar_usuario(telefono_id, [mensaje_texto for _, mensaje_texto in mensajes])
+                )
+                self._tareas.add(tarea)
+                tarea.add_done_callback(self._tareas.discard)
+            for message_id in ids_pendientes:
+                aplicacion.deduplicador.confirmar(message_id)
+            return 200, {'message': 'EVENT_RECEIVED'}
+        except aplicacion.ColaLlena as e:
+            logging.warning(str(e))
+            for message_id in ids_pendientes:
+                aplicacion.deduplicador.olvidar(message_id)
+            return 503, {'message': 'EVENT_QUEUE_FULL'}
+        except Exception as e:
+            logging.error(f"Error en recibir_mensajes (asgi): {e}")
+            for message_id in ids_pendientes:
+                aplicacion.deduplicador.olvidar(message_id)
+            return 500, {'message': 'EVENT_RECEIVED_ERROR'}
+
+    async def _procesar_usuario(self, telefono_id, mensajes):
+        candado = self._candados.get(telefono_id)
+        if candado is None:
+            candado = self._candados[telefono_id] = asyncio.Lock()
+        async with candado:
+            for mensaje_texto in mensajes:
+                try:
+                    await self._procesar_y_responder(telefono_id, mensaje_texto)
+                except Exception as e:
+                    logging.error(f"Error procesando mensaje de {telefono_id} (asgi): {e}")
+
+    async def _procesar_y_responder(self, telefono_id, mensaje_recibido):
+        # La sesión puede requerir una lectura de la DB si no está en caché: se hace fuera del event loop
+        respuestas = await asyncio.to_thread(aplicacion.resolver_respuestas, telefono_id, mensaje_recibido)
+        for tipo, texto, button_titles, button_ids in respuestas:
+            cuerpo = aplicacion.preparar_mensaje(telefono_id, texto, tipo, button_titles, button_ids)
+            if cuerpo is None:
+                continue
+            # Límite de tasa del número emisor (misma cubeta de tokens que el modo Flask)
+            espera = aplicacion.limitador_envios.reservar(os.environ['META_WHATSAPP_PHONE_NUMBER_ID'])
+            if espera:
+                await asyncio.sleep(espera)
+            inicio = time.perf_counter()
+            try:
+                response = await self.graph.post_json(
+                    aplicacion.ruta_mensajes(), cuerpo, os.environ['META_WHATSAPP_ACCESS_TOKEN']
+                )
+                aplicacion.tiempo_graph.observar(time.perf_counter() - inicio, status=response.status)
+                logging.info("Respuesta de WhatsApp API: %s %s", response.status, response.reason)
+            except Exception as e:
+                aplicacion.tiempo_graph.observar(time.perf_counter() - inicio, status='error')
+                logging.error(f"Error al enviar mensaje a WhatsApp: {e}")
+
+
+def _encabezado(scope, nombre):
+    for clave, valor in scope['headers']:
+        if clave == nombre:
+            return valor.decode('latin-1')
+    return None
+
+
+async def _leer_cuerpo(receive, max_bytes):
+    """Lee el cuerpo completo; retorna None si supera `max_bytes`."""
+    partes = []
+    total = 0
+    while True:
+        mensaje = await receive()
+        parte = mensaje.get('body', b'')
+        total += len(parte)
+        if total > max_bytes:
+            return None
+        partes.append(parte)
+        if not mensaje.get('more_body'):
+            return b''.join(partes)
+
+
+async def _responder(send, status, cuerpo, content_type):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode()), (b'content-length', str(len(cuerpo)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': cuerpo})
+
+
+async def _responder_json(send, status, datos):
+    await _responder(send, status, json.dumps(datos).encode(), 'application/json')
+
+
+app = AplicacionAsgi(max_en_vuelo=int(os.getenv('ASGI_MAX_EN_VUELO', '1000')))
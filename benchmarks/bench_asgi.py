@@ -0,0 +1,136 @@
+"""
+Compara el modo Flask (hilos) con el modo ASGI (asyncio) del webhook usando el
+servidor Graph local con latencia inyectada.
+
+Uso: python benchmarks/bench_asgi.py [--conversaciones 300] [--concurrencia 32] [--latencia 0.05]
+Cada conversación es un "hola" de un usuario distinto (3 envíos a la API Graph).
+Reporta latencia del acuse del webhook y el tiempo hasta que el stub recibe todos los envíos.
+Cada modo corre en un proceso aparte.
+"""
+import argparse
+import hashlib
+import hmac
+import http.client
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, RAIZ)
+
+PUERTO = 8765
+SECRETO = "app-secret-de-prueba" # Los POST se firman como lo hace Meta (X-Hub-Signature-256)
+
+
+def payload_webhook(i):
+    return json.dumps({"entry": [{"changes": [{"value": {"messages": [
+        {"from": f"57300{i:07d}", "id": f"wamid.bench.{i}.{time.time()}", "type": "text", "text": {"body": "hola"}}
+    ]}}]}]}).encode()
+
+
+def firmar(cuerpo):
+    return "sha256=" + hmac.new(SECRETO.encode(), cuerpo, hashlib.sha256).hexdigest()
+
+
+def iniciar_servidor(modo):
+    import app as aplicacion
+    if modo == 'flask':
+        from werkzeug.serving import make_server
+        servidor = make_server("127.0.0.1", PUERTO, aplicacion.app, threaded=True)
+        threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    else:
+        import uvicorn
+        import asgi
+        servidor = uvicorn.Server(uvicorn.Config(asgi.app, host="127.0.0.1", port=PUERTO, log_level="warning"))
+        threading.Thread(target=servidor.run, daemon=True).start()
+        while not servidor.started:
+            time.sleep(0.01)
+
+
+def correr_hijo(modo, conversaciones, concurrencia, latencia):
+    from stub_graph import StubGraph
+
+    with StubGraph(latencia=latencia) as stub:
+        os.environ['GRAPH_API_URL'] = stub.url
+        import logging
+        logging.disable(logging.WARNING)
+        iniciar_servidor(modo)
+
+        locales = threading.local()
+        def entregar(i):
+            if not hasattr(locales, 'conexion'):
+                locales.conexion = http.client.HTTPConnection("127.0.0.1", PUERTO)
+            inicio = time.perf_counter()
+            cuerpo = payload_webhook(i)
+            locales.conexion.request("POST", "/webhook", cuerpo,
+                                     {"Content-Type": "application/json", "X-Hub-Signature-256": firmar(cuerpo)})
+            respuesta = locales.conexion.getresponse()
+            respuesta.read()
+            return time.perf_counter() - inicio, respuesta.status
+
+        inicio = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrencia) as ejecutor:
+            resultados = list(ejecutor.map(entregar, range(conversaciones)))
+        esperados = conversaciones * 3
+        while stub.peticiones < esperados and time.perf_counter() - inicio < 300:
+            time.sleep(0.005)
+        total = time.perf_counter() - inicio
+
+        acuses = sorted(duracion for duracion, _ in resultados)
+        print(json.dumps({
+            'acuse_p50_ms': acuses[len(acuses) // 2] * 1000,
+            'acuse_p99_ms': acuses[int(len(acuses) * 0.99) - 1] * 1000,
+            'segundos': total,
+            'envios': stub.peticiones,
+            'acuses_200': sum(1 for _, status in resultados if status == 200),
+        }))
+        os._exit(0) # Sin esperar el drenado de hilos del servidor
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--conversaciones", type=int, default=300)
+    parser.add_argument("--concurrencia", type=int, default=32)
+    parser.add_argument("--latencia", type=float, default=0.05)
+    parser.add_argument("--hijo", choices=("flask", "asgi"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.hijo:
+        correr_hijo(args.hijo, args.conversaciones, args.concurrencia, args.latencia)
+        return
+
+    with tempfile.TemporaryDirectory() as directorio:
+        for modo in ("flask", "asgi"):
+            env = dict(
+                os.environ,
+                DATABASE_URL=f"sqlite:///{os.path.join(directorio, modo + '.db')}",
+                META_WHATSAPP_ACCESS_TOKEN="token",
+                API_WHATSAPP_VERSION="v22.0",
+                META_WHATSAPP_PHONE_NUMBER_ID="123456",
+                META_WHATSAPP_APP_SECRET=SECRETO,
+                # Sin límite de tasa efectivo: se mide el servidor, no la cubeta de tokens
+                GRAPH_TASA_MENSAJES="100000",
+                GRAPH_RAFAGA_MENSAJES="100000",
+            )
+            salida = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--hijo", modo,
+                 "--conversaciones", str(args.conversaciones), "--concurrencia", str(args.concurrencia),
+                 "--latencia", str(args.latencia)],
+                env=env, capture_output=True, text=True, cwd=directorio
+            )
+            if salida.returncode != 0:
+                print(f"{modo}: error\n{salida.stderr}")
+                continue
+            r = json.loads(salida.stdout.strip().splitlines()[-1])
+            print(f"{modo:<6} acuse p50 {r['acuse_p50_ms']:6.2f} ms  p99 {r['acuse_p99_ms']:7.2f} ms   "
+                  f"{r['envios']} envíos en {r['segundos']:.2f}s ({r['envios'] / r['segundos']:.1f}/s)   "
+                  f"acuses 200: {r['acuses_200']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Campaña masiva contra el servidor Graph local: throughput de envío y reanudación tras una caída.
+
+Uso:
+  python benchmarks/bench_campana.py [--destinatarios 10000] [--latencia 0.05] [--tasa 80]
+      [--hilos 16] [--lote 500] [--caida 3000] [--lentos 0.01]
+Fase 1: un proceso envía la campaña y muere (os._exit) cuando el stub recibe el envío número
+--caida, sin que el cliente alcance a leer la respuesta. Fase 2: cuando vence el bloqueo que
+dejó el primero, otro proceso reanuda con `ejecutar_campana` hasta terminar. Una fracción
+--lentos de los envíos llega al stub pero responde después de GRAPH_TIMEOUT (el cliente no
+debe reintentarlos). Cada proceso usa la
+misma DB SQLite temporal; el stub anota en un archivo cada destinatario recibido, y al final
+se verifica que ninguno recibió el mensaje dos veces y cuántos quedaron inciertos ('enviando').
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, RAIZ)
+
+CAMPANA = "bench"
+TIMEOUT_GRAPH = 0.5
+BLOQUEO = 3 # CAMPANA_BLOQUEO: la fase 2 espera a que venza el de la fase 1
+
+
+def correr_hijo(fase, destinatarios, latencia, hilos, lote, caida, lentos, recibidos):
+    from stub_graph import StubGraph
+
+    anotar = threading.Lock()
+
+    class StubQueAnota(StubGraph):
+        def respuesta(self, path, cuerpo):
+            with anotar:
+                with open(recibidos, 'a') as archivo:
+                    archivo.write(json.loads(cuerpo)['to'] + "\n")
+                if caida and self.peticiones >= caida:
+                    os._exit(3) # Caída a mitad de un lote: este envío llegó pero no se confirma
+            if random.random() < lentos:
+                time.sleep(TIMEOUT_GRAPH * 2) # Llegó, pero el cliente deja de esperar la respuesta
+            return super().respuesta(path, cuerpo)
+
+    with StubQueAnota(latencia=latencia) as stub:
+        os.environ['GRAPH_API_URL'] = stub.url
+        import logging
+        logging.disable(logging.WARNING)
+        import app as aplicacion
+
+        if fase == 1:
+            with aplicacion.app.app_context():
+                aplicacion.db.session.add(aplicacion.Campana(nombre=CAMPANA, tipo='text', mensaje="Promo de prueba"))
+                aplicacion.db.session.commit()
+            aplicacion.agregar_destinatarios(CAMPANA, (f"57310{i:07d}" for i in range(destinatarios)))
+        estadisticas = aplicacion.ejecutar_campana(CAMPANA, hilos, lote)
+        aplicacion.escritor_log.detener()
+        print(json.dumps({'estadisticas': estadisticas, 'resumen': aplicacion.resumen_campana(CAMPANA)}))
+        os._exit(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--destinatarios", type=int, default=10000)
+    parser.add_argument("--latencia", type=float, default=0.05, help="Segundos por llamada al stub de Graph")
+    parser.add_argument("--tasa", type=float, default=80, help="Mensajes por segundo permitidos (CAMPANA_TASA_MENSAJES)")
+    parser.add_argument("--hilos", type=int, default=16)
+    parser.add_argument("--lote", type=int, default=500)
+    parser.add_argument("--caida", type=int, default=3000, help="Envío en el que muere la fase 1 (0: sin caída)")
+    parser.add_argument("--lentos", type=float, default=0.01, help="Fracción de envíos que responden después del timeout")
+    parser.add_argument("--hijo", type=int, choices=(1, 2), help=argparse.SUPPRESS)
+    parser.add_argument("--recibidos", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.hijo:
+        correr_hijo(args.hijo, args.destinatarios, args.latencia, args.hilos, args.lote,
+                    args.caida if args.hijo == 1 else 0, args.lentos, args.recibidos)
+        return
+
+    with tempfile.TemporaryDirectory() as directorio:
+        recibidos = os.path.join(directorio, "recibidos.txt")
+        env = dict(
+            os.environ,
+            DATABASE_URL=f"sqlite:///{os.path.join(directorio, 'campana.db')}",
+            META_WHATSAPP_ACCESS_TOKEN="token",
+            API_WHATSAPP_VERSION="v22.0",
+            META_WHATSAPP_PHONE_NUMBER_ID="123456",
+            # El nivel del número queda alto para que solo limite la cubeta de la campaña
+            GRAPH_TASA_MENSAJES="100000",
+            CAMPANA_TASA_MENSAJES=str(args.tasa),
+            CAMPANA_RAFAGA_MENSAJES=str(args.tasa),
+            GRAPH_TIMEOUT=str(TIMEOUT_GRAPH),
+            CAMPANA_BLOQUEO=str(BLOQUEO),
+        )
+        for fase in (1, 2):
+            salida = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--hijo", str(fase),
+                 "--destinatarios", str(args.destinatarios), "--latencia", str(args.latencia),
+                 "--hilos", str(args.hilos), "--lote", str(args.lote), "--caida", str(args.caida),
+                 "--lentos", str(args.lentos),
+                 "--recibidos", recibidos],
+                env=env, capture_output=True, text=True, cwd=directorio
+            )
+            if salida.returncode == 3:
+                print(f"fase {fase}: caída simulada en el envío {args.caida}")
+                time.sleep(BLOQUEO)
+                continue
+            if salida.returncode != 0:
+                print(f"fase {fase}: error\n{salida.stderr}")
+                return
+            r = json.loads(salida.stdout.strip().splitlines()[-1])
+            e, resumen = r['estadisticas'], r['resumen']
+            print(f"fase {fase}: {e['enviados']} enviados, {e['fallidos']} fallidos, {e['inciertos']} sin respuesta "
+                  f"en {e['segundos']:.2f}s   "
+                  f"{e['envios_por_segundo']}/s   {e['lotes']} lotes")
+            print(f"  campaña '{resumen['estado']}': " +
+                  "   ".join(f"{estado} {resumen[estado]}" for estado in ('pendiente', 'enviando', 'enviado', 'fallido')))
+
+        with open(recibidos) as archivo:
+            conteo = collections.Counter(linea.strip() for linea in archivo)
+        dobles = sum(1 for veces in conteo.values() if veces > 1)
+        print(f"destinatarios que recibieron el mensaje: {len(conteo)} de {args.destinatarios}   "
+              f"recibidos dos veces o más: {dobles}")
+
+
+if __name__ == "__main__":
+    main()
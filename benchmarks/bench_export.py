@@ -0,0 +1,86 @@
+"""
+Mide la exportación masiva del log (/api/log/exportar): filas/s y memoria pico según el
+tamaño del log, para comprobar que el cursor del lado del servidor mantiene la memoria constante.
+
+Uso: python benchmarks/bench_export.py [--filas 20000 --filas 200000] [--formato csv]
+Cada tamaño corre en un proceso aparte con una DB SQLite temporal.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, RAIZ)
+
+
+def correr_hijo(filas, formato):
+    import logging
+    logging.disable(logging.WARNING)
+    import app as aplicacion
+    from sqlalchemy import insert
+
+    inicio_fechas = datetime(2026, 1, 1)
+    with aplicacion.app.app_context():
+        for desde in range(0, filas, 10000):
+            aplicacion.db.session.execute(insert(aplicacion.Log), [{
+                'fecha_y_hora': inicio_fechas + timedelta(seconds=i),
+                'telefono_usuario_id': f"57300{i % 5000:07d}",
+                'plataforma': 'whatsapp 📞📱💬',
+                'mensaje': f"Mensaje de prueba número {i}",
+                'estado_usuario': 'recibido' if i % 2 else 'enviado',
+                'etiqueta_campana': 'Vacaciones',
+                'agente': 'Bot',
+            } for i in range(desde, min(desde + 10000, filas))])
+            aplicacion.db.session.commit()
+
+    cliente = aplicacion.app.test_client()
+    tracemalloc.start()
+    inicio = time.perf_counter()
+    respuesta = cliente.get(f'/api/log/exportar?formato={formato}', buffered=False)
+    total_bytes = sum(len(bloque) for bloque in respuesta.response)
+    segundos = time.perf_counter() - inicio
+    _, pico = tracemalloc.get_traced_memory()
+    respuesta.close()
+    print(json.dumps({'segundos': segundos, 'bytes': total_bytes, 'pico_memoria': pico}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--filas", type=int, action="append", dest="tamanos")
+    parser.add_argument("--formato", choices=("csv", "jsonl"), default="csv")
+    parser.add_argument("--hijo", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.hijo:
+        correr_hijo(args.hijo, args.formato)
+        return
+
+    with tempfile.TemporaryDirectory() as directorio:
+        for filas in args.tamanos or [20000, 200000]:
+            env = dict(
+                os.environ,
+                DATABASE_URL=f"sqlite:///{os.path.join(directorio, f'export_{filas}.db')}",
+                META_WHATSAPP_ACCESS_TOKEN="token",
+                API_WHATSAPP_VERSION="v22.0",
+                META_WHATSAPP_PHONE_NUMBER_ID="123456",
+            )
+            salida = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--hijo", str(filas), "--formato", args.formato],
+                env=env, capture_output=True, text=True, cwd=directorio
+            )
+            if salida.returncode != 0:
+                print(f"{filas} filas: error\n{salida.stderr}")
+                continue
+            r = json.loads(salida.stdout.strip().splitlines()[-1])
+            print(f"{filas:>8} filas {args.formato}: {r['segundos']:.2f}s ({filas / r['segundos']:9.0f} filas/s)   "
+                  f"{r['bytes'] / 1e6:7.1f} MB exportados   memoria pico {r['pico_memoria'] / 1e6:6.2f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Costo por petición de verificar X-Hub-Signature-256 (firma.VerificadorFirma) según el tamaño
+del cuerpo, comparado con parsear el mismo JSON.
+
+Uso: python benchmarks/bench_firma.py [--repeticiones 20000]
+Casos: firma válida, firma incorrecta (mismo costo: se calcula el HMAC) y sin encabezado
+(rechazo sin calcular el HMAC).
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from firma import VerificadorFirma
+
+SECRETO = "app-secret-de-prueba"
+
+
+def payload(mensajes):
+    """POST del webhook con `mensajes` mensajes de texto, como los envía Meta."""
+    return json.dumps({"object": "whatsapp_business_account", "entry": [{
+        "id": "102290129340398",
+        "changes": [{"field": "messages", "value": {
+            "messaging_product": "whatsapp",
+            "metadata": {"display_phone_number": "15550783881", "phone_number_id": "106540352242922"},
+            "contacts": [{"profile": {"name": "Usuario de prueba"}, "wa_id": "573001234567"}],
+            "messages": [{
+                "from": "573001234567", "id": f"wamid.HBgMNTczMDAxMjM0NTY3FQIAEhggQjk{i:08d}",
+                "timestamp": "1750000000", "type": "text", "text": {"body": "Hola, quiero más información"}
+            } for i in range(mensajes)],
+        }}],
+    }]}).encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeticiones", type=int, default=20000)
+    args = parser.parse_args()
+
+    verificador = VerificadorFirma(SECRETO)
+    for mensajes in (1, 10, 100, 1000):
+        cuerpo = payload(mensajes)
+        firma = "sha256=" + hmac.new(SECRETO.encode(), cuerpo, hashlib.sha256).hexdigest()
+        incorrecta = "sha256=" + "0" * 64
+        assert verificador.motivo_rechazo(cuerpo, firma) is None
+
+        casos = {
+            'válida': lambda: verificador.motivo_rechazo(cuerpo, firma),
+            'incorrecta': lambda: verificador.motivo_rechazo(cuerpo, incorrecta),
+            'sin firma': lambda: verificador.motivo_rechazo(cuerpo, None),
+            'json.loads': lambda: json.loads(cuerpo),
+        }
+        tiempos = {
+            nombre: min(timeit.repeat(caso, number=args.repeticiones, repeat=3)) / args.repeticiones * 1e6
+            for nombre, caso in casos.items()
+        }
+        print(f"{len(cuerpo):>8} bytes ({mensajes:>4} mensajes): " +
+              "   ".join(f"{nombre} {us:8.2f} µs" for nombre, us in tiempos.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Compara el envío con una conexión nueva por mensaje (comportamiento anterior)
+contra el pool keep-alive de GraphClient, usando el servidor Graph local.
+
+Uso: python benchmarks/bench_graph_client.py [--mensajes 500] [--hilos 8] [--latencia 0.005]
+Nota: el stub es HTTP plano, así que no mide el costo del handshake TLS, que en
+producción hace la diferencia aún mayor.
+"""
+import argparse
+import http.client
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from graph_client import GraphClient
+from stub_graph import StubGraph
+
+RUTA = "/v22.0/123456/messages"
+CUERPO = json.dumps({
+    "messaging_product": "whatsapp",
+    "recipient_type": "individual",
+    "to": "573000000000",
+    "type": "text",
+    "text": {"preview_url": False, "body": "¡Hola! Bienvenido a TicAll Media."}
+})
+
+
+def enviar_sin_pool(stub):
+    host, port = stub.url.split("//")[1].split(":")
+    connection = http.client.HTTPConnection(host, int(port))
+    try:
+        connection.request("POST", RUTA, CUERPO, {"Content-Type": "application/json"})
+        connection.getresponse().read()
+    finally:
+        connection.close()
+
+
+def medir(nombre, funcion, mensajes, hilos):
+    latencias = []
+
+    def una():
+        inicio = time.perf_counter()
+        funcion()
+        latencias.append(time.perf_counter() - inicio)
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=hilos) as ejecutor:
+        for _ in range(mensajes):
+            ejecutor.submit(una)
+    total = time.perf_counter() - inicio
+    latencias.sort()
+    p50 = latencias[len(latencias) // 2] * 1000
+    p99 = latencias[int(len(latencias) * 0.99) - 1] * 1000
+    print(f"{nombre:<12} {mensajes / total:>9.1f} msg/s   p50 {p50:6.2f} ms   p99 {p99:6.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--mensajes", type=int, default=500)
+    parser.add_argument("--hilos", type=int, default=8)
+    parser.add_argument("--latencia", type=float, default=0.005)
+    args = parser.parse_args()
+
+    with StubGraph(latencia=args.latencia) as stub:
+        medir("sin pool", lambda: enviar_sin_pool(stub), args.mensajes, args.hilos)
+        conexiones_sin_pool = stub.conexiones
+
+        cliente = GraphClient(base_url=stub.url, tamano_pool=args.hilos)
+        medir("con pool", lambda: cliente.post_json(RUTA, CUERPO, "token"), args.mensajes, args.hilos)
+        cliente.cerrar()
+        print(f"conexiones abiertas: sin pool {conexiones_sin_pool}, "
+              f"con pool {stub.conexiones - conexiones_sin_pool}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Microbenchmark del armado de payloads salientes: dict nuevo + json.dumps por envío
+(camino anterior) contra plantillas serializadas en caché (payloads.CachePlantillas).
+
+Uso: python benchmarks/bench_payloads.py [--repeticiones 100000]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from payloads import CachePlantillas, construir_payload
+from translations import get_message
+
+IMAGEN = "https://res.cloudinary.com/dioy4cydg/image/upload/v1747884690/imagen_index_wjog6p.jpg"
+TELEFONO = "573001234567"
+
+# Los tres mensajes del saludo inicial
+MENSAJES = [
+    ('text', get_message("es", "welcome_initial"), None, None),
+    ('image', get_message("es", "greeting_text1"), None, None),
+    ('button', get_message("es", "greeting_text2"), ["Si", "Tal vez"], ["btn_si1", "btn_no1"]),
+]
+
+
+def camino_anterior():
+    for message_type, message_text, button_titles, button_ids in MENSAJES:
+        json.dumps(construir_payload(TELEFONO, message_text, message_type, button_titles, button_ids, IMAGEN))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeticiones", type=int, default=100000)
+    args = parser.parse_args()
+
+    cache = CachePlantillas(image_link=IMAGEN)
+    cache.precargar(MENSAJES)
+
+    def con_plantillas():
+        for message_type, message_text, button_titles, button_ids in MENSAJES:
+            cache.obtener(message_text, message_type, button_titles, button_ids).para(TELEFONO)
+
+    # Ambos caminos deben producir el mismo mensaje
+    for message_type, message_text, button_titles, button_ids in MENSAJES:
+        esperado = construir_payload(TELEFONO, message_text, message_type, button_titles, button_ids, IMAGEN)
+        assert json.loads(cache.obtener(message_text, message_type, button_titles, button_ids).para(TELEFONO)) == esperado
+
+    for nombre, funcion in (("dict + dumps", camino_anterior), ("plantillas", con_plantillas)):
+        segundos = min(timeit.repeat(funcion, number=args.repeticiones, repeat=3))
+        print(f"{nombre:<14} {segundos / args.repeticiones * 1e6:7.2f} µs por saludo (3 mensajes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""
+Prueba de carga del webhook: reproduce lotes realistas de WhatsApp contra /webhook con
+el servidor Graph local (latencia y 429 inyectados) y reporta acuses, respuestas y filas.
+
+Uso:
+  python benchmarks/bench_webhook.py [--entregas 1000] [--concurrencia 32] [--latencia 0.02]
+      [--tasa-429 0.02] [--modo flask] [--modo asgi] [--semilla 1]
+Mezcla de entregas: texto ("hola"), button_reply, lotes con varios mensajes de uno o más
+usuarios, y reenvíos de Meta (mismo POST con los mismos ids, que no deben responderse).
+Reporta p50/p99 del acuse del webhook, p50/p99 de extremo a extremo (del POST a la primera
+respuesta que recibe el stub para ese usuario), entregas/s, envíos/s y filas escritas en la DB.
+Cada modo corre en un proceso aparte con una DB SQLite temporal.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, RAIZ)
+
+from bench_asgi import PUERTO, SECRETO, firmar, iniciar_servidor
+
+MEZCLA = (('texto', 0.4), ('boton', 0.3), ('lote', 0.2), ('reenvio', 0.1))
+BOTONES = ('btn_si1', 'btn_no1', 'btn_si2', 'btn_no2', 'btn_si3', 'btn_no3')
+
+
+def mensaje_texto(telefono, message_id, texto):
+    return {"from": telefono, "id": message_id, "type": "text", "text": {"body": texto}}
+
+
+def mensaje_boton(telefono, message_id, boton):
+    return {"from": telefono, "id": message_id, "type": "interactive",
+            "interactive": {"type": "button_reply", "button_reply": {"id": boton, "title": boton}}}
+
+
+def generar_entregas(cantidad, semilla):
+    """Retorna [(tipo, telefonos, cuerpo_json_bytes)]; los reenvíos repiten un cuerpo anterior."""
+    azar = random.Random(semilla)
+    tipos, pesos = zip(*MEZCLA)
+    entregas = []
+    for i in range(cantidad):
+        tipo = azar.choices(tipos, pesos)[0]
+        if tipo == 'reenvio' and not entregas:
+            tipo = 'texto'
+        if tipo == 'reenvio':
+            _, telefonos, cuerpo = azar.choice(entregas)
+            entregas.append(('reenvio', telefonos, cuerpo))
+            continue
+        telefono = f"57300{i:07d}" # Un usuario nuevo por entrega: su primera respuesta es de esta entrega
+        if tipo == 'texto':
+            mensajes = [mensaje_texto(telefono, f"wamid.carga.{i}.0", "hola")]
+        elif tipo == 'boton':
+            mensajes = [mensaje_boton(telefono, f"wamid.carga.{i}.0", azar.choice(BOTONES))]
+        else:
+            # Varios mensajes del mismo usuario en orden, más otro usuario en el mismo POST
+            otro = f"57301{i:07d}"
+            mensajes = [
+                mensaje_texto(telefono, f"wamid.carga.{i}.0", "hola"),
+                mensaje_boton(telefono, f"wamid.carga.{i}.1", azar.choice(BOTONES)),
+                mensaje_texto(otro, f"wamid.carga.{i}.2", "hi"),
+            ]
+        telefonos = sorted({m['from'] for m in mensajes})
+        cuerpo = json.dumps({"object": "whatsapp_business_account", "entry": [{"changes": [
+            {"field": "messages", "value": {"messaging_product": "whatsapp", "messages": mensajes}}
+        ]}]}).encode()
+        entregas.append((tipo, telefonos, cuerpo))
+    return entregas
+
+
+def percentil(valores, p):
+    if not valores:
+        return float('nan')
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p))] * 1000
+
+
+def esperar_procesamiento(modo, aplicacion):
+    """Drena la cola del webhook (o las tareas ASGI) y los envíos pendientes."""
+    if modo == 'flask':
+        aplicacion.cola_webhook.detener()
+    else:
+        import asgi
+        while asgi.app._tareas:
+            time.sleep(0.01)
+    aplicacion.programador_envios.detener()
+
+
+def correr_hijo(modo, entregas, concurrencia, latencia, tasa_429, semilla):
+    from stub_graph import StubGraph
+
+    primera_respuesta = {} # telefono -> momento en que el stub recibió su primer envío
+
+    class StubConTiempos(StubGraph):
+        def respuesta(self, path, cuerpo):
+            telefono = json.loads(cuerpo).get('to')
+            primera_respuesta.setdefault(telefono, time.perf_counter())
+            return super().respuesta(path, cuerpo)
+
+    with StubConTiempos(latencia=latencia, tasa_429=tasa_429) as stub:
+        os.environ['GRAPH_API_URL'] = stub.url
+        import logging
+        logging.disable(logging.WARNING)
+        import app as aplicacion
+        iniciar_servidor(modo)
+
+        lista = generar_entregas(entregas, semilla)
+        inicio_usuario = {} # telefono -> momento del POST de su primera entrega
+        locales = threading.local()
+
+        def entregar(entrega):
+            _, telefonos, cuerpo = entrega
+            if not hasattr(locales, 'conexion'):
+                locales.conexion = http.client.HTTPConnection("127.0.0.1", PUERTO)
+            inicio = time.perf_counter()
+            for telefono in telefonos:
+                inicio_usuario.setdefault(telefono, inicio)
+            locales.conexion.request("POST", "/webhook", cuerpo,
+                                     {"Content-Type": "application/json", "X-Hub-Signature-256": firmar(cuerpo)})
+            respuesta = locales.conexion.getresponse()
+            respuesta.read()
+            return time.perf_counter() - inicio, respuesta.status
+
+        inicio = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrencia) as ejecutor:
+            resultados = list(ejecutor.map(entregar, lista))
+        esperar_procesamiento(modo, aplicacion)
+        total = time.perf_counter() - inicio
+        for escritor in (aplicacion.escritor_log, aplicacion.escritor_ids, aplicacion.escritor_sesiones):
+            escritor.detener()
+        with aplicacion.app.app_context():
+            filas_log = aplicacion.db.session.query(aplicacion.Log).count()
+
+        acuses = [duracion for duracion, _ in resultados]
+        extremo_a_extremo = [
+            primera_respuesta[telefono] - inicio_usuario[telefono]
+            for telefono in primera_respuesta if telefono in inicio_usuario
+        ]
+        print(json.dumps({
+            'segundos': total,
+            'entregas': len(lista),
+            'reenvios': sum(1 for tipo, _, _ in lista if tipo == 'reenvio'),
+            'acuses_200': sum(1 for _, status in resultados if status == 200),
+            'acuse_p50_ms': percentil(acuses, 0.5),
+            'acuse_p99_ms': percentil(acuses, 0.99),
+            'e2e_p50_ms': percentil(extremo_a_extremo, 0.5),
+            'e2e_p99_ms': percentil(extremo_a_extremo, 0.99),
+            'usuarios_respondidos': len(extremo_a_extremo),
+            'envios': stub.peticiones,
+            'respuestas_429': stub.respuestas_429,
+            'duplicados_ignorados': aplicacion.deduplicador.estadisticas()['aciertos'],
+            'filas_log': filas_log,
+        }))
+        os._exit(0) # Sin esperar el drenado de hilos del servidor
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--entregas", type=int, default=1000)
+    parser.add_argument("--concurrencia", type=int, default=32)
+    parser.add_argument("--latencia", type=float, default=0.02, help="Segundos por llamada al stub de Graph")
+    parser.add_argument("--tasa-429", type=float, default=0.02, help="Fracción de llamadas que responden 429")
+    parser.add_argument("--modo", action="append", choices=("flask", "asgi"), dest="modos")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--hijo", choices=("flask", "asgi"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.hijo:
+        correr_hijo(args.hijo, args.entregas, args.concurrencia, args.latencia, args.tasa_429, args.semilla)
+        return
+
+    with tempfile.TemporaryDirectory() as directorio:
+        for modo in args.modos or ["flask"]:
+            env = dict(
+                os.environ,
+                DATABASE_URL=f"sqlite:///{os.path.join(directorio, modo + '.db')}",
+                META_WHATSAPP_ACCESS_TOKEN="token",
+                API_WHATSAPP_VERSION="v22.0",
+                META_WHATSAPP_PHONE_NUMBER_ID="123456",
+                META_WHATSAPP_APP_SECRET=SECRETO,
+                # Sin límite de tasa efectivo: se mide el servidor, no la cubeta de tokens
+                GRAPH_TASA_MENSAJES="100000",
+                GRAPH_RAFAGA_MENSAJES="100000",
+            )
+            salida = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--hijo", modo,
+                 "--entregas", str(args.entregas), "--concurrencia", str(args.concurrencia),
+                 "--latencia", str(args.latencia), "--tasa-429", str(args.tasa_429),
+                 "--semilla", str(args.semilla)],
+                env=env, capture_output=True, text=True, cwd=directorio
+            )
+            if salida.returncode != 0:
+                print(f"{modo}: error\n{salida.stderr}")
+                continue
+            r = json.loads(salida.stdout.strip().splitlines()[-1])
+            print(f"{modo}: {r['entregas']} entregas ({r['reenvios']} reenvíos) en {r['segundos']:.2f}s   "
+                  f"{r['entregas'] / r['segundos']:.1f} entregas/s   acuses 200: {r['acuses_200']}")
+            print(f"  acuse        p50 {r['acuse_p50_ms']:8.2f} ms   p99 {r['acuse_p99_ms']:8.2f} ms")
+            print(f"  extremo a extremo p50 {r['e2e_p50_ms']:8.2f} ms   p99 {r['e2e_p99_ms']:8.2f} ms   "
+                  f"({r['usuarios_respondidos']} usuarios)")
+            print(f"  envíos {r['envios']} ({r['envios'] / r['segundos']:.1f}/s)   429 inyectados {r['respuestas_429']}   "
+                  f"duplicados ignorados {r['duplicados_ignorados']}   filas de log {r['filas_log']}")
+
+
+if __name__ == "__main__":
+    main()
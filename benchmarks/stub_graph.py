@@ -0,0 +1,130 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#_______________________________________________________________________________________
+"""
+Servidor Graph API local (HTTP, keep-alive) para medir latencias y reutilización
+de conexiones sin salir a la red.
+-latencia: segundos de espera simulada por petición.
+-tasa_429: fracción de peticiones que responden 429 con Retry-After.
+Registra conexiones abiertas, peticiones y los cuerpos recibidos.
+También imita /media: las subidas retornan un id, GET /<version>/<id> retorna la URL de
+descarga y esa URL sirve los bytes guardados en `archivos` (media_id -> bytes).
+"""
+#_______________________________________________________________________________________
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Necesario para keep-alive
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.stub._contar('conexiones')
+
+    def log_message(self, format, *args):
+        pass # Silenciar el log por petición del servidor de pruebas
+
+    def _responder(self, status, cuerpo, headers=None):
+        datos = json.dumps(cuerpo).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(datos)))
+        for clave, valor in (headers or {}).items():
+            self.send_header(clave, valor)
+        self.end_headers()
+        self.wfile.write(datos)
+
+    def do_POST(self):
+        stub = self.server.stub
+        largo = int(self.headers.get("Content-Length", 0))
+        cuerpo = self.rfile.read(largo)
+        if stub.latencia:
+            time.sleep(stub.latencia)
+        if stub.tasa_429 and random.random() < stub.tasa_429:
+            stub._contar('respuestas_429')
+            self._responder(429, {"error": {"code": 4, "message": "rate limit"}}, {"Retry-After": "0"})
+            return
+        stub._registrar(self.path, cuerpo)
+        self._responder(200, stub.respuesta(self.path, cuerpo))
+
+    def do_GET(self):
+        stub = self.server.stub
+        if stub.latencia:
+            time.sleep(stub.latencia)
+        if self.path.startswith("/archivos/"):
+            datos = stub.archivos.get(self.path[len("/archivos/"):])
+            if datos is None:
+                self._responder(404, {"error": {"message": "not found"}})
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(datos)))
+            self.end_headers()
+            self.wfile.write(datos)
+            return
+        stub._registrar(self.path, b"")
+        self._responder(200, stub.respuesta(self.path, b""))
+
+
+class _Servidor(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024 # Con el backlog por defecto (5) se pierden conexiones bajo concurrencia
+
+
+class StubGraph:
+    """Servidor Graph falso que corre en un hilo; usar como context manager."""
+
+    def __init__(self, latencia=0.0, tasa_429=0.0, host="127.0.0.1", port=0):
+        self.latencia = latencia
+        self.tasa_429 = tasa_429
+        self._servidor = _Servidor((host, port), _Handler)
+        self._servidor.stub = self
+        self._lock = threading.Lock()
+        self._hilo = None
+        self.conexiones = 0
+        self.peticiones = 0
+        self.respuestas_429 = 0
+        self.recibidos = []
+        self.archivos = {}
+
+    @property
+    def url(self):
+        host, port = self._servidor.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _contar(self, campo):
+        with self._lock:
+            setattr(self, campo, getattr(self, campo) + 1)
+
+    def _registrar(self, path, cuerpo):
+        with self._lock:
+            self.peticiones += 1
+            self.recibidos.append((path, cuerpo))
+
+    def respuesta(self, path, cuerpo):
+        """Cuerpo JSON que responde el servidor; por defecto imita /messages y /media."""
+        if path.endswith("/media"):
+            return {"id": f"media.stub{self.peticiones}"}
+        if not cuerpo and not path.endswith("/messages"):
+            media_id = path.rstrip("/").rsplit("/", 1)[-1]
+            return {"url": f"{self.url}/archivos/{media_id}", "id": media_id}
+        return {"messaging_product": "whatsapp", "messages": [{"id": f"wamid.stub{self.peticiones}"}]}
+
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self._servidor.serve_forever, daemon=True)
+        self._hilo.start()
+        return self
+
+    def detener(self):
+        self._servidor.shutdown()
+        self._servidor.server_close()
+
+    def __enter__(self):
+        return self.iniciar()
+
+    def __exit__(self, *exc):
+        self.detener()
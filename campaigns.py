@@ -0,0 +1,119 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from graph_client import PeticionNoEnviada
+
+#_______________________________________________________________________________________
+"""
+Envío masivo de campañas (un mensaje a miles de destinatarios).
+
+-Los destinatarios se leen de la DB por lotes (keyset por teléfono), sin cargarlos todos.
+-Cada lote se envía por tramos (tantos destinatarios como hilos) en paralelo, respetando el
+límite de tasa del número emisor (una cubeta de tokens, como las respuestas del bot).
+-Estado por destinatario: pendiente -> enviando -> enviado | fallido.
+-Reanudable sin envíos dobles: cada tramo se reclama (pasa de 'pendiente' a 'enviando' y se
+confirma en la DB) justo antes de enviarlo y solo se envían los que este proceso reclamó,
+y la API Graph no reintenta un POST que pudo haber llegado. Tras
+una caída, al reanudar solo se toman los 'pendiente'. Los que quedaron en 'enviando' (a lo
+sumo un tramo por caída, más los envíos sin respuesta o con 5xx) pudieron haberse enviado o
+no, así que no se reenvían solos: se reportan como inciertos y se reintentan solo si se pide.
+-'fallido' es seguro de reintentar: la petición no salió o Graph la rechazó (4xx, 429).
+"""
+#_______________________________________________________________________________________
+
+PENDIENTE = 'pendiente'
+ENVIANDO = 'enviando'
+ENVIADO = 'enviado'
+FALLIDO = 'fallido'
+
+
+class EjecutorCampana:
+    """Recorre los destinatarios pendientes de una campaña por lotes y los envía en paralelo."""
+
+    def __init__(self, obtener_pendientes, reclamar, marcar, enviar, limitador, phone_number_id, num_hilos=8,
+                 tamano_lote=500, tamano_tramo=None):
+        self.obtener_pendientes = obtener_pendientes # obtener_pendientes(despues_de, limite) -> [telefono, ...] ordenados
+        self.reclamar = reclamar # reclamar([telefono, ...]) -> los que pasaron de 'pendiente' a 'enviando' en esta llamada
+        self.marcar = marcar # marcar([{'telefono_usuario_id', 'estado', 'wamid', 'error'}, ...]) persiste el tramo
+        self.enviar = enviar # enviar(telefono) -> RespuestaGraph; PeticionNoEnviada si no llegó a salir
+        self.limitador = limitador
+        self.phone_number_id = phone_number_id
+        self.num_hilos = num_hilos
+        self.tamano_lote = tamano_lote
+        self.tamano_tramo = tamano_tramo or num_hilos # Máximo de destinatarios inciertos tras una caída
+        self._detener = threading.Event()
+        self.enviados = 0
+        self.fallidos = 0
+        self.inciertos = 0
+        self.lotes = 0
+        self.segundos = 0.0
+
+    def detener(self):
+        """Pide terminar después del lote en curso (el resto queda 'pendiente')."""
+        self._detener.set()
+
+    def _enviar_uno(self, telefono_id):
+        self.limitador.esperar(self.phone_number_id)
+        try:
+            respuesta = self.enviar(telefono_id)
+        except PeticionNoEnviada as e:
+            return {'telefono_usuario_id': telefono_id, 'estado': FALLIDO, 'wamid': None, 'error': f"no enviado: {e}"}
+        except Exception as e:
+            # Timeout o conexión cortada después de escribir la petición: pudo haber llegado
+            logging.warning(f"Envío de campaña a {telefono_id} sin respuesta: {e}")
+            return {'telefono_usuario_id': telefono_id, 'estado': ENVIANDO, 'wamid': None, 'error': f"sin respuesta: {e}"}
+        if not respuesta.ok:
+            error = f"{respuesta.status} {respuesta.body[:200].decode('utf-8', 'replace')}"
+            # Un 5xx no garantiza que Graph no lo haya procesado: queda incierto
+            estado = ENVIANDO if respuesta.status >= 500 else FALLIDO
+            return {'telefono_usuario_id': telefono_id, 'estado': estado, 'wamid': None, 'error': error}
+        try:
+            wamid = json.loads(respuesta.body)['messages'][0]['id']
+        except (ValueError, KeyError, IndexError):
+            wamid = None
+        return {'telefono_usuario_id': telefono_id, 'estado': ENVIADO, 'wamid': wamid, 'error': None}
+
+    def ejecutar(self):
+        """Envía hasta que no queden pendientes o se llame a detener(). Retorna las estadísticas."""
+        inicio = time.perf_counter()
+        despues_de = ''
+        with ThreadPoolExecutor(max_workers=self.num_hilos, thread_name_prefix='campana') as ejecutor:
+            while not self._detener.is_set():
+                lote = self.obtener_pendientes(despues_de, self.tamano_lote)
+                if not lote:
+                    break
+                for inicio_tramo in range(0, len(lote), self.tamano_tramo):
+                    if self._detener.is_set():
+                        break
+                    # Punto de control: confirmado en la DB justo antes de enviar el tramo; los que
+                    # ya no estaban 'pendiente' (los tomó otro proceso) no se envían
+                    tramo = self.reclamar(lote[inicio_tramo:inicio_tramo + self.tamano_tramo])
+                    if not tramo:
+                        continue
+                    resultados = list(ejecutor.map(self._enviar_uno, tramo))
+                    self.marcar(resultados)
+                    for resultado in resultados:
+                        if resultado['estado'] == ENVIADO:
+                            self.enviados += 1
+                        elif resultado['estado'] == FALLIDO:
+                            self.fallidos += 1
+                        else:
+                            self.inciertos += 1
+                self.lotes += 1
+                despues_de = lote[-1]
+                logging.info("Campaña: lote de %s (%s enviados en total)", len(lote), self.enviados)
+        self.segundos = time.perf_counter() - inicio
+        return self.estadisticas()
+
+    def estadisticas(self):
+        return {
+            'enviados': self.enviados,
+            'fallidos': self.fallidos,
+            'inciertos': self.inciertos,
+            'lotes': self.lotes,
+            'segundos': round(self.segundos, 3),
+            'envios_por_segundo': round(self.enviados / self.segundos, 1) if self.segundos else None,
+        }
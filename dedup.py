@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import OrderedDict
+
+#_______________________________________________________________________________________
+"""
+Deduplicación de mensajes entrantes por id de WhatsApp (message['id']).
+
+Meta reenvía un evento cuando el acuse tarda o falla; sin esta capa cada reenvío
+repetía todo el flujo y todas las respuestas.
+-En memoria: conjunto LRU con TTL de ids vistos recientemente (consulta O(1), sin DB).
+-Persistencia: los ids nuevos se entregan a `persistir(id)` y al arrancar se recargan
+con `cargar()`, para que un reinicio no vuelva a procesar reenvíos.
+-Contadores de aciertos (duplicados) y fallos (mensajes nuevos).
+"""
+#_______________________________________________________________________________________
+
+
+class Deduplicador:
+    """Conjunto LRU con TTL de ids de mensajes ya procesados."""
+
+    def __init__(self, ttl=86400, max_ids=100000, persistir=None):
+        self.ttl = ttl
+        self.max_ids = max_ids
+        self.persistir = persistir
+        self._vistos = OrderedDict() # id -> momento (epoch) en que se vio
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def _purgar(self, ahora):
+        # Los ids están en orden de llegada: se eliminan desde el más antiguo
+        while self._vistos:
+            message_id, visto = next(iter(self._vistos.items()))
+            if ahora - visto <= self.ttl and len(self._vistos) <= self.max_ids:
+                break
+            self._vistos.popitem(last=False)
+
+    def cargar(self, ids_con_fecha):
+        """Carga ids ya procesados como pares (id, epoch), por ejemplo desde la tabla persistente."""
+        ahora = time.time()
+        with self._lock:
+            for message_id, visto in sorted(ids_con_fecha, key=lambda par: par[1]):
+                if ahora - visto <= self.ttl:
+                    self._vistos[message_id] = visto
+            self._purgar(ahora)
+
+    def es_duplicado(self, message_id):
+        """Retorna True si el id ya se vio; si es nuevo lo marca como visto (consulta y alta atómicas)."""
+        ahora = time.time()
+        with self._lock:
+            visto = self._vistos.get(message_id)
+            if visto is not None and ahora - visto <= self.ttl:
+                self.aciertos += 1
+                return True
+            self._vistos[message_id] = ahora
+            self._vistos.move_to_end(message_id)
+            self.fallos += 1
+            self._purgar(ahora)
+            return False
+
+    def olvidar(self, message_id):
+        """Desmarca un id (p. ej. si no se pudo encolar y Meta debe reintentarlo)."""
+        with self._lock:
+            self._vistos.pop(message_id, None)
+
+    def confirmar(self, message_id):
+        """Persiste un id ya aceptado para procesar."""
+        if self.persistir:
+            self.persistir(message_id)
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'ids_en_memoria': len(self._vistos),
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+            }
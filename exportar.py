@@ -0,0 +1,147 @@
+import csv
+import json
+import logging
+import os
+from io import StringIO
+from urllib.parse import quote
+
+#_______________________________________________________________________________________
+"""
+Exportación masiva del log de conversaciones (reemplaza la copia por mensaje a Google Sheets).
+
+-Las filas llegan de un cursor del lado del servidor y se convierten a CSV o JSONL por
+bloques, así la memoria no depende del tamaño del log.
+-Modo incremental: se exporta desde la última fila exportada (punto de control 'fecha|id' en
+un archivo), para que una tarea programada sincronice por lotes en lugar de mensaje por mensaje.
+Los ids no se confirman en orden cuando escriben varios procesos (workers de gunicorn, la CLI de
+campañas) sobre PostgreSQL, así que el punto de control es la fecha del registro y solo se
+exportan los registros con más de EXPORTAR_RETRASO segundos: se asume que un registro se confirma
+en la DB antes de ese retraso (el escritor de log escribe cada fracción de segundo).
+-SubidorSheets agrega las filas a una hoja de Google Sheets con values:append, en lotes y
+con la URL base configurable para probarlo contra un servidor local.
+"""
+#_______________________________________________________________________________________
+
+COLUMNAS_EXPORTACION = (
+    'id', 'fecha_y_hora', 'telefono_usuario_id', 'plataforma', 'mensaje', 'estado_usuario', 'etiqueta_campana', 'agente'
+)
+
+
+def _valor(valor):
+    return valor.isoformat() if hasattr(valor, 'isoformat') else valor
+
+
+def filas_a_csv(filas, columnas=COLUMNAS_EXPORTACION, filas_por_bloque=500):
+    """Genera el CSV (con encabezado) en bloques de texto de `filas_por_bloque` filas."""
+    buffer = StringIO()
+    escritor = csv.writer(buffer)
+    escritor.writerow(columnas)
+    pendientes = 0
+    for fila in filas:
+        escritor.writerow([_valor(valor) for valor in fila])
+        pendientes += 1
+        if pendientes >= filas_por_bloque:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            pendientes = 0
+    yield buffer.getvalue()
+
+
+def filas_a_jsonl(filas, columnas=COLUMNAS_EXPORTACION, filas_por_bloque=500):
+    """Genera un objeto JSON por línea, en bloques de `filas_por_bloque` filas."""
+    bloque = []
+    for fila in filas:
+        bloque.append(json.dumps(dict(zip(columnas, map(_valor, fila))), ensure_ascii=False))
+        if len(bloque) >= filas_por_bloque:
+            yield '\n'.join(bloque) + '\n'
+            bloque = []
+    if bloque:
+        yield '\n'.join(bloque) + '\n'
+
+
+# formato -> (generador, tipo MIME)
+FORMATOS = {
+    'csv': (filas_a_csv, 'text/csv; charset=utf-8'),
+    'jsonl': (filas_a_jsonl, 'application/x-ndjson; charset=utf-8'),
+}
+
+
+def cursor_de_fila(fila):
+    """Punto de control 'fecha_iso|id' de una fila exportada (mismo formato que el cursor del dashboard)."""
+    return f"{fila[1].isoformat()}|{fila[0]}"
+
+
+def leer_punto_control(ruta):
+    """Punto de control guardado en `ruta` ('' si no existe)."""
+    try:
+        with open(ruta) as archivo:
+            return archivo.read().strip()
+    except FileNotFoundError:
+        return ''
+
+
+def guardar_punto_control(ruta, cursor):
+    """Guarda el punto de control; se escribe en un temporal y se reemplaza para no dejarlo a medias."""
+    temporal = f"{ruta}.tmp"
+    with open(temporal, 'w') as archivo:
+        archivo.write(cursor)
+    os.replace(temporal, ruta)
+
+
+class SubidorSheets:
+    """Agrega filas a una hoja de Google Sheets en lotes (una petición values:append por lote)."""
+
+    def __init__(self, cliente, spreadsheet_id, rango, token, tamano_lote=500):
+        self.cliente = cliente # GraphClient apuntando a la API de Sheets (pool keep-alive y reintentos)
+        self.ruta = (f"/v4/spreadsheets/{spreadsheet_id}/values/{quote(rango, safe='')}:append"
+                     "?valueInputOption=RAW&insertDataOption=INSERT_ROWS")
+        self.token = token
+        self.tamano_lote = tamano_lote
+        self.filas_subidas = 0
+        self.lotes = 0
+
+    def subir(self, filas, al_confirmar=None):
+        """
+        Sube las filas en lotes. Tras cada lote aceptado se llama `al_confirmar(ultima_fila)`
+        (p. ej. para guardar el punto de control). Retorna el número de filas subidas.
+        """
+        lote = []
+        for fila in filas:
+            lote.append(fila)
+            if len(lote) >= self.tamano_lote:
+                self._subir_lote(lote, al_confirmar)
+                lote = []
+        if lote:
+            self._subir_lote(lote, al_confirmar)
+        return self.filas_subidas
+
+    def _subir_lote(self, lote, al_confirmar):
+        cuerpo = json.dumps({'values': [[_valor(valor) for valor in fila] for fila in lote]}, ensure_ascii=False)
+        respuesta = self.cliente.post_json(self.ruta, cuerpo, self.token)
+        if not respuesta.ok:
+            # Se detiene sin avanzar el punto de control: la siguiente ejecución reintenta este lote
+            raise RuntimeError(f"Sheets respondió {respuesta.status} {respuesta.reason}: {respuesta.body[:200]!r}")
+        self.filas_subidas += len(lote)
+        self.lotes += 1
+        logging.info("Lote de %s filas subido a Sheets (%s en total)", len(lote), self.filas_subidas)
+        if al_confirmar:
+            al_confirmar(lote[-1])
+
+
+def token_sheets():
+    """
+    Token de acceso para la API de Sheets: SHEETS_TOKEN si está definido, si no se obtiene
+    con la cuenta de servicio de GOOGLE_CREDENTIALS_JSON (requiere google-auth).
+    """
+    if os.getenv('SHEETS_TOKEN'):
+        return os.environ['SHEETS_TOKEN']
+    from google.oauth2.service_account import Credentials
+    from google.auth.transport.requests import Request
+
+    credenciales = Credentials.from_service_account_info(
+        json.load(StringIO(os.environ['GOOGLE_CREDENTIALS_JSON'])),
+        scopes=['https://www.googleapis.com/auth/spreadsheets'],
+    )
+    credenciales.refresh(Request())
+    return credenciales.token
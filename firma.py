@@ -0,0 +1,44 @@
+import hashlib
+import hmac
+
+#_______________________________________________________________________________________
+"""
+Verificación de la firma X-Hub-Signature-256 de los POST del webhook de Meta.
+
+Meta firma el cuerpo crudo con HMAC-SHA256 usando el App Secret. Sin esta verificación
+cualquiera puede hacer que el bot envíe mensajes y escriba en la DB.
+-Se verifica sobre los bytes recibidos, antes de parsear el JSON.
+-Comparación en tiempo constante (hmac.compare_digest).
+-Rechazo barato: sin encabezado o con formato incorrecto no se calcula el HMAC.
+-La clave se procesa una sola vez; cada petición copia el estado HMAC ya inicializado.
+"""
+#_______________________________________________________________________________________
+
+PREFIJO = 'sha256='
+LARGO_ENCABEZADO = len(PREFIJO) + 64 # 'sha256=' + 32 bytes en hexadecimal
+HEXADECIMAL = frozenset('0123456789abcdefABCDEF')
+
+
+class VerificadorFirma:
+    """Verifica X-Hub-Signature-256 con el App Secret; sin secreto queda inactivo."""
+
+    def __init__(self, secreto):
+        self._base = hmac.new(secreto.encode('utf-8'), digestmod=hashlib.sha256) if secreto else None
+
+    @property
+    def activo(self):
+        return self._base is not None
+
+    def motivo_rechazo(self, cuerpo, encabezado):
+        """Retorna None si la firma es válida, o el motivo del rechazo ('sin_firma', 'formato', 'firma_invalida')."""
+        if not encabezado:
+            return 'sin_firma'
+        firma = encabezado[len(PREFIJO):]
+        # compare_digest no acepta texto no ASCII: un valor que no es hexadecimal se rechaza por formato
+        if len(encabezado) != LARGO_ENCABEZADO or not encabezado.startswith(PREFIJO) or not HEXADECIMAL.issuperset(firma):
+            return 'formato'
+        mac = self._base.copy()
+        mac.update(cuerpo)
+        if not hmac.compare_digest(mac.hexdigest(), firma.lower()):
+            return 'firma_invalida'
+        return None
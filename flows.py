@@ -0,0 +1,195 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from translations import MESSAGES, get_message
+
+#_______________________________________________________________________________________
+"""
+Máquina de estados de la conversación definida en un archivo JSON (flows.json).
+
+Reemplaza la cadena de if/elif de procesar_y_responder_mensaje:
+-pasos: cada paso es la lista de respuestas a enviar (text, image o button con sus botones).
+-disparadores: mensaje recibido (en minúsculas) o id de botón -> paso, válidos en cualquier estado.
+-transiciones: {paso_actual: {disparador: paso}}, tienen prioridad sobre los disparadores globales.
+-paso_por_defecto: paso cuando el mensaje no coincide con ningún disparador.
+-cambio_idioma: mensaje -> idioma; cambia el idioma del usuario y reinicia en paso_por_defecto.
+
+Al cargar se valida y se compila una tabla (paso_actual, disparador) -> paso para
+resolver cada mensaje en O(1), y las respuestas de cada paso se resuelven por idioma
+una sola vez. El archivo se recarga en caliente cuando cambia (sin reiniciar).
+"""
+#_______________________________________________________________________________________
+
+TIPOS_RESPUESTA = ('text', 'image', 'button')
+MAX_BOTONES = 3 # Límite de botones de respuesta de WhatsApp
+MAX_TITULO_BOTON = 20 # Límite de caracteres del título de un botón
+
+
+class Flujo:
+    """Definición de flujo ya validada y compilada."""
+
+    def __init__(self, definicion):
+        self._validar_tipos(definicion)
+        self.etiqueta_campana = definicion.get('etiqueta_campana')
+        self.paso_por_defecto = definicion['paso_por_defecto']
+        pasos = definicion['pasos']
+        self._validar(definicion, pasos)
+
+        # Tabla de despacho: (paso_actual o None para global, disparador) -> paso
+        self._tabla = {}
+        for disparador, paso in definicion.get('disparadores', {}).items():
+            self._tabla[(None, disparador.lower())] = paso
+        for paso_actual, reglas in definicion.get('transiciones', {}).items():
+            for disparador, paso in reglas.items():
+                self._tabla[(paso_actual, disparador.lower())] = paso
+
+        self._cambio_idioma = {
+            mensaje.lower(): lang for mensaje, lang in definicion.get('cambio_idioma', {}).items()
+        }
+
+        # Respuestas resueltas por (paso, idioma): (tipo, texto, titulos_botones, ids_botones)
+        self._respuestas = {}
+        for nombre, respuestas in pasos.items():
+            for lang in MESSAGES:
+                self._respuestas[(nombre, lang)] = [
+                    (
+                        respuesta['tipo'],
+                        get_message(lang, respuesta['mensaje']),
+                        [boton['titulo'].get(lang, boton['titulo']['en']) for boton in respuesta.get('botones', [])] or None,
+                        [boton['id'] for boton in respuesta.get('botones', [])] or None,
+                    )
+                    for respuesta in respuestas
+                ]
+        self.pasos = tuple(pasos)
+
+    @staticmethod
+    def _validar_tipos(definicion):
+        """Valida la estructura del JSON (objetos, listas y textos) antes de recorrerlo."""
+        def exigir(valor, tipo, donde):
+            if not isinstance(valor, tipo):
+                raise ValueError(f"{donde} debe ser {'un objeto' if tipo is dict else 'una lista' if tipo is list else 'un texto'}")
+        exigir(definicion, dict, "El flujo")
+        exigir(definicion.get('paso_por_defecto'), str, "paso_por_defecto")
+        exigir(definicion.get('pasos'), dict, "pasos")
+        for clave in ('disparadores', 'cambio_idioma'):
+            exigir(definicion.get(clave, {}), dict, clave)
+            for destino in definicion.get(clave, {}).values():
+                exigir(destino, str, f"Cada valor de {clave}")
+        exigir(definicion.get('transiciones', {}), dict, "transiciones")
+        for paso_actual, reglas in definicion.get('transiciones', {}).items():
+            exigir(reglas, dict, f"transiciones['{paso_actual}']")
+            for destino in reglas.values():
+                exigir(destino, str, f"Cada destino de transiciones['{paso_actual}']")
+        for nombre, respuestas in definicion['pasos'].items():
+            exigir(respuestas, list, f"El paso '{nombre}'")
+            for respuesta in respuestas:
+                exigir(respuesta, dict, f"Cada respuesta de '{nombre}'")
+                exigir(respuesta.get('botones', []), list, f"Los botones de '{nombre}'")
+                for boton in respuesta.get('botones', []):
+                    exigir(boton, dict, f"Cada botón de '{nombre}'")
+                    exigir(boton.get('id'), str, f"El id de un botón de '{nombre}'")
+                    exigir(boton.get('titulo'), dict, f"El título de un botón de '{nombre}'")
+                    for titulo in boton['titulo'].values():
+                        exigir(titulo, str, f"Cada título de un botón de '{nombre}'")
+
+    @staticmethod
+    def _validar(definicion, pasos):
+        referenciados = [definicion['paso_por_defecto']]
+        referenciados += definicion.get('disparadores', {}).values()
+        for paso_actual, reglas in definicion.get('transiciones', {}).items():
+            referenciados += [paso_actual, *reglas.values()]
+        for paso in referenciados:
+            if paso not in pasos:
+                raise ValueError(f"Paso no definido: {paso}")
+        for mensaje, lang in definicion.get('cambio_idioma', {}).items():
+            if lang not in MESSAGES:
+                raise ValueError(f"Idioma no definido en translations para '{mensaje}': {lang}")
+        for nombre, respuestas in pasos.items():
+            for respuesta in respuestas:
+                if respuesta.get('tipo') not in TIPOS_RESPUESTA:
+                    raise ValueError(f"Tipo de respuesta no soportado en '{nombre}': {respuesta.get('tipo')}")
+                if respuesta.get('mensaje') not in MESSAGES['en']:
+                    raise ValueError(f"Mensaje no definido en translations en '{nombre}': {respuesta.get('mensaje')}")
+                botones = respuesta.get('botones', [])
+                if respuesta['tipo'] == 'button' and not 0 < len(botones) <= MAX_BOTONES:
+                    raise ValueError(f"Los botones en '{nombre}' deben ser entre 1 y {MAX_BOTONES}")
+                for boton in botones:
+                    if 'id' not in boton or 'en' not in boton.get('titulo', {}):
+                        raise ValueError(f"Botón sin id o sin título en inglés en '{nombre}'")
+                    if any(len(titulo) > MAX_TITULO_BOTON for titulo in boton['titulo'].values()):
+                        raise ValueError(f"Título de botón de más de {MAX_TITULO_BOTON} caracteres en '{nombre}'")
+
+    def resolver(self, paso_actual, mensaje_procesado):
+        """Retorna el siguiente paso para el mensaje recibido (ya en minúsculas)."""
+        return (
+            self._tabla.get((paso_actual, mensaje_procesado))
+            or self._tabla.get((None, mensaje_procesado))
+            or self.paso_por_defecto
+        )
+
+    def idioma_para(self, mensaje_procesado):
+        """Retorna el idioma si el mensaje es una solicitud de cambio de idioma, o None."""
+        return self._cambio_idioma.get(mensaje_procesado)
+
+    def respuestas(self, paso, lang):
+        """Lista de (tipo, texto, titulos_botones, ids_botones) del paso en el idioma dado."""
+        return self._respuestas.get((paso, lang)) or self._respuestas[(paso, 'en')]
+
+    def todas_las_respuestas(self):
+        """Todas las respuestas de todos los pasos e idiomas (para precargar plantillas)."""
+        for respuestas in self._respuestas.values():
+            yield from respuestas
+
+
+class MotorFlujo:
+    """Mantiene el flujo vigente y lo recarga cuando cambia el archivo."""
+
+    def __init__(self, ruta, intervalo_revision=5.0, al_cargar=None):
+        self.ruta = ruta
+        self.intervalo_revision = intervalo_revision
+        self.al_cargar = al_cargar # Función que recibe cada flujo nuevo (p. ej. para precargar plantillas)
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._proxima_revision = 0.0
+        self._flujo = None
+        self.recargas = 0
+        self.recargar()
+
+    def recargar(self):
+        """Carga y compila el archivo; si es inválido se conserva el flujo anterior."""
+        with self._lock:
+            try:
+                mtime = os.path.getmtime(self.ruta)
+                with open(self.ruta, encoding='utf-8') as archivo:
+                    flujo = Flujo(json.load(archivo))
+                if self.al_cargar:
+                    self.al_cargar(flujo)
+            except Exception as e:
+                # Al arrancar el error se propaga; en una recarga en caliente nunca llega al mensaje en curso
+                if self._flujo is None:
+                    raise
+                logging.error(f"Flujo inválido en {self.ruta}, se mantiene el anterior: {e!r}")
+                return False
+            self._flujo = flujo
+            self._mtime = mtime
+            self.recargas += 1
+            logging.info(f"Flujo cargado desde {self.ruta} ({len(flujo.pasos)} pasos)")
+            return True
+
+    @property
+    def flujo(self):
+        """Flujo vigente; revisa el archivo como máximo cada `intervalo_revision` segundos."""
+        ahora = time.monotonic()
+        if ahora >= self._proxima_revision:
+            self._proxima_revision = ahora + self.intervalo_revision
+            try:
+                mtime = os.path.getmtime(self.ruta)
+                if mtime != self._mtime:
+                    self._mtime = mtime # Si el archivo es inválido no se reintenta hasta el próximo cambio
+                    self.recargar()
+            except OSError as e:
+                logging.error(f"No se pudo revisar el archivo de flujo {self.ruta}: {e}")
+        return self._flujo
@@ -0,0 +1,342 @@
+import asyncio
+import http.client
+import logging
+import queue
+import random
+import select
+import ssl
+import threading
+import time
+from urllib.parse import urlsplit
+
+#_______________________________________________________________________________________
+"""
+Cliente HTTP reutilizable para la API Graph de Meta (WhatsApp Business).
+
+Antes se abría una conexión HTTPSConnection nueva por cada mensaje (handshake TCP+TLS
+completo por envío). Este cliente mantiene un pool de conexiones keep-alive:
+-Tamaño del pool y timeouts configurables.
+-Reintentos con backoff exponencial y jitter (respetando Retry-After). Un POST /messages no es
+idempotente: solo se reintenta si la petición seguro no salió (falla al conectar, o conexión
+keep-alive caída detectada antes de escribir) o si Graph respondió 429. Un timeout o un reset
+después de escribir la petición no se reintenta: el mensaje pudo haber llegado.
+-La URL base es configurable para apuntar a un servidor Graph local de pruebas.
+GraphClientAsync es la versión para asyncio (modo ASGI), con el mismo pool y reintentos
+sobre streams de asyncio, sin dependencias externas.
+"""
+#_______________________________________________________________________________________
+
+ESTADOS_REINTENTABLES = {429, 500, 502, 503, 504}
+METODOS_IDEMPOTENTES = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+
+class PeticionNoEnviada(OSError):
+    """La petición no llegó a escribirse en la conexión: se puede reintentar sin riesgo de duplicados."""
+
+
+def estados_reintentables(method):
+    """Un 429 garantiza que Graph no procesó la petición; un 5xx no, así que solo se reintenta si es idempotente."""
+    return ESTADOS_REINTENTABLES if method in METODOS_IDEMPOTENTES else {429}
+
+
+def espera_backoff(intento, base, maximo, retry_after=None):
+    """Segundos a esperar antes del reintento: Retry-After si viene, si no backoff exponencial con "full jitter"."""
+    if retry_after:
+        try:
+            return min(float(retry_after), maximo)
+        except ValueError:
+            pass
+    return random.uniform(0, min(maximo, base * (2 ** intento)))
+
+
+class RespuestaGraph:
+    """Resultado de una petición a la API Graph."""
+
+    def __init__(self, status, reason, body, intentos):
+        self.status = status
+        self.reason = reason
+        self.body = body
+        self.intentos = intentos
+
+    @property
+    def ok(self):
+        return 200 <= self.status < 300
+
+
+class GraphClient:
+    """Pool de conexiones keep-alive hacia la API Graph con reintentos."""
+
+    def __init__(self, base_url="https://graph.facebook.com", tamano_pool=10, timeout=10.0,
+                 max_reintentos=3, backoff_base=0.5, backoff_max=8.0):
+        partes = urlsplit(base_url)
+        self.https = partes.scheme != 'http'
+        self.host = partes.hostname
+        self.port = partes.port
+        self.prefijo = partes.path.rstrip('/')
+        self.timeout = timeout
+        self.max_reintentos = max_reintentos
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._pool = queue.LifoQueue(maxsize=tamano_pool)
+        self._lock = threading.Lock()
+        self.conexiones_creadas = 0
+        self.peticiones = 0
+        self.reintentos = 0
+        self.errores = 0
+
+    def _nueva_conexion(self):
+        clase = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        with self._lock:
+            self.conexiones_creadas += 1
+        return clase(self.host, self.port, timeout=self.timeout)
+
+    @staticmethod
+    def _conexion_caida(connection):
+        """Una conexión keep-alive ociosa que tiene algo para leer fue cerrada (EOF) por el servidor."""
+        if connection.sock is None:
+            return False
+        try:
+            legible, _, _ = select.select([connection.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(legible)
+
+    def _tomar_conexion(self):
+        while True:
+            try:
+                connection = self._pool.get_nowait()
+            except queue.Empty:
+                return self._nueva_conexion()
+            if not self._conexion_caida(connection):
+                return connection
+            connection.close()
+
+    def _devolver_conexion(self, connection):
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def _espera_backoff(self, intento, retry_after=None):
+        return espera_backoff(intento, self.backoff_base, self.backoff_max, retry_after)
+
+    def _enviar_una_vez(self, method, path, body, headers):
+        """Hace una petición reutilizando una conexión del pool (las caídas se descartan antes de escribir)."""
+        connection = self._tomar_conexion()
+        if connection.sock is None:
+            try:
+                connection.connect()
+            except OSError as e:
+                connection.close()
+                raise PeticionNoEnviada(f"No se pudo conectar con la API Graph: {e}") from e
+        try:
+            connection.request(method, self.prefijo + path, body, headers)
+            response = connection.getresponse()
+            contenido = response.read() # Leer todo el cuerpo para poder reutilizar la conexión
+        except Exception:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self._devolver_conexion(connection)
+        return response, contenido
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Envía una petición y retorna un RespuestaGraph. Reintenta si la petición no salió y ante 429;
+        los errores de red después de escribirla y los 5xx solo se reintentan en métodos idempotentes.
+        """
+        headers = headers or {}
+        idempotente = method in METODOS_IDEMPOTENTES
+        reintentables = estados_reintentables(method)
+        with self._lock:
+            self.peticiones += 1
+        intento = 0
+        while True:
+            try:
+                response, contenido = self._enviar_una_vez(method, path, body, headers)
+            except (OSError, http.client.HTTPException) as e:
+                if intento >= self.max_reintentos or not (idempotente or isinstance(e, PeticionNoEnviada)):
+                    with self._lock:
+                        self.errores += 1
+                    raise
+                espera = self._espera_backoff(intento)
+                logging.warning(f"Error de red con la API Graph ({e}), reintento en {espera:.2f}s")
+            else:
+                if response.status not in reintentables or intento >= self.max_reintentos:
+                    if response.status >= 400:
+                        with self._lock:
+                            self.errores += 1
+                    return RespuestaGraph(response.status, response.reason, contenido, intento + 1)
+                espera = self._espera_backoff(intento, response.getheader('Retry-After'))
+                logging.warning(f"API Graph respondió {response.status}, reintento en {espera:.2f}s")
+            with self._lock:
+                self.reintentos += 1
+            intento += 1
+            time.sleep(espera)
+
+    def post_json(self, path, data, token):
+        """Envía un cuerpo JSON ya serializado (str o bytes) con el token de acceso."""
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {token}"
+        }
+        if isinstance(data, str):
+            # En bytes, http.client envía cabeceras y cuerpo en un solo send() (evita Nagle + delayed ACK)
+            data = data.encode('utf-8')
+        return self.request("POST", path, data, headers)
+
+    def cerrar(self):
+        """Cierra todas las conexiones del pool."""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'conexiones_creadas': self.conexiones_creadas,
+                'conexiones_libres': self._pool.qsize(),
+                'peticiones': self.peticiones,
+                'reintentos': self.reintentos,
+                'errores': self.errores,
+            }
+
+
+class GraphClientAsync:
+    """Pool de conexiones keep-alive asíncrono (HTTP/1.1 sobre asyncio) hacia la API Graph."""
+
+    def __init__(self, base_url="https://graph.facebook.com", max_conexiones=100, timeout=10.0,
+                 max_reintentos=3, backoff_base=0.5, backoff_max=8.0):
+        partes = urlsplit(base_url)
+        self.https = partes.scheme != 'http'
+        self.host = partes.hostname
+        self.port = partes.port or (443 if self.https else 80)
+        self.prefijo = partes.path.rstrip('/')
+        self.timeout = timeout
+        self.max_reintentos = max_reintentos
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._ssl = ssl.create_default_context() if self.https else None
+        self._libres = [] # Conexiones (reader, writer) abiertas y sin uso
+        self._cupos = asyncio.Semaphore(max_conexiones)
+        self.conexiones_creadas = 0
+        self.peticiones = 0
+        self.reintentos = 0
+        self.errores = 0
+
+    async def _tomar_conexion(self):
+        while self._libres:
+            reader, writer = self._libres.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        self.conexiones_creadas += 1
+        try:
+            return await asyncio.wait_for(asyncio.open_connection(self.host, self.port, ssl=self._ssl), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise PeticionNoEnviada(f"No se pudo conectar con la API Graph: {e}") from e
+
+    async def _leer_respuesta(self, reader):
+        linea = await reader.readline()
+        if not linea:
+            raise ConnectionResetError("Conexión cerrada por la API Graph")
+        _, status, *reason = linea.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        headers = {}
+        while True:
+            linea = await reader.readline()
+            if linea in (b'\r\n', b'\n', b''):
+                break
+            clave, _, valor = linea.decode('latin-1').partition(':')
+            headers[clave.strip().lower()] = valor.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            partes = []
+            while True:
+                largo = int((await reader.readline()).split(b';')[0], 16)
+                if largo == 0:
+                    await reader.readline()
+                    break
+                partes.append(await reader.readexactly(largo))
+                await reader.readline()
+            contenido = b''.join(partes)
+        elif 'content-length' in headers:
+            contenido = await reader.readexactly(int(headers['content-length']))
+        else:
+            contenido = await reader.read()
+            headers['connection'] = 'close'
+        return int(status), (reason[0] if reason else ''), headers, contenido
+
+    async def _enviar_una_vez(self, method, path, body, headers):
+        async with self._cupos:
+            reader, writer = await self._tomar_conexion() # Las conexiones caídas se descartan antes de escribir
+            cabeceras = {'Host': self.host, 'Content-Length': str(len(body or b'')), **headers}
+            peticion = f"{method} {self.prefijo + path} HTTP/1.1\r\n" + ''.join(
+                f"{clave}: {valor}\r\n" for clave, valor in cabeceras.items()
+            ) + "\r\n"
+            try:
+                # Cabeceras y cuerpo en una sola escritura
+                writer.write(peticion.encode('latin-1') + (body or b''))
+                await asyncio.wait_for(writer.drain(), self.timeout)
+                respuesta = await asyncio.wait_for(self._leer_respuesta(reader), self.timeout)
+            except BaseException:
+                writer.close()
+                raise
+            if respuesta[2].get('connection', '').lower() == 'close':
+                writer.close()
+            else:
+                self._libres.append((reader, writer))
+            return respuesta
+
+    async def post_json(self, path, data, token):
+        """
+        Envía un cuerpo JSON ya serializado; reintenta solo ante 429 o si la petición no salió
+        (un POST con error después de escribirlo pudo haber llegado y no se repite).
+        """
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {token}"
+        }
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.peticiones += 1
+        intento = 0
+        while True:
+            try:
+                status, reason, respuesta_headers, contenido = await self._enviar_una_vez("POST", path, data, headers)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+                if intento >= self.max_reintentos or not isinstance(e, PeticionNoEnviada):
+                    self.errores += 1
+                    raise
+                espera = self._espera_backoff(intento)
+                logging.warning(f"Error de red con la API Graph ({e!r}), reintento en {espera:.2f}s")
+            else:
+                if status not in estados_reintentables("POST") or intento >= self.max_reintentos:
+                    if status >= 400:
+                        self.errores += 1
+                    return RespuestaGraph(status, reason, contenido, intento + 1)
+                espera = self._espera_backoff(intento, respuesta_headers.get('retry-after'))
+                logging.warning(f"API Graph respondió {status}, reintento en {espera:.2f}s")
+            self.reintentos += 1
+            intento += 1
+            await asyncio.sleep(espera)
+
+    def _espera_backoff(self, intento, retry_after=None):
+        return espera_backoff(intento, self.backoff_base, self.backoff_max, retry_after)
+
+    async def cerrar(self):
+        """Cierra todas las conexiones libres del pool."""
+        while self._libres:
+            _, writer = self._libres.pop()
+            writer.close()
+
+    def estadisticas(self):
+        return {
+            'conexiones_creadas': self.conexiones_creadas,
+            'conexiones_libres': len(self._libres),
+            'peticiones': self.peticiones,
+            'reintentos': self.reintentos,
+            'errores': self.errores,
+        }
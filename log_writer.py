@@ -0,0 +1,129 @@
+import logging
+import queue
+import threading
+import time
+
+#_______________________________________________________________________________________
+"""
+Escritor único del log de mensajes.
+
+Antes cada mensaje entrante o saliente abría su propio hilo, con su propio contexto
+de aplicación y su propio commit, y todos competían por el bloqueo de escritura de SQLite.
+Ahora los eventos van a una cola y un solo hilo los escribe por lotes:
+-El lote se escribe al llegar a `tamano_lote` eventos o cada `intervalo` segundos.
+-Al detener se vacía la cola antes de salir (flush en el apagado).
+-Contadores de eventos escritos, descartados (cola llena) y fallidos.
+"""
+#_______________________________________________________________________________________
+
+_FIN = object() # Marcador para detener el hilo escritor
+
+
+class EscritorLog:
+    """Hilo escritor que agrupa eventos de log y los guarda con `escribir_lote(lista_de_dicts)`."""
+
+    def __init__(self, escribir_lote, tamano_lote=100, intervalo=0.5, tamano_cola=10000):
+        self.escribir_lote = escribir_lote
+        self.tamano_lote = tamano_lote
+        self.intervalo = intervalo
+        self._cola = queue.Queue(maxsize=tamano_cola)
+        self._lock = threading.Lock()
+        self._hilo = None
+        self._cerrado = False
+        self.encolados = 0
+        self.escritos = 0
+        self.lotes = 0
+        self.descartados = 0
+        self.fallidos = 0
+
+    def iniciar(self):
+        with self._lock:
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._trabajar, name="escritor-log", daemon=True)
+                self._hilo.start()
+
+    def registrar(self, evento):
+        """Encola un evento (dict con las columnas del log); nunca bloquea al llamador."""
+        if self._cerrado:
+            self._contar('descartados')
+            return False
+        self.iniciar()
+        try:
+            self._cola.put_nowait(evento)
+        except queue.Full:
+            self._contar('descartados')
+            logging.warning("Cola del log llena, evento descartado")
+            return False
+        self._contar('encolados')
+        return True
+
+    def _contar(self, campo, cantidad=1):
+        with self._lock:
+            setattr(self, campo, getattr(self, campo) + cantidad)
+
+    def _escribir(self, lote):
+        try:
+            self.escribir_lote(lote)
+            self._contar('escritos', len(lote))
+            self._contar('lotes')
+        except Exception as e:
+            self._contar('fallidos', len(lote))
+            logging.error(f"Error escribiendo lote de {len(lote)} registros en el log: {e}")
+
+    def _trabajar(self):
+        terminar = False
+        while not terminar:
+            lote = []
+            limite = None
+            while len(lote) < self.tamano_lote:
+                espera = None if limite is None else limite - time.monotonic()
+                if espera is not None and espera <= 0:
+                    break
+                try:
+                    evento = self._cola.get(timeout=espera)
+                except queue.Empty:
+                    break
+                if evento is _FIN:
+                    terminar = True
+                    break
+                lote.append(evento)
+                if limite is None:
+                    # El intervalo se cuenta desde el primer evento del lote
+                    limite = time.monotonic() + self.intervalo
+            if lote:
+                self._escribir(lote)
+
+    def vaciar(self, timeout=5):
+        """Espera a que la cola quede vacía (útil en pruebas y antes de consultar el log)."""
+        limite = time.monotonic() + timeout
+        while time.monotonic() < limite:
+            with self._lock:
+                if self.encolados == self.escritos + self.fallidos:
+                    return True
+            time.sleep(0.01)
+        return False
+
+    def detener(self, timeout=10):
+        """Deja de aceptar eventos y escribe los pendientes antes de terminar el hilo."""
+        with self._lock:
+            if self._cerrado:
+                return
+            self._cerrado = True
+            hilo = self._hilo
+        if hilo is None:
+            return
+        self._cola.put(_FIN)
+        hilo.join(timeout)
+        if hilo.is_alive():
+            logging.warning(f"Escritor de log detenido con {self._cola.qsize()} eventos sin escribir")
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'pendientes': self._cola.qsize(),
+                'encolados': self.encolados,
+                'escritos': self.escritos,
+                'lotes': self.lotes,
+                'descartados': self.descartados,
+                'fallidos': self.fallidos,
+            }
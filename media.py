@@ -0,0 +1,212 @@
+import base64
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import threading
+import time
+import urllib.request
+import uuid
+
+#_______________________________________________________________________________________
+"""
+Archivos multimedia de WhatsApp.
+
+-Salientes: cada recurso configurado (p. ej. la imagen del saludo) se sube una sola vez al
+endpoint /media de la API Graph y se envía por `id`, así Meta no vuelve a descargar la URL
+de Cloudinary por cada usuario. Los ids vencen a los 30 días: CacheMedia los vuelve a subir
+antes de que venzan, en segundo plano; mientras no haya id vigente se envía el link.
+El id y su vencimiento se guardan (en la DB), así los demás procesos y los reinicios
+reutilizan el id vigente en lugar de volver a subir el archivo.
+-Entrantes: las imágenes, audios, videos y documentos que envían los usuarios se descargan
+a disco por bloques (sin cargar el archivo en memoria) y se verifica su sha256.
+"""
+#_______________________________________________________________________________________
+
+TIPOS_MEDIA = ('image', 'audio', 'video', 'document', 'sticker')
+
+
+def leer_recurso(origen, max_bytes=16 * 1024 * 1024, timeout=30):
+    """Lee un recurso local o http(s) y retorna (bytes, tipo_mime)."""
+    if origen.startswith(('http://', 'https://')):
+        with urllib.request.urlopen(origen, timeout=timeout) as respuesta:
+            datos = respuesta.read(max_bytes + 1)
+            tipo_mime = respuesta.headers.get_content_type()
+    else:
+        with open(origen, 'rb') as archivo:
+            datos = archivo.read(max_bytes + 1)
+        tipo_mime = mimetypes.guess_type(origen)[0] or 'application/octet-stream'
+    if len(datos) > max_bytes:
+        raise ValueError(f"El recurso {origen} supera {max_bytes} bytes")
+    return datos, tipo_mime
+
+
+def subir_media(cliente, ruta, token, origen, nombre=None):
+    """Sube un recurso al endpoint /media (multipart/form-data) y retorna el media id."""
+    datos, tipo_mime = leer_recurso(origen)
+    nombre = nombre or os.path.basename(origen.split('?', 1)[0]) or 'archivo'
+    limite = uuid.uuid4().hex
+    partes = []
+    for campo, valor in (('messaging_product', 'whatsapp'), ('type', tipo_mime)):
+        partes.append(f'--{limite}\r\nContent-Disposition: form-data; name="{campo}"\r\n\r\n{valor}\r\n'.encode())
+    partes.append(
+        f'--{limite}\r\nContent-Disposition: form-data; name="file"; filename="{nombre}"\r\n'
+        f'Content-Type: {tipo_mime}\r\n\r\n'.encode()
+    )
+    cuerpo = b''.join(partes) + datos + f'\r\n--{limite}--\r\n'.encode()
+    respuesta = cliente.request("POST", ruta, cuerpo, {
+        "Content-Type": f"multipart/form-data; boundary={limite}",
+        "Authorization": f"Bearer {token}",
+    })
+    if not respuesta.ok:
+        raise RuntimeError(f"Subida de {origen} rechazada: {respuesta.status} {respuesta.body[:200]!r}")
+    return json.loads(respuesta.body)['id']
+
+
+class CacheMedia:
+    """Media ids de los recursos subidos, con vencimiento y renovación anticipada."""
+
+    def __init__(self, subir, ttl=29 * 86400, margen=86400, al_actualizar=None, leer=None, guardar=None):
+        self.subir = subir # subir(origen) -> media id
+        self.ttl = ttl # Meta conserva los archivos 30 días; se usa un poco menos
+        self.margen = margen # Se renueva cuando falta menos que esto para el vencimiento
+        self.al_actualizar = al_actualizar # al_actualizar(origen, media_id) al tener un id nuevo
+        self.leer = leer # leer(origen) -> (media_id, vence) guardado, o None
+        self.guardar = guardar # guardar(origen, media_id, vence) tras cada subida
+        self._ids = {} # origen -> (media_id, vence)
+        self._lock = threading.Lock()
+        self.subidas = 0
+        self.reutilizadas = 0
+        self.fallidas = 0
+
+    def id_vigente(self, origen):
+        """Media id vigente del recurso, o None (no bloquea: el envío usa el link mientras tanto)."""
+        entrada = self._ids.get(origen)
+        if entrada is not None and time.time() < entrada[1]:
+            return entrada[0]
+        return None
+
+    def _guardado_vigente(self, origen):
+        if self.leer is None:
+            return None
+        try:
+            guardado = self.leer(origen)
+        except Exception as e:
+            logging.error(f"No se pudo leer el media id guardado de {origen}: {e}")
+            return None
+        if guardado is not None and time.time() < guardado[1] - self.margen:
+            return guardado
+        return None
+
+    def refrescar(self, origenes):
+        """
+        Usa el id guardado si sigue vigente; si no, sube el recurso. Los errores se registran
+        y se reintenta en la próxima llamada.
+        """
+        for origen in origenes:
+            entrada = self._ids.get(origen)
+            if entrada is not None and time.time() < entrada[1] - self.margen:
+                continue
+            guardado = self._guardado_vigente(origen)
+            if guardado is not None:
+                with self._lock:
+                    self._ids[origen] = guardado
+                    self.reutilizadas += 1
+                logging.info("Recurso %s con media id guardado %s", origen, guardado[0])
+                if self.al_actualizar:
+                    self.al_actualizar(origen, guardado[0])
+                continue
+            try:
+                media_id = self.subir(origen)
+            except Exception as e:
+                self.fallidas += 1
+                logging.error(f"No se pudo subir {origen} a /media: {e}")
+                continue
+            vence = time.time() + self.ttl
+            with self._lock:
+                self._ids[origen] = (media_id, vence)
+                self.subidas += 1
+            logging.info("Recurso %s subido a /media con id %s", origen, media_id)
+            if self.guardar:
+                try:
+                    self.guardar(origen, media_id, vence)
+                except Exception as e:
+                    logging.error(f"No se pudo guardar el media id de {origen}: {e}")
+            if self.al_actualizar:
+                self.al_actualizar(origen, media_id)
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'recursos': {origen: {'id': media_id, 'vence': round(vence - time.time())}
+                             for origen, (media_id, vence) in self._ids.items()},
+                'subidas': self.subidas,
+                'reutilizadas': self.reutilizadas,
+                'fallidas': self.fallidas,
+            }
+
+
+class DescargadorMedia:
+    """Descarga a disco, por bloques, los archivos multimedia recibidos."""
+
+    def __init__(self, obtener_url, directorio, tamano_bloque=64 * 1024, max_bytes=100 * 1024 * 1024, timeout=30):
+        self.obtener_url = obtener_url # obtener_url(media_id) -> (url, headers) de descarga
+        self.directorio = directorio
+        self.tamano_bloque = tamano_bloque
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.descargados = 0
+        self.bytes_descargados = 0
+        self.fallidos = 0
+
+    def descargar(self, media):
+        """
+        Descarga el archivo de un mensaje (el dict 'image', 'audio', 'document'... con 'id',
+        'mime_type' y 'sha256') y retorna la ruta en disco. Se escribe en un temporal y se
+        renombra al terminar, así nunca queda un archivo a medias con el nombre final.
+        """
+        media_id = media['id']
+        nombre = ''.join(c for c in media_id if c.isalnum() or c in '-_') # El id viene del webhook: sin rutas
+        extension = mimetypes.guess_extension(media.get('mime_type', '').split(';')[0].strip()) or ''
+        ruta = os.path.join(self.directorio, f"{nombre}{extension}")
+        temporal = f"{ruta}.parcial"
+        os.makedirs(self.directorio, exist_ok=True)
+        url, headers = self.obtener_url(media_id)
+        suma = hashlib.sha256()
+        total = 0
+        try:
+            peticion = urllib.request.Request(url, headers=headers)
+            with urllib.request.urlopen(peticion, timeout=self.timeout) as respuesta, open(temporal, 'wb') as archivo:
+                while True:
+                    bloque = respuesta.read(self.tamano_bloque)
+                    if not bloque:
+                        break
+                    total += len(bloque)
+                    if total > self.max_bytes:
+                        raise ValueError(f"El archivo {media_id} supera {self.max_bytes} bytes")
+                    suma.update(bloque)
+                    archivo.write(bloque)
+            # Meta envía el sha256 en hexadecimal o en base64 según la versión de la API
+            if media.get('sha256') and media['sha256'] not in (suma.hexdigest(), base64.b64encode(suma.digest()).decode()):
+                raise ValueError(f"sha256 del archivo {media_id} no coincide")
+            os.replace(temporal, ruta)
+        except Exception:
+            with self._lock:
+                self.fallidos += 1
+            if os.path.exists(temporal):
+                os.remove(temporal)
+            raise
+        with self._lock:
+            self.descargados += 1
+            self.bytes_descargados += total
+        return ruta
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'descargados': self.descargados,
+                'bytes': self.bytes_descargados,
+                'fallidos': self.fallidos,
+            }
@@ -0,0 +1,135 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+#_______________________________________________________________________________________
+"""
+Métricas del bot en formato de texto de Prometheus (ruta /metrics), sin dependencias.
+-Contador: total acumulado por combinación de etiquetas.
+-Histograma: distribución de tiempos por buckets, con suma y conteo.
+-Medidor: valor instantáneo leído con una función al momento de exportar
+(p. ej. la profundidad de una cola).
+"""
+#_______________________________________________________________________________________
+
+BUCKETS_SEGUNDOS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _etiquetas_texto(etiquetas):
+    if not etiquetas:
+        return ''
+    partes = []
+    for clave, valor in etiquetas:
+        valor = str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        partes.append(f'{clave}="{valor}"')
+    return '{' + ','.join(partes) + '}'
+
+
+class Contador:
+    def __init__(self, nombre, ayuda):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self._valores = {}
+        self._lock = threading.Lock()
+
+    def inc(self, cantidad=1, **etiquetas):
+        clave = tuple(sorted(etiquetas.items()))
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + cantidad
+
+    def valores(self):
+        """Dict {valor_de_la_única_etiqueta o tupla de etiquetas: total}."""
+        with self._lock:
+            return {
+                (clave[0][1] if len(clave) == 1 else clave): valor for clave, valor in self._valores.items()
+            }
+
+    def exportar(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} counter"]
+        with self._lock:
+            for clave, valor in sorted(self._valores.items()):
+                lineas.append(f"{self.nombre}{_etiquetas_texto(clave)} {valor}")
+        return lineas
+
+
+class Histograma:
+    def __init__(self, nombre, ayuda, buckets=BUCKETS_SEGUNDOS):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.buckets = tuple(buckets)
+        self._series = {} # etiquetas -> [conteos por bucket..., suma, conteo]
+        self._lock = threading.Lock()
+
+    def observar(self, valor, **etiquetas):
+        clave = tuple(sorted(etiquetas.items()))
+        indice = bisect.bisect_left(self.buckets, valor)
+        with self._lock:
+            serie = self._series.get(clave)
+            if serie is None:
+                serie = self._series[clave] = [0] * (len(self.buckets) + 2)
+            if indice < len(self.buckets):
+                serie[indice] += 1
+            serie[-2] += valor
+            serie[-1] += 1
+
+    @contextmanager
+    def medir(self, **etiquetas):
+        """Mide el tiempo del bloque `with` en segundos."""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(time.perf_counter() - inicio, **etiquetas)
+
+    def exportar(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} histogram"]
+        with self._lock:
+            series = {clave: list(serie) for clave, serie in self._series.items()}
+        for clave, serie in sorted(series.items()):
+            acumulado = 0
+            for limite, conteo in zip(self.buckets, serie):
+                acumulado += conteo
+                lineas.append(f"{self.nombre}_bucket{_etiquetas_texto(clave + (('le', limite),))} {acumulado}")
+            lineas.append(f"{self.nombre}_bucket{_etiquetas_texto(clave + (('le', '+Inf'),))} {serie[-1]}")
+            lineas.append(f"{self.nombre}_sum{_etiquetas_texto(clave)} {serie[-2]}")
+            lineas.append(f"{self.nombre}_count{_etiquetas_texto(clave)} {serie[-1]}")
+        return lineas
+
+
+class Medidor:
+    def __init__(self, nombre, ayuda, funcion):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.funcion = funcion
+
+    def exportar(self):
+        return [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} gauge",
+                f"{self.nombre} {self.funcion()}"]
+
+
+class RegistroMetricas:
+    """Agrupa las métricas y las exporta en formato de texto de Prometheus."""
+
+    def __init__(self, prefijo=""):
+        self.prefijo = prefijo
+        self._metricas = []
+
+    def _agregar(self, metrica):
+        self._metricas.append(metrica)
+        return metrica
+
+    def contador(self, nombre, ayuda):
+        return self._agregar(Contador(self.prefijo + nombre, ayuda))
+
+    def histograma(self, nombre, ayuda, buckets=BUCKETS_SEGUNDOS):
+        return self._agregar(Histograma(self.prefijo + nombre, ayuda, buckets))
+
+    def medidor(self, nombre, ayuda, funcion):
+        return self._agregar(Medidor(self.prefijo + nombre, ayuda, funcion))
+
+    def exportar(self):
+        lineas = []
+        for metrica in self._metricas:
+            lineas.extend(metrica.exportar())
+        return '\n'.join(lineas) + '\n'
@@ -0,0 +1,197 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+#_______________________________________________________________________________________
+"""
+Programador de envíos salientes hacia la API de WhatsApp.
+
+-Orden por destinatario: los mensajes a un mismo telefono_id salen en orden FIFO y de a
+uno (el siguiente solo después de que terminó el anterior), así texto -> imagen -> botones
+llegan en orden aunque el envío sea concurrente.
+-Paralelismo entre destinatarios: un grupo de hilos atiende por turnos a los destinatarios
+con mensajes pendientes, sin bloqueo de cabeza de fila entre usuarios.
+-Límite de tasa: una cubeta de tokens por phone-number-id emisor, según el nivel de
+throughput de la API Graph (por defecto 80 mensajes/s).
+-Con la cola llena, quien encola espera un tiempo acotado a que haya lugar; nunca se envía
+por fuera de la cola (rompería el orden con los mensajes ya encolados al mismo destinatario).
+-Métricas: latencia en cola (de encolar a enviar) p50/p99/máx, pendientes y esperas por límite.
+"""
+#_______________________________________________________________________________________
+
+
+class CubetaTokens:
+    """Cubeta de tokens: `tasa` tokens por segundo con capacidad `rafaga`."""
+
+    def __init__(self, tasa, rafaga=None):
+        self.tasa = float(tasa)
+        self.rafaga = float(rafaga or tasa)
+        self._tokens = self.rafaga
+        self._ultima = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reservar(self):
+        """Reserva un token y retorna los segundos a esperar antes de usarlo (0 si hay disponible)."""
+        with self._lock:
+            ahora = time.monotonic()
+            self._tokens = min(self.rafaga, self._tokens + (ahora - self._ultima) * self.tasa)
+            self._ultima = ahora
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.tasa
+
+
+class LimitadorTasa:
+    """Una cubeta de tokens por phone-number-id emisor."""
+
+    def __init__(self, tasa=80, rafaga=None):
+        self.tasa = tasa
+        self.rafaga = rafaga
+        self._cubetas = {}
+        self._lock = threading.Lock()
+        self.esperas = 0
+
+    def reservar(self, phone_number_id):
+        """Segundos a esperar para poder enviar desde este número (0 si puede enviar ya)."""
+        with self._lock:
+            cubeta = self._cubetas.get(phone_number_id)
+            if cubeta is None:
+                cubeta = self._cubetas[phone_number_id] = CubetaTokens(self.tasa, self.rafaga)
+        espera = cubeta.reservar()
+        if espera:
+            with self._lock:
+                self.esperas += 1
+        return espera
+
+    def esperar(self, phone_number_id):
+        """Bloquea el hilo hasta que haya un token para este número."""
+        espera = self.reservar(phone_number_id)
+        if espera:
+            time.sleep(espera)
+
+
+class ProgramadorEnvios:
+    """Cola de envíos ordenada por destinatario, con hilos de envío y límite de tasa."""
+
+    def __init__(self, enviar, limitador, num_hilos=8, max_pendientes=10000, muestras_latencia=1000, espera_encolar=5.0):
+        self.enviar_fn = enviar # enviar(cuerpo) hace la llamada a la API
+        self.limitador = limitador
+        self.num_hilos = num_hilos
+        self.max_pendientes = max_pendientes
+        self.espera_encolar = espera_encolar
+        self._pendientes = {} # telefono_id -> deque[(phone_number_id, cuerpo, momento_encolado)]
+        self._listos = queue.Queue() # Destinatarios con mensajes y sin envío en curso
+        self._lock = threading.Lock()
+        self._hay_lugar = threading.Condition(self._lock)
+        self._hilos = []
+        self._cerrado = False
+        self._latencias = deque(maxlen=muestras_latencia)
+        self.total_pendientes = 0
+        self.encolados = 0
+        self.enviados = 0
+        self.fallidos = 0
+        self.rechazados = 0
+
+    def iniciar(self):
+        with self._lock:
+            if self._hilos:
+                return
+            for i in range(self.num_hilos):
+                hilo = threading.Thread(target=self._trabajar, name=f"envios-{i}", daemon=True)
+                hilo.start()
+                self._hilos.append(hilo)
+
+    def enviar(self, phone_number_id, telefono_id, cuerpo):
+        """
+        Encola un mensaje para `telefono_id`. Si hay `max_pendientes` espera hasta `espera_encolar`
+        segundos a que se libere lugar; retorna False si sigue llena o está cerrado.
+        """
+        self.iniciar()
+        with self._lock:
+            limite = time.monotonic() + self.espera_encolar
+            while not self._cerrado and self.total_pendientes >= self.max_pendientes:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                self._hay_lugar.wait(restante)
+            if self._cerrado or self.total_pendientes >= self.max_pendientes:
+                self.rechazados += 1
+                logging.warning(f"Envío a {telefono_id} rechazado: cola de envíos llena o cerrada")
+                return False
+            fila = self._pendientes.get(telefono_id)
+            if fila is None:
+                # Destinatario sin pendientes ni envío en curso: pasa a la fila de listos
+                fila = self._pendientes[telefono_id] = deque()
+                self._listos.put(telefono_id)
+            fila.append((phone_number_id, cuerpo, time.monotonic()))
+            self.total_pendientes += 1
+            self.encolados += 1
+        return True
+
+    def _trabajar(self):
+        while True:
+            telefono_id = self._listos.get()
+            if telefono_id is None:
+                return
+            with self._lock:
+                phone_number_id, cuerpo, encolado = self._pendientes[telefono_id].popleft()
+            self.limitador.esperar(phone_number_id)
+            self._latencias.append(time.monotonic() - encolado)
+            try:
+                self.enviar_fn(cuerpo)
+                exito = True
+            except Exception as e:
+                exito = False
+                logging.error(f"Error enviando mensaje a {telefono_id}: {e}")
+            with self._lock:
+                self.total_pendientes -= 1
+                self._hay_lugar.notify()
+                if exito:
+                    self.enviados += 1
+                else:
+                    self.fallidos += 1
+                # Si el destinatario tiene más mensajes vuelve al final de la fila (turnos justos)
+                if self._pendientes[telefono_id]:
+                    self._listos.put(telefono_id)
+                else:
+                    del self._pendientes[telefono_id]
+
+    def vaciar(self, timeout=30):
+        """Espera a que no queden mensajes pendientes."""
+        limite = time.monotonic() + timeout
+        while time.monotonic() < limite:
+            with self._lock:
+                if not self.total_pendientes:
+                    return True
+            time.sleep(0.01)
+        return False
+
+    def detener(self, timeout=30):
+        """Deja de aceptar mensajes, envía los pendientes y detiene los hilos."""
+        with self._lock:
+            if self._cerrado:
+                return
+            self._cerrado = True
+        if not self.vaciar(timeout):
+            logging.warning(f"Programador de envíos detenido con {self.total_pendientes} mensajes sin enviar")
+        for _ in self._hilos:
+            self._listos.put(None)
+
+    def estadisticas(self):
+        latencias = sorted(self._latencias)
+        def percentil(p):
+            return round(latencias[min(len(latencias) - 1, int(len(latencias) * p))] * 1000, 2) if latencias else None
+        with self._lock:
+            return {
+                'pendientes': self.total_pendientes,
+                'destinatarios_activos': len(self._pendientes),
+                'encolados': self.encolados,
+                'enviados': self.enviados,
+                'fallidos': self.fallidos,
+                'rechazados': self.rechazados,
+                'esperas_por_limite': self.limitador.esperas,
+                'latencia_cola_ms': {'p50': percentil(0.5), 'p99': percentil(0.99), 'max': percentil(1.0)},
+            }
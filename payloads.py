@@ -0,0 +1,129 @@
+import json
+import threading
+
+#_______________________________________________________________________________________
+"""
+Construcción de los cuerpos JSON de los mensajes salientes de WhatsApp.
+
+El contenido de cada mensaje del bot solo cambia por el destinatario ("to"), así que
+cada combinación (tipo, texto, botones) se serializa una sola vez como bytes y al
+enviar solo se inserta el teléfono entre el prefijo y el sufijo ya serializados.
+Las imágenes se envían por media id cuando ya se subieron a /media (media.py), o por link.
+"""
+#_______________________________________________________________________________________
+
+_MARCADOR_DESTINATARIO = "\x00destinatario\x00"
+
+
+def construir_payload(telefono_id, message_text, message_type='text', button_titles=None, button_ids=None,
+                      image_link=None, image_id=None):
+    """Retorna el dict del mensaje para la API de WhatsApp, o None si el tipo o los parámetros no son válidos."""
+    if message_type == 'text':
+        return {
+            "messaging_product": "whatsapp",
+            "recipient_type": "individual",
+            "to": telefono_id,
+            "type": "text",
+            "text": {
+                "preview_url": False,
+                "body": message_text
+            }
+        }
+    elif message_type == 'image':
+        return {
+            "messaging_product": "whatsapp",
+            "recipient_type": "individual",
+            "to": telefono_id,
+            "type": "image",
+            "image": {
+                **({"id": image_id} if image_id else {"link": image_link}), # Por id, Meta no descarga la URL en cada envío
+                "caption": message_text # El texto se usa como descripción de la imagen
+            }
+        }
+    elif message_type == 'button' and button_titles and button_ids and len(button_titles) == len(button_ids):
+        buttons = []
+        for i in range(len(button_titles)):
+            buttons.append({
+                "type": "reply",
+                "reply": {"id": button_ids[i], "title": button_titles[i]}
+            })
+        return {
+            "messaging_product": "whatsapp",
+            "recipient_type": "individual",
+            "to": telefono_id,
+            "type": "interactive",
+            "interactive": {
+                "type": "button",
+                "body": {"text": message_text},
+                "footer": {"text": "Select one of the options:"},
+                "action": {"buttons": buttons}
+            }
+        }
+    return None
+
+
+class PlantillaPayload:
+    """Payload serializado una vez, con el destinatario como único hueco."""
+
+    __slots__ = ('prefijo', 'sufijo')
+
+    def __init__(self, data):
+        serializado = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        marcador = json.dumps(_MARCADOR_DESTINATARIO).encode('utf-8')
+        self.prefijo, self.sufijo = serializado.split(marcador)
+
+    def para(self, telefono_id):
+        """Retorna el cuerpo en bytes para el destinatario dado."""
+        return self.prefijo + json.dumps(telefono_id).encode('utf-8') + self.sufijo
+
+
+class CachePlantillas:
+    """Plantillas por (tipo, texto, títulos, ids). Se precargan al arrancar; las nuevas se agregan hasta `max_plantillas`."""
+
+    def __init__(self, image_link=None, max_plantillas=1024):
+        self.image_link = image_link
+        self.image_id = None
+        self.max_plantillas = max_plantillas
+        self._plantillas = {}
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, message_text, message_type='text', button_titles=None, button_ids=None):
+        """Retorna la PlantillaPayload del mensaje, o None si el tipo o los parámetros no son válidos."""
+        clave = (message_type, message_text, tuple(button_titles or ()), tuple(button_ids or ()))
+        plantilla = self._plantillas.get(clave)
+        if plantilla is not None:
+            self.aciertos += 1
+            return plantilla
+        self.fallos += 1
+        image_id = self.image_id
+        data = construir_payload(_MARCADOR_DESTINATARIO, message_text, message_type, button_titles, button_ids,
+                                 self.image_link, image_id)
+        if data is None:
+            return None
+        plantilla = PlantillaPayload(data)
+        with self._lock:
+            # Si el media id cambió mientras se construía, esta plantilla no se guarda
+            if len(self._plantillas) < self.max_plantillas and image_id == self.image_id:
+                self._plantillas[clave] = plantilla
+        return plantilla
+
+    def usar_imagen_id(self, image_id):
+        """Envía las imágenes por media id desde ahora: se descartan las plantillas de imagen con el link anterior."""
+        with self._lock:
+            self.image_id = image_id
+            for clave in [clave for clave in self._plantillas if clave[0] == 'image']:
+                del self._plantillas[clave]
+
+    def precargar(self, mensajes):
+        """Construye por adelantado las plantillas de una lista de (tipo, texto, títulos, ids)."""
+        for message_type, message_text, button_titles, button_ids in mensajes:
+            self.obtener(message_text, message_type, button_titles, button_ids)
+
+    def estadisticas(self):
+        return {
+            'plantillas': len(self._plantillas),
+            'aciertos': self.aciertos,
+            'fallos': self.fallos,
+        }
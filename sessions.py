@@ -0,0 +1,71 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+#_______________________________________________________________________________________
+"""
+Sesión por usuario (idioma, paso actual del flujo y última actividad).
+
+La consulta de idioma se había quitado porque iba a la DB en cada mensaje. Ahora las
+sesiones viven en una caché LRU con TTL en memoria:
+-Lectura: acierto en caché sin ir a la DB; solo en un fallo se llama a `cargar(telefono)`.
+-Escritura diferida (write-behind): cada cambio se entrega a `persistir(sesion)`, que
+lo encola para guardarse por lotes fuera del camino del mensaje.
+"""
+#_______________________________________________________________________________________
+
+
+class AlmacenSesiones:
+    """Caché LRU con TTL de sesiones de usuario respaldada por la DB."""
+
+    def __init__(self, cargar, persistir, ttl=1800, max_sesiones=50000, idioma_por_defecto="es"):
+        self.cargar = cargar
+        self.persistir = persistir
+        self.ttl = ttl
+        self.max_sesiones = max_sesiones
+        self.idioma_por_defecto = idioma_por_defecto
+        self._cache = OrderedDict() # telefono -> (momento de carga, sesion)
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, telefono_id):
+        """Retorna la sesión del usuario (dict con 'idioma', 'paso' y 'ultima_vez')."""
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._cache.get(telefono_id)
+            if entrada is not None and ahora - entrada[0] <= self.ttl:
+                self._cache.move_to_end(telefono_id)
+                self.aciertos += 1
+                return entrada[1]
+            self.fallos += 1
+        sesion = self.cargar(telefono_id) or {'idioma': self.idioma_por_defecto, 'paso': None, 'ultima_vez': None}
+        self._guardar_en_cache(telefono_id, sesion)
+        return sesion
+
+    def _guardar_en_cache(self, telefono_id, sesion):
+        with self._lock:
+            self._cache[telefono_id] = (time.monotonic(), sesion)
+            self._cache.move_to_end(telefono_id)
+            while len(self._cache) > self.max_sesiones:
+                self._cache.popitem(last=False)
+
+    def actualizar(self, telefono_id, **cambios):
+        """Aplica cambios a la sesión en caché y los encola para persistir."""
+        with self._lock:
+            entrada = self._cache.get(telefono_id)
+        actual = entrada[1] if entrada is not None else self.obtener(telefono_id)
+        sesion = dict(actual, **cambios)
+        sesion['ultima_vez'] = datetime.utcnow()
+        self._guardar_en_cache(telefono_id, sesion)
+        self.persistir({'telefono_usuario_id': telefono_id, **sesion})
+        return sesion
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'sesiones_en_cache': len(self._cache),
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+            }
@@ -0,0 +1,188 @@
+import itertools
+import logging
+import queue
+import threading
+import time
+import zlib
+
+#_______________________________________________________________________________________
+"""
+Cola de trabajo acotada para procesar los mensajes del webhook en segundo plano.
+
+El webhook solo valida, encola y responde 200 a Meta; un grupo fijo de hilos
+consume la cola y ejecuta el flujo de respuesta (envíos a la API de WhatsApp y log).
+-Backpressure: si la cola está llena se espera un tiempo corto y luego se rechaza,
+para que Meta reintente más tarde en lugar de acumular memoria sin límite.
+-Métricas: profundidad de la cola, tareas encoladas, procesadas, fallidas y rechazadas.
+-Drenado: al apagar se procesan las tareas pendientes antes de detener los hilos.
+-Orden por clave: cada hilo tiene su propia cola y las tareas con la misma clave
+(p. ej. el teléfono del usuario) van siempre al mismo hilo, así se respetan en orden FIFO
+mientras que claves distintas se procesan en paralelo.
+TareaPeriodica ejecuta una función de mantenimiento cada cierto intervalo en un hilo aparte.
+"""
+#_______________________________________________________________________________________
+
+_FIN = object() # Marcador para detener cada hilo trabajador
+
+
+class ColaLlena(Exception):
+    """Una tarea del webhook no entró en su cola: se responde 503 para que Meta reintente."""
+
+
+class ColaTrabajo:
+    """Grupo de hilos trabajadores que consumen una cola acotada de tareas."""
+
+    def __init__(self, nombre="webhook", num_trabajadores=4, tamano_maximo=1000, espera_encolar=0.5):
+        self.nombre = nombre
+        self.num_trabajadores = num_trabajadores
+        self.espera_encolar = espera_encolar
+        # Una cola por hilo; la capacidad total se reparte entre ellas
+        tamano_por_hilo = max(1, tamano_maximo // num_trabajadores)
+        self._colas = [queue.Queue(maxsize=tamano_por_hilo) for _ in range(num_trabajadores)]
+        self._turno = itertools.count()
+        self._hilos = []
+        self._lock = threading.Lock()
+        self._iniciada = False
+        self._cerrada = False
+        self.encolados = 0
+        self.procesados = 0
+        self.fallidos = 0
+        self.rechazados = 0
+        self.profundidad_maxima = 0
+
+    def iniciar(self):
+        """Arranca los hilos trabajadores (solo la primera vez)."""
+        with self._lock:
+            if self._iniciada:
+                return
+            self._iniciada = True
+            for i, cola in enumerate(self._colas):
+                hilo = threading.Thread(target=self._trabajar, args=(cola,), name=f"{self.nombre}-{i}", daemon=True)
+                hilo.start()
+                self._hilos.append(hilo)
+
+    def _cola_para(self, clave):
+        if clave is None:
+            return self._colas[next(self._turno) % self.num_trabajadores]
+        # crc32 es estable entre procesos (hash() de str no lo es)
+        return self._colas[zlib.crc32(str(clave).encode()) % self.num_trabajadores]
+
+    def encolar(self, funcion, *args, clave=None):
+        """
+        Agrega una tarea a la cola. Las tareas con la misma `clave` se ejecutan en orden.
+        Retorna False si la cola sigue llena después de `espera_encolar` segundos o si ya se cerró.
+        """
+        if self._cerrada:
+            self._contar('rechazados')
+            return False
+        self.iniciar()
+        cola = self._cola_para(clave)
+        try:
+            cola.put((funcion, args), timeout=self.espera_encolar)
+        except queue.Full:
+            self._contar('rechazados')
+            logging.warning(f"Cola '{self.nombre}' llena ({cola.maxsize}), tarea rechazada")
+            return False
+        with self._lock:
+            self.encolados += 1
+            self.profundidad_maxima = max(self.profundidad_maxima, self._profundidad())
+        return True
+
+    def _profundidad(self):
+        return sum(cola.qsize() for cola in self._colas)
+
+    def _contar(self, campo):
+        with self._lock:
+            setattr(self, campo, getattr(self, campo) + 1)
+
+    def _trabajar(self, cola):
+        while True:
+            tarea = cola.get()
+            try:
+                if tarea is _FIN:
+                    return
+                funcion, args = tarea
+                try:
+                    funcion(*args)
+                    self._contar('procesados')
+                except Exception as e:
+                    self._contar('fallidos')
+                    logging.error(f"Error procesando tarea en cola '{self.nombre}': {e}")
+            finally:
+                cola.task_done()
+
+    def detener(self, timeout=30):
+        """Deja de aceptar tareas, drena las pendientes y espera a que terminen los hilos."""
+        with self._lock:
+            if self._cerrada:
+                return
+            self._cerrada = True
+            hilos = list(self._hilos)
+        limite = time.monotonic() + timeout
+        for cola in self._colas[:len(hilos)]:
+            cola.put(_FIN)
+        for hilo in hilos:
+            hilo.join(max(0, limite - time.monotonic()))
+        pendientes = self._profundidad()
+        if pendientes:
+            logging.warning(f"Cola '{self.nombre}' detenida con {pendientes} tareas sin procesar")
+
+    def estadisticas(self):
+        """Retorna un diccionario con las métricas actuales de la cola."""
+        with self._lock:
+            return {
+                'profundidad': self._profundidad(),
+                'capacidad': sum(cola.maxsize for cola in self._colas),
+                'profundidad_maxima': self.profundidad_maxima,
+                'trabajadores': self.num_trabajadores,
+                'encolados': self.encolados,
+                'procesados': self.procesados,
+                'fallidos': self.fallidos,
+                'rechazados': self.rechazados,
+            }
+
+
+class TareaPeriodica:
+    """
+    Ejecuta `funcion` cada `intervalo` segundos en un hilo daemon (con `inmediata` también al
+    iniciar); los errores se registran y no la detienen.
+    """
+
+    def __init__(self, nombre, funcion, intervalo, inmediata=False):
+        self.nombre = nombre
+        self.funcion = funcion
+        self.intervalo = intervalo
+        self.inmediata = inmediata
+        self._detener = threading.Event()
+        self._hilo = None
+        self._lock = threading.Lock()
+        self.ejecuciones = 0
+        self.fallidas = 0
+
+    def iniciar(self):
+        """Arranca el hilo (solo la primera vez)."""
+        with self._lock:
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._ejecutar, name=self.nombre, daemon=True)
+                self._hilo.start()
+        return self
+
+    def _ejecutar(self):
+        if self.inmediata:
+            self._ejecutar_una_vez()
+        while not self._detener.wait(self.intervalo):
+            self._ejecutar_una_vez()
+
+    def _ejecutar_una_vez(self):
+        try:
+            self.funcion()
+            self.ejecuciones += 1
+        except Exception as e:
+            self.fallidas += 1
+            logging.error(f"Error en la tarea periódica {self.nombre}: {e}")
+
+    def detener(self, timeout=30):
+        """Detiene la tarea; si está ejecutándose se espera a que termine."""
+        self._detener.set()
+        if self._hilo is not None:
+            self._hilo.join(timeout)